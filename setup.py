@@ -140,6 +140,7 @@ if __name__ == "__main__":
           #scripts and plugins
           entry_points = {
                           #'console_scripts': ['automat_decode_nispy = automat.scripts.decode_nispy:main']
+                          'console_scripts': ['automat_reprocess_events = automat.core.events.parallel_parser:main'],
                          },
           **PACKAGE_METADATA 
     )
@@ -0,0 +1,278 @@
+""" an EventServer which serves all of its clients from a single asyncio event
+    loop, suitable for many concurrent subscribers
+"""
+###############################################################################
+import socket, asyncio, queue
+from automat.core.threads.interruptible_thread import InterruptibleThread
+from automat.core.network.framing import FRAME_HEADER, read_frame_async
+from automat.core.network.serializers import DEFAULT_SERIALIZER, SerializerError, choose_serializer, get_serializer, make_hello, parse_hello, get_event_serializer_names
+from .event_server import reserve_port, now, encode_event, CURSOR_MAX_EVENTS
+from .event_caching import EventCachingProcess
+from .subscription  import EventSubscription, DEFAULT_SUBSCRIBE_TIMEOUT
+
+###############################################################################
+DEFAULT_MAX_LAG       = 100000  #events a client may fall behind before the slow client policy applies
+DEFAULT_DRAIN_TIMEOUT = 10.0    #seconds a client may block its socket buffer before the slow client policy applies
+WRITE_BUFFER_HIGH     = 256*1024  #bytes buffered per client before writes wait on the client (backpressure)
+SLOW_CLIENT_POLICIES  = ('drop', 'disconnect')
+FRAME_CACHE_SIZE      = 2*CURSOR_MAX_EVENTS  #recently encoded events shared between clients
+
+def _key_index(key):
+    "the absolute event index of a frame cache key"
+    return key[0]
+
+###############################################################################
+class AsyncEventServer(InterruptibleThread):
+    """Serves the cached events to any number of clients from one thread.
+
+       Writes to a client wait while its socket buffer is full, during which
+       its cursor falls behind. A client which falls behind by more than 
+       'max_lag' events is handled according to 'slow_client_policy':
+         'drop'       - skip the client ahead to the newest events and send an
+                        ('EVENTS_DROPPED', {'count': n}) event in their place
+         'disconnect' - close the client connection
+       A client whose socket does not drain within 'drain_timeout' is always
+       disconnected.
+    """
+    def __init__(self,
+                 event_queue,
+                 port                  = None,
+                 sock_obj              = None,
+                 log_func              = None,
+                 event_caching_process = None,
+                 event_file            = None,
+                 max_clients           = None,  #None is unlimited
+                 max_lag               = DEFAULT_MAX_LAG,
+                 drain_timeout         = DEFAULT_DRAIN_TIMEOUT,
+                 slow_client_policy    = 'drop',
+                 subscribe_timeout     = DEFAULT_SUBSCRIBE_TIMEOUT,
+                 serializers           = None,  #names of the accepted serializers, None accepts all available which can send events
+                ):
+        #set up the thread
+        InterruptibleThread.__init__(self)
+        self.daemon = True
+        self.event_queue  = event_queue
+        self.event_file   = event_file
+        if log_func is None:
+            def log_func(text):
+                print(text)
+        self.log_func = log_func #logging function
+        if not slow_client_policy in SLOW_CLIENT_POLICIES:
+            raise ValueError("'slow_client_policy' must be one of %r, got %r" % (SLOW_CLIENT_POLICIES, slow_client_policy))
+        self.max_clients        = max_clients
+        self.max_lag            = max_lag
+        self.drain_timeout      = drain_timeout
+        self.slow_client_policy = slow_client_policy
+        self.subscribe_timeout  = subscribe_timeout
+        self.serializers        = get_event_serializer_names(serializers)
+        #create a socket which accepts python objects and bind to port
+        if sock_obj is None:
+            sock_obj = reserve_port(port)
+        elif port:
+            sock_obj.bind(("",port))
+        self.sock_obj = sock_obj
+        #configure event udpating thread
+        if event_caching_process is None:
+            event_caching_process = EventCachingProcess(event_queue = event_queue, event_file = event_file)
+        self.event_caching_process = event_caching_process
+        #event loop state, only touched from within the loop
+        self._loop          = None
+        self._stopping      = None
+        self._wakeup_queued = False
+        self._client_wakeups = set()
+        self._client_writers = set()
+        self._client_tasks   = set()
+        self._frame_cache    = {} #(absolute event index, sequenced, serializer name) -> encoded event
+
+    def shutdown(self, close_sock_obj = True):
+        self.stop_event.set()
+        loop = self._loop
+        if not loop is None:
+            try:
+                loop.call_soon_threadsafe(self._stopping.set)
+            except RuntimeError: #loop already closed
+                pass
+        self.join()
+        if close_sock_obj:
+            self.sock_obj.close()
+        self.log("server shutdown")
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    def get_client_count(self):
+        return len(self._client_writers)
+
+    def log(self,msg):
+        msg = "%s: %s" % (now(),msg)
+        self.log_func(msg)
+
+    #--------------------------------------------------------------------------
+    # Event loop methods
+    async def _serve(self):
+        self._loop     = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        if self.stop_event.isSet(): #shutdown before the loop was running
+            return
+        self.event_caching_process.add_listener(self._on_new_events)
+        server = await asyncio.start_server(self.handle_client, sock = self.sock_obj, backlog = 128)
+        self.log("server started")
+        try:
+            await self._stopping.wait()
+        finally:
+            self.event_caching_process.remove_listener(self._on_new_events)
+            server.close()
+            #let the client handlers exit their loops, dropping any unsent data
+            self._wake_clients()
+            for writer in list(self._client_writers):
+                writer.transport.abort()
+            await asyncio.gather(*self._client_tasks, return_exceptions = True)
+            await server.wait_closed()
+
+    def _on_new_events(self):
+        "called in the caching thread, schedules one wakeup of the clients"
+        if not self._wakeup_queued:
+            self._wakeup_queued = True
+            try:
+                self._loop.call_soon_threadsafe(self._wake_clients)
+            except RuntimeError: #loop already closed
+                pass
+
+    def _wake_clients(self):
+        self._wakeup_queued = False
+        for wakeup in self._client_wakeups:
+            wakeup.set()
+
+    async def handle_client(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        if not self.max_clients is None and len(self._client_writers) >= self.max_clients:
+            self.log("refused client at %s, already serving %d clients" % (address, self.max_clients))
+            writer.close()
+            return
+        self.log("server connected by client at %s" % (address,))
+        writer.transport.set_write_buffer_limits(high = WRITE_BUFFER_HIGH)
+        wakeup = asyncio.Event()
+        task   = asyncio.current_task()
+        self._client_wakeups.add(wakeup)
+        self._client_writers.add(writer)
+        self._client_tasks.add(task)
+        try:
+            subscription, serializer = await self._receive_subscription(reader, writer)
+            await self._stream_events(writer, wakeup, subscription, serializer)
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, socket.error, ValueError) as exc:
+            self.log("client at %s disconnected: %r" % (address, exc))
+        except Exception as exc:
+            #a bad client mustn't take down the others
+            self.log("client at %s failed: %r" % (address, exc))
+        finally:
+            self._client_wakeups.discard(wakeup)
+            self._client_writers.discard(writer)
+            self._client_tasks.discard(task)
+            writer.close()
+
+    async def _receive_subscription(self, reader, writer):
+        """wait briefly for the client to negotiate a serializer and send an
+           optional subscription, returns (subscription, serializer), clients
+           which don't negotiate get pickled events
+        """
+        try:
+            data = await asyncio.wait_for(read_frame_async(reader), timeout = self.subscribe_timeout)
+        except asyncio.TimeoutError:
+            return (EventSubscription(), self._get_default_serializer())
+        offered = parse_hello(data)
+        if offered is None:
+            serializer = self._get_default_serializer()
+            return (EventSubscription.from_message(serializer.loads(data)), serializer)
+        name  = choose_serializer(offered, self.serializers)
+        reply = make_hello([name] if name else [])
+        writer.write(FRAME_HEADER.pack(len(reply)) + reply)
+        if name is None:
+            raise SerializerError("accepts none of the offered serializers %r" % (offered,))
+        serializer = get_serializer(name)
+        try:
+            data = await asyncio.wait_for(read_frame_async(reader), timeout = self.subscribe_timeout)
+        except asyncio.TimeoutError:
+            return (EventSubscription(), serializer)
+        return (EventSubscription.from_message(serializer.loads(data)), serializer)
+
+    def _get_default_serializer(self):
+        "the serializer for clients which don't negotiate"
+        if not DEFAULT_SERIALIZER.name in self.serializers:
+            raise SerializerError("client must negotiate one of the serializers %r" % (self.serializers,))
+        return DEFAULT_SERIALIZER
+
+    async def _stream_events(self, writer, wakeup, subscription, serializer):
+        event_cache        = self.event_caching_process.event_cache
+        event_cache_cursor = self.event_caching_process.get_cursor(max_events = CURSOR_MAX_EVENTS)
+        encode_event       = self._encode_event
+        name               = serializer.name
+        #send the previous events incrementally
+        for msg in subscription.replay_history(event_cache_cursor):
+            writer.write(encode_event(msg, serializer))
+            await self._drain(writer)
+        sequenced = subscription.sequenced
+        while not self._stopping.is_set():
+            #clear before checking so that a wakeup can't be missed
+            wakeup.clear()
+            events = event_cache_cursor.get_events(block = False)
+            if not events:
+                await wakeup.wait()
+                continue
+            if sequenced:
+                frames = [encode_event(item, serializer, (item[0], True, name)) for item in subscription.select(events)]
+            elif subscription.matches_all():
+                frames = [encode_event(event, serializer, (index, False, name)) for index, event in enumerate(events, events.start)]
+            else:
+                match  = subscription.match
+                frames = [encode_event(event, serializer, (index, False, name)) for index, event in enumerate(events, events.start) if match(event)]
+            #handle clients which are falling behind
+            lag = event_cache.end_index - event_cache_cursor.cursor_index
+            if lag > self.max_lag:
+                if self.slow_client_policy == 'disconnect':
+                    raise ConnectionError("client fell behind by %d events" % lag)
+                event_cache_cursor.cursor_index = event_cache.end_index
+                frames.append(encode_event(('EVENTS_DROPPED', {'count': lag}), serializer))
+            if frames:
+                #write the whole batch at once, so the transport can send it with one system call
+                writer.writelines(frames)
+                await self._drain(writer)
+
+    def _encode_event(self, event, serializer, key = None):
+        """serialize and frame the event, events with a 'key' (absolute index,
+           sequenced, serializer name) are only encoded once for all clients
+        """
+        if not key is None:
+            frame = self._frame_cache.get(key)
+            if not frame is None:
+                return frame
+        frame = b"".join(encode_event(serializer, event))
+        if not key is None:
+            frame_cache = self._frame_cache
+            frame_cache[key] = frame
+            if len(frame_cache) > FRAME_CACHE_SIZE:
+                #forget the oldest half
+                cutoff = self.event_caching_process.event_cache.end_index - FRAME_CACHE_SIZE//2
+                for old_key in [k for k in frame_cache if _key_index(k) < cutoff]:
+                    del frame_cache[old_key]
+        return frame
+
+    async def _drain(self, writer):
+        "wait for the client to accept the buffered data, applying backpressure"
+        await asyncio.wait_for(writer.drain(), timeout = self.drain_timeout)
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    import time, datetime
+    EVENT_QUEUE = queue.Queue()
+    server = AsyncEventServer(event_queue = EVENT_QUEUE, port = 50007)
+    server.event_caching_process.start()
+    server.start()
+    try:
+        while True:
+            EVENT_QUEUE.put(('TIME', {'now': datetime.datetime.now()}))
+            time.sleep(1.0)
+    finally:
+        server.shutdown()
+        server.event_caching_process.shutdown()
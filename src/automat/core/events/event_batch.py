@@ -0,0 +1,44 @@
+""" batches of events, put on an event queue as a single item
+
+    A controller in a fast acquisition loop buffers its events and sends them
+    as one EventBatch, so that the queue's lock is taken once per batch rather
+    than once per event. The consumers of an event queue unpack the batches,
+    the events in the cache, the event file and the event log are never batched.
+"""
+###############################################################################
+class EventBatch(list):
+    "a list of (event_type, content) events, sent as one queue item"
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<EventBatch of %d events>" % len(self)
+
+def unpack_events(items):
+    "iterate over the events of the queue items, unpacking the batches"
+    for item in items:
+        if isinstance(item, EventBatch):
+            yield from item
+        else:
+            yield item
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    import queue, time
+    NUM_EVENTS = 100000
+    BATCH_SIZE = 256
+    event_queue = queue.Queue()
+    t0 = time.perf_counter()
+    for i in range(NUM_EVENTS):
+        event_queue.put(('SAMPLE', i))
+    t1 = time.perf_counter()
+    batch = EventBatch()
+    for i in range(NUM_EVENTS):
+        batch.append(('SAMPLE', i))
+        if len(batch) >= BATCH_SIZE:
+            event_queue.put(batch)
+            batch = EventBatch()
+    event_queue.put(batch)
+    t2 = time.perf_counter()
+    print("put per event: %0.3f us, batched: %0.3f us" % (1e6*(t1 - t0)/NUM_EVENTS, 1e6*(t2 - t1)/NUM_EVENTS))
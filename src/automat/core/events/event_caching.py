@@ -1,76 +1,238 @@
-import socket, sys, time, datetime, queue, pickle
+import socket, sys, time, datetime, queue, pickle, threading
 from automat.core.threads.interruptible_thread import InterruptibleThread
-WAIT_DELAY = 0.100 #100 ms
+from .ring_buffer import EventRingBuffer, DEFAULT_CAPACITY
+from .event_batch import EventBatch
+from .event_channel import EventChannel
+WAIT_DELAY     = 1.0   #fallback period for noticing a stop_event set from outside of shutdown
+MAX_BATCH_SIZE = 1000  #maximum number of queue items (events or EventBatches) drained per wakeup
+
+#placed on the queue by 'shutdown' to wake up a blocked caching loop
+_WAKEUP = object()
 ###############################################################################
-class EventCacheCursor(object):
-    def __init__(self,event_cache):
+class EventCacheView(object):
+    """A read-only window onto the absolute index range [start, stop) of the
+       event cache, the events are not copied out of the cache
+    """
+    def __init__(self, event_cache, start, stop):
         self.event_cache = event_cache
-        self.cursor_index = 0
+        self.start = start
+        self.stop  = stop
+    def __len__(self):
+        return self.stop - self.start
+    def __iter__(self):
+        return self.event_cache.iter_range(self.start, self.stop)
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("EventCacheView does not support extended slicing")
+            stop = max(start, stop)
+            return EventCacheView(self.event_cache, self.start + start, self.start + stop)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("EventCacheView index out of range")
+        return self.event_cache.get(self.start + key)
+    def __reduce__(self):
+        #pickle as a plain list, never the whole underlying cache
+        return (list, (list(self),))
+    def __repr__(self):
+        return "<EventCacheView [%d:%d]>" % (self.start, self.stop)
+
+###############################################################################
+class EventCacheCursor(object):
+    """Iterates over views of the events that have arrived since the last 
+       iteration, blocking until the caching thread notifies of new events
+    """
+    def __init__(self, 
+                 event_cache, 
+                 cache_updated = None,  #threading.Condition notified on new events
+                 max_events    = None,  #maximum number of events in a view, None is unbounded 
+                 timeout       = None,  #maximum time to block for new events, None waits forever
+                ):
+        self.event_cache   = event_cache
+        self.cache_updated = cache_updated
+        self.max_events    = max_events
+        self.timeout       = timeout
+        self.cursor_index  = 0
     def __iter__(self):
         return self
     def __next__(self):
-        #get all new events
-        events = self.event_cache[self.cursor_index:]
+        return self.get_events(timeout = self.timeout)
+    def has_events(self):
+        return self.event_cache.end_index > self.cursor_index
+    def wait(self, timeout = None):
+        """block until new events are available or the timeout expires,
+           returns True if there are new events
+        """
+        cache_updated = self.cache_updated
+        if cache_updated is None:
+            return self.has_events()
+        with cache_updated:
+            return cache_updated.wait_for(self.has_events, timeout = timeout)
+    def get_events(self, block = True, timeout = None, max_events = "default"):
+        """get a view of the new events and advance the cursor past them,
+           the view will be empty if no events arrived within the timeout
+        """
+        if block:
+            self.wait(timeout = timeout)
+        if max_events == "default":
+            max_events = self.max_events
+        #skip over any events which were cleared or discarded
+        start = max(self.cursor_index, self.event_cache.start_index)
+        stop  = self.event_cache.end_index
+        if not max_events is None:
+            stop = min(stop, start + max_events)
         #advance the cursor
-        self.cursor_index = len(self.event_cache)
-        return events
+        self.cursor_index = stop
+        return EventCacheView(self.event_cache, start, stop)
     
 ###############################################################################
 class EventCachingProcess(InterruptibleThread):
-    def __init__(self, event_queue, event_file = None):
+    def __init__(self, 
+                 event_queue, 
+                 event_file       = None,
+                 event_log        = None,             #an EventLogWriter to record the events in, closed on 'shutdown'
+                 cache_capacity   = DEFAULT_CAPACITY, #maximum number of events held in memory
+                 cache_max_memory = None,             #approximate memory budget in bytes for the cache
+                 cache_spill_path = None,             #segment file for events evicted from memory
+                ):
         InterruptibleThread.__init__(self)
         self.setDaemon(True) #will end automatically on exit
         self.event_file     = event_file
+        self.event_log      = event_log
         self.event_queue    = event_queue
         #create in memory structure for storing events
-        self.event_cache  = [] 
+        self.event_cache  = EventRingBuffer(capacity   = cache_capacity,
+                                            max_memory = cache_max_memory,
+                                            spill_path = cache_spill_path,
+                                           )
+        #notifies the cursors that new events have been cached
+        self.cache_updated = threading.Condition()
+        #callables run in the caching thread after each batch of new events
+        self._listeners = ()
     
     def event_callback(self, event):
         "overload this function to process events as they come in"
         if not self.event_file is None:
-            pickle.dump(event, self.event_file)
-            self.event_file.flush()
+            pickle.dump(event, self.event_file) #flushed once per batch
+        if not self.event_log is None:
+            self.event_log.append(event)        #written out in chunks
         return event   
     
     def clear(self):
-        "clear the event cache"
-        self.event_cache = []
+        "clear the event cache, existing cursors remain valid"
+        self.event_cache.clear()
              
-    def run(self):
-        event_queue    = self.event_queue
-        event_cache    = self.event_cache
+    def shutdown(self):
+        self.stop_event.set()
+        #wake up the caching loop if it is blocked on an empty queue
+        self.event_queue.put(_WAKEUP)
+        self.join()
+        #write the log's footer index, so readers needn't decompress every chunk
+        if not self.event_log is None:
+            self.event_log.close()
+
+    def process_event(self, event):
+        "run the callback on a single event and update the event cache"
         event_callback = self.event_callback
+        try:
+            event = event_callback(event)
+        except Exception as exc:
+            import traceback
+            #event callback failure wrap in error event
+            error_type, exc, tb = sys.exc_info()
+            content = {}
+            content['event'] = event
+            content['error_type'] = error_type
+            content['error_msg']  = msg = str(exc)
+            content['traceback']  = traceback.format_exc()
+            event = ('EVENT_CACHING_ERROR', content)
+            try:
+                event_callback(event)
+            except Exception: #e.g. the event log failing again, the error event is still cached
+                pass
+        #update the event cache
+        self.event_cache.append(event)
+
+    def run(self):
+        process_event  = self.process_event
         stop_event     = self.stop_event
+        cache_updated  = self.cache_updated
         while True:
             try:
-                #see if an event has arrived
-                #throws Queue.Empty if no object in the Queue
-                event = event_queue.get(block=False) 
-                #process the event with the callback 
-                try:
-                    event = event_callback(event)
-                    #update the event_cache list
-                    event_cache.append(event)
-                except Exception as exc:
-                    import traceback
-                    #event callback failure wrap in error event
-                    error_type, exc, tb = sys.exc_info()
-                    content = {}
-                    content['event'] = event
-                    content['error_type'] = error_type
-                    content['error_msg']  = msg = str(exc)
-                    content['traceback']  = traceback.format_exc()                    
-                    err_event = ('EVENT_CACHING_ERROR', content)
-                    event_callback(err_event)
-                    event_cache.append(err_event)  
+                events, drained = self._get_events()
             except queue.Empty:
                 if stop_event.isSet():
+                    self.flush_event_storage()
                     return
-                #wait for items on Queue to arrive
-                stop_event.wait(WAIT_DELAY) 
+                #write out any events the log has held for too long
+                if not self.event_log is None:
+                    self.event_log.flush_if_due()
+                continue
+            for event in events:
+                if event is _WAKEUP:
+                    continue
+                if isinstance(event, EventBatch): #sent together by a controller
+                    for batched_event in event:
+                        process_event(batched_event)
+                    continue
+                process_event(event)
+            if not self.event_file is None:
+                self.event_file.flush()
+            #wake up any cursors waiting on the new events
+            with cache_updated:
+                cache_updated.notify_all()
+            for listener in self._listeners:
+                listener()
+            #only exit once the queue has been emptied
+            if drained and stop_event.isSet():
+                self.flush_event_storage()
+                return
+
+    def _get_events(self):
+        """block until events arrive, returns them with whether the queue was
+           emptied, raises queue.Empty after WAIT_DELAY
+        """
+        event_queue = self.event_queue
+        if isinstance(event_queue, EventChannel):
+            #fan in from the rings of all the producers at once
+            events = event_queue.get_many(MAX_BATCH_SIZE, timeout = WAIT_DELAY)
+            if not events:
+                raise queue.Empty
+            return events, len(events) < MAX_BATCH_SIZE
+        #Queue.get waits on a condition variable so there is no latency added by polling
+        events = [event_queue.get(timeout = WAIT_DELAY)]
+        #drain whatever else has accumulated in one batch
+        try:
+            while len(events) < MAX_BATCH_SIZE:
+                events.append(event_queue.get_nowait())
+        except queue.Empty:
+            return events, True
+        return events, False
+
+    def flush_event_storage(self):
+        "write out all of the events buffered for the event file and log"
+        if not self.event_file is None:
+            self.event_file.flush()
+        if not self.event_log is None:
+            self.event_log.flush()
+
+    def add_listener(self, listener):
+        """register a callable to run (in the caching thread) whenever new 
+           events are cached, it must not block
+        """
+        self._listeners = self._listeners + (listener,)
+
+    def remove_listener(self, listener):
+        self._listeners = tuple(l for l in self._listeners if l != listener)
 
-    def get_cursor(self):
-        return EventCacheCursor(self.event_cache)
+    def get_cursor(self, max_events = None, timeout = None):
+        return EventCacheCursor(self.event_cache, 
+                                cache_updated = self.cache_updated,
+                                max_events    = max_events,
+                                timeout       = timeout,
+                               )
         
 
 ###############################################################################
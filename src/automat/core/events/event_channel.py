@@ -0,0 +1,212 @@
+""" an event queue with one single-producer/single-consumer ring per producing
+    thread, read by one consumer which fans the rings in
+
+    A 'queue.Queue' takes its lock on every 'put', so with many controllers
+    the producers contend on it. The rings of an EventChannel take no lock:
+    the producer stores the item in its slot and then advances the head, the
+    consumer reads up to the head and then advances the tail, and each index
+    is only written by one side (which the GIL makes safe). The consumer is
+    only woken through an Event when it is asleep on empty rings, and a
+    producer only waits on one when its ring is full.
+
+    It has the interface of 'queue.Queue' used by the controllers and the
+    caching thread, so it can be passed as 'thread_init(event_queue = ...)'.
+    Events are kept in order per producing thread, not between threads.
+"""
+###############################################################################
+import threading, queue, time
+
+DEFAULT_RING_CAPACITY = 4096 #events buffered per producing thread
+WAIT_DELAY            = 0.1  #seconds, fallback period for rechecking a wait
+
+###############################################################################
+class _Ring(object):
+    "a bounded ring written by one thread and read by the consumer"
+    __slots__ = ('slots', 'capacity', 'head', 'tail', 'thread', 'producer_waiting', 'space_available')
+
+    def __init__(self, capacity, thread):
+        self.slots    = [None]*capacity
+        self.capacity = capacity
+        self.head     = 0 #count of items written, only advanced by the producer
+        self.tail     = 0 #count of items read, only advanced by the consumer
+        self.thread   = thread
+        self.producer_waiting = False
+        self.space_available  = threading.Event()
+
+###############################################################################
+class EventChannel(object):
+    """Fan-in event queue, any number of threads may 'put', only one thread
+       may 'get', 'get_nowait' or 'get_many'
+    """
+    def __init__(self, ring_capacity = DEFAULT_RING_CAPACITY):
+        self.ring_capacity = ring_capacity
+        self._rings      = () #replaced, never modified, so the consumer reads it without locking
+        self._rings_lock = threading.Lock()
+        self._local      = threading.local()
+        self._consumer_waiting = False
+        self._items_available  = threading.Event()
+        self._next_ring  = 0 #where the consumer's round-robin resumes
+
+    #--------------------------------------------------------------------------
+    # producer side
+    def _add_ring(self):
+        ring = self._local.ring = _Ring(self.ring_capacity, threading.current_thread())
+        with self._rings_lock:
+            self._rings = self._rings + (ring,)
+        return ring
+
+    def put(self, item, block = True, timeout = None):
+        try:
+            ring = self._local.ring
+        except AttributeError: #first item from this thread
+            ring = self._add_ring()
+        head = ring.head
+        if head - ring.tail >= ring.capacity:
+            self._wait_for_space(ring, block, timeout)
+        ring.slots[head % ring.capacity] = item
+        ring.head = head + 1 #publish the item
+        if self._consumer_waiting:
+            self._items_available.set()
+
+    def put_nowait(self, item):
+        self.put(item, block = False)
+
+    def _wait_for_space(self, ring, block, timeout):
+        if not block:
+            raise queue.Full
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while ring.head - ring.tail >= ring.capacity:
+                ring.producer_waiting = True
+                if ring.head - ring.tail < ring.capacity: #read after announcing the wait
+                    break
+                remaining = WAIT_DELAY
+                if not deadline is None:
+                    remaining = min(remaining, deadline - time.monotonic())
+                    if remaining <= 0:
+                        raise queue.Full
+                ring.space_available.wait(remaining)
+                ring.space_available.clear()
+        finally:
+            ring.producer_waiting = False
+
+    #--------------------------------------------------------------------------
+    # consumer side
+    def get_many(self, max_items = None, timeout = None):
+        """get the items from all the rings, up to 'max_items', waiting up to
+           'timeout' seconds (None is forever) for any, an empty list on timeout
+        """
+        items = self._drain(max_items)
+        if items:
+            return items
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._consumer_waiting = True
+            try:
+                items = self._drain(max_items) #read after announcing the wait
+                if items:
+                    return items
+                remaining = WAIT_DELAY
+                if not deadline is None:
+                    remaining = min(remaining, deadline - time.monotonic())
+                    if remaining <= 0:
+                        return items
+                self._items_available.wait(remaining)
+                self._items_available.clear()
+            finally:
+                self._consumer_waiting = False
+            self._prune_rings()
+
+    def get(self, block = True, timeout = None):
+        items = self.get_many(1, timeout = timeout) if block else self._drain(1)
+        if not items:
+            raise queue.Empty
+        return items[0]
+
+    def get_nowait(self):
+        return self.get(block = False)
+
+    def _drain(self, max_items):
+        "read the available items round-robin over the rings, oldest first in each ring"
+        items = []
+        rings = self._rings
+        num_rings = len(rings)
+        start = self._next_ring % num_rings if num_rings else 0
+        for i in range(num_rings):
+            ring = rings[(start + i) % num_rings]
+            tail  = ring.tail
+            count = ring.head - tail
+            if not count:
+                continue
+            if not max_items is None:
+                count = min(count, max_items - len(items))
+            slots    = ring.slots
+            capacity = ring.capacity
+            for index in range(tail, tail + count):
+                slot = index % capacity
+                items.append(slots[slot])
+                slots[slot] = None #don't keep the item alive
+            ring.tail = tail + count #free the slots
+            if ring.producer_waiting:
+                ring.space_available.set()
+            if not max_items is None and len(items) >= max_items:
+                self._next_ring = start + i + 1 #resume after this ring
+                break
+        return items
+
+    def _prune_rings(self):
+        "drop the empty rings of the threads which have ended"
+        rings = self._rings
+        if all(ring.thread.is_alive() or ring.head != ring.tail for ring in rings):
+            return
+        with self._rings_lock:
+            self._rings = tuple(ring for ring in self._rings if ring.thread.is_alive() or ring.head != ring.tail)
+
+    #--------------------------------------------------------------------------
+    def qsize(self):
+        return sum(ring.head - ring.tail for ring in self._rings)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def get_producer_count(self):
+        return len(self._rings)
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    #micro-benchmark against queue.Queue, many producers and one consumer
+    NUM_EVENTS = 200000 #in total, split between the producers
+    def run(event_queue, num_producers):
+        per_producer = NUM_EVENTS//num_producers
+        def produce():
+            put = event_queue.put
+            for i in range(per_producer):
+                put(('SAMPLE', i))
+        producers = [threading.Thread(target = produce) for i in range(num_producers)]
+        t0 = time.perf_counter()
+        for producer in producers:
+            producer.start()
+        received = 0
+        total = per_producer*num_producers
+        if isinstance(event_queue, EventChannel):
+            while received < total:
+                received += len(event_queue.get_many(1000, timeout = 1.0))
+        else:
+            get, get_nowait = event_queue.get, event_queue.get_nowait
+            while received < total:
+                get(timeout = 1.0)
+                received += 1
+                try:
+                    while True:
+                        get_nowait()
+                        received += 1
+                except queue.Empty:
+                    pass
+        for producer in producers:
+            producer.join()
+        return 1e6*(time.perf_counter() - t0)/total
+    print("%10s %16s %16s" % ('producers', 'Queue (us/ev)', 'Channel (us/ev)'))
+    for num_producers in (1, 4, 16):
+        print("%10d %16.3f %16.3f" % (num_producers, run(queue.Queue(), num_producers), run(EventChannel(), num_producers)))
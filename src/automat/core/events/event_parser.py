@@ -1,17 +1,66 @@
+###############################################################################
+from automat.core.events.event_batch import EventBatch, unpack_events
+
+HANDLER_PREFIX = "handle_"
+
+def handles(*event_types):
+    """decorator to register a parser method as the handler for the event
+       types, in addition to the 'handle_<event_type>' naming convention
+    """
+    def decorator(func):
+        func._handled_event_types = event_types
+        return func
+    return decorator
+
+def _build_dispatch_table(cls):
+    "map event types to handler method names, subclasses override their bases"
+    table = {}
+    for klass in reversed(cls.__mro__):
+        for name, attr in vars(klass).items():
+            if name.startswith(HANDLER_PREFIX) and callable(attr):
+                table[name[len(HANDLER_PREFIX):]] = name
+            for event_type in getattr(attr, '_handled_event_types', ()):
+                table[event_type] = name
+    return table
+
+###############################################################################
 class EventParser(object):
+    """Dispatches (event_type, content) events to handler methods, the handlers
+       are resolved once per class and bound once per instance
+    """
+    _dispatch_table = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._dispatch_table = _build_dispatch_table(cls)
+
     def __init__(self, event_stream = None):
+        if not event_stream is None:
+            #accept any iterable, e.g. a slice of an IndexedPickleFile, or
+            #the items of an event queue which may be EventBatches
+            event_stream = unpack_events(event_stream)
         self.event_stream = event_stream
-    
+
+    def __getattr__(self, name):
+        #bind the handlers on first use, even if a subclass skips __init__
+        if name == '_handlers':
+            handlers = dict((event_type, getattr(self, method_name)) for event_type, method_name in self._dispatch_table.items())
+            self._handlers = handlers
+            return handlers
+        raise AttributeError("%r object has no attribute %r" % (self.__class__.__name__, name))
+
     def __iter__(self):
         if self.event_stream is None:
             raise IOError("EventParser must be initialized with a stream to run in iterator mode")
         return self
-    
+
     def parse_all(self):
-        return [val for val in self]
-    
+        if self.event_stream is None:
+            raise IOError("EventParser must be initialized with a stream to run in iterator mode")
+        return self.feed_many(self.event_stream)
+
     def __next__(self):
-        event_stream = self.event_stream 
+        event_stream = self.event_stream
         feed = self.feed
         while True:
             event = next(event_stream)
@@ -19,19 +68,42 @@ class EventParser(object):
             if not obj is None:
                 #return any objects created during parsing
                 return obj
-                         
+
     def feed(self,event):
+        if isinstance(event, EventBatch): #returns the list of objects created
+            return self.feed_many(event)
         event_type, content = event
-        #content['timestamp'] = content['time']
-        handler_name = "handle_%s" % event_type       #construct the event handler name
-        handler = None        
-        try:                    #retrieve and call the handler
-            handler = self.__getattribute__(handler_name)
-        except AttributeError:  #handler not found for event
+        handler = self._handlers.get(event_type)
+        if handler is None: #handler not found for event
             return None
-        obj = handler(content)
         #return any objects created during parsing
-        return obj
+        return handler(content)
+
+    def feed_many(self, events):
+        """feed an iterable of events (or EventBatches), returns the list of
+           objects created during parsing, each event goes through 'feed' if
+           a subclass overrides it, otherwise straight to its handler
+        """
+        results = []
+        if type(self).feed is not EventParser.feed:
+            feed = self.feed
+            for event in unpack_events(events):
+                obj = feed(event)
+                if not obj is None:
+                    results.append(obj)
+            return results
+        handlers = self._handlers
+        for event in events:
+            if isinstance(event, EventBatch):
+                results.extend(self.feed_many(event))
+                continue
+            event_type, content = event
+            handler = handlers.get(event_type)
+            if not handler is None:
+                obj = handler(content)
+                if not obj is None:
+                    results.append(obj)
+        return results
 
 ###############################################################################
 # TEST CODE
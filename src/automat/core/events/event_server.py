@@ -1,10 +1,13 @@
-import socket, sys, time, datetime, pickle, queue, _thread
+import socket, sys, time, datetime, queue, _thread
 from automat.core.threads.interruptible_thread import InterruptibleThread
+from automat.core.network.framing import FrameWriter, FrameReader
+from automat.core.network.serializers import DEFAULT_SERIALIZER, SerializerError, parse_hello, reply_serializer, get_event_serializer_names
 
 ###############################################################################
 DEFAULT_EVENT_FILE = "events.pkl" #for reporting events from event queue
 DEFAULT_LOG_FILE   = "server.log" #for reporting server related events
 SOCKET_TIMEOUT     = 1.0          #timeout for accepting connections
+CURSOR_MAX_EVENTS  = 1000         #maximum number of events sent per cursor wakeup
 
 def now():
     return datetime.datetime.now()
@@ -19,10 +22,34 @@ def reserve_port(port = None):
         return sock_obj    
     except socket.error:
         return None
+
+def _encoding_error(serializer, exc):
+    content = {'serializer': serializer.name, 'error_type': exc.__class__.__name__, 'error_msg': str(exc)}
+    return ('EVENT_ENCODING_ERROR', content)
+
+def encode_event(serializer, event):
+    """frame the event with the client's serializer, an event which it can't
+       encode is replaced by an 'EVENT_ENCODING_ERROR' event, also within a
+       'PAST_EVENTS' chunk
+    """
+    try:
+        return serializer.encode(event)
+    except Exception as exc:
+        if isinstance(event, tuple) and len(event) == 2 and event[0] == 'PAST_EVENTS':
+            chunk = []
+            for item in event[1]:
+                try:
+                    serializer.encode(item)
+                    chunk.append(item)
+                except Exception as item_exc:
+                    chunk.append(_encoding_error(serializer, item_exc))
+            return serializer.encode(('PAST_EVENTS', chunk))
+        return serializer.encode(_encoding_error(serializer, exc))
         
         
 ###############################################################################
 from .event_caching import EventCachingProcess
+from .subscription  import EventSubscription, DEFAULT_SUBSCRIBE_TIMEOUT
 
 class EventServer(InterruptibleThread):
     def __init__(self,
@@ -32,11 +59,15 @@ class EventServer(InterruptibleThread):
                  log_func              = None,
                  event_caching_process = None,
                  event_file            = None,
+                 subscribe_timeout     = DEFAULT_SUBSCRIBE_TIMEOUT,
+                 serializers           = None,  #names of the accepted serializers, None accepts all available which can send events
                 ):
         #set up the thread
         InterruptibleThread.__init__(self)
         self.event_queue  = event_queue
         self.event_file   = event_file
+        self.subscribe_timeout = subscribe_timeout
+        self.serializers  = get_event_serializer_names(serializers)
         if log_func is None:
             def log_func(text):
                 print(text)
@@ -85,22 +116,75 @@ class EventServer(InterruptibleThread):
     def handle_client(self,connection,address):
         stop_event    = self.stop_event 
         #get a cursor to shared memory event history
-        event_cache_cursor = self.event_caching_process.get_cursor() 
-        #send all the previous events
-        connection.send(pickle.dumps(('PAST_EVENTS',next(event_cache_cursor))))
+        event_cache_cursor = self.event_caching_process.get_cursor(max_events = CURSOR_MAX_EVENTS) 
+        #let the client restrict which events it is sent
+        try:
+            subscription, serializer = self.receive_subscription(connection)
+        except Exception as exc: #dropped, or a malformed subscription
+            self.log("client at %s disconnected during subscription: %r" % (address, exc))
+            connection.close()
+            return
+        #events are serialized into length-prefixed frames and coalesced into few writes
+        writer = FrameWriter(connection)
+        encode = lambda event: encode_event(serializer, event)
         #keep track of new events arriving, and send them over the socket
         try:
-            for events in event_cache_cursor:    
-                if events:
-                    for event in events:
-                        connection.send(pickle.dumps(event))
-                #pause for a bit to conserve processor resources
-                stop_event.wait(0.1) 
+            #send the previous events incrementally
+            for msg in subscription.replay_history(event_cache_cursor):
+                writer.write_frames(encode(msg))
+            writer.flush()
+            while not stop_event.isSet():
+                #block until the caching thread signals new events, or buffered frames are due
+                timeout = writer.time_until_flush()
+                if timeout is None:
+                    timeout = SOCKET_TIMEOUT
+                events = subscription.select(event_cache_cursor.get_events(timeout = timeout))
+                for event in events:
+                    writer.write_frames(encode(event))
+                if event_cache_cursor.has_events():
+                    writer.flush_if_due()
+                else: #caught up, don't hold back the remainder
+                    writer.flush()
         except socket.error:
             #connection dropped, end this thread
             self.log("client at %s disconnected" % (address,))
-            return
+        except Exception as exc:
+            #a bad client mustn't leave its connection open
+            self.log("client at %s failed: %r" % (address, exc))
+        finally:
+            connection.close()
             
+    def receive_subscription(self, connection):
+        """wait briefly for the client to negotiate a serializer and send an
+           optional subscription, returns (subscription, serializer), clients
+           which don't negotiate get pickled events
+        """
+        serializer   = None
+        subscription = EventSubscription() #default matches all events
+        reader = FrameReader(connection, buffer_size = 4096)
+        connection.settimeout(self.subscribe_timeout)
+        try:
+            data    = reader.read_frame_view()
+            offered = parse_hello(data)
+            if offered is None:
+                serializer = self._get_default_serializer()
+                subscription = EventSubscription.from_message(serializer.loads(data))
+            else:
+                serializer = reply_serializer(connection, offered, self.serializers)
+                subscription = EventSubscription.from_message(serializer.decode(reader))
+        except socket.timeout:
+            if serializer is None:
+                serializer = self._get_default_serializer()
+        finally:
+            connection.settimeout(None)
+        return (subscription, serializer)
+
+    def _get_default_serializer(self):
+        "the serializer for clients which don't negotiate"
+        if not DEFAULT_SERIALIZER.name in self.serializers:
+            raise SerializerError("client must negotiate one of the serializers %r" % (self.serializers,))
+        return DEFAULT_SERIALIZER
+
     def log(self,msg):
         msg = "%s: %s" % (now(),msg)
         self.log_func(msg)
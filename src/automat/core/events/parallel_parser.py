@@ -0,0 +1,163 @@
+""" parallel offline reprocessing of event logs with EventParser subclasses
+
+    The log (an uncompressed '.pkl' file of pickled events) is split into
+    independent segments, either before each event of the given boundary
+    types or by a user provided partition function. Each segment is parsed
+    by a fresh parser instance in a process pool and the outputs are merged
+    in the original order.
+"""
+###############################################################################
+import os, time, argparse
+import concurrent.futures
+from multiprocessing.util import Finalize
+from automat.core.filetools.pickle_file import IndexedPickleFile
+from automat.core.filetools.modules import chain_import
+
+DEFAULT_SCAN_SEGMENTS = 64 #pieces the log is split into when scanning for boundaries
+
+###############################################################################
+# Worker functions - must be module level to run in the process pool
+_open_files = {} #filename -> ((size, mtime), IndexedPickleFile), only cached in the worker processes
+
+def _close_files():
+    for key, pickle_file in _open_files.values():
+        pickle_file.close()
+    _open_files.clear()
+
+def _init_worker():
+    #close the files when the pool shuts the worker down
+    Finalize(None, _close_files, exitpriority = 10)
+
+def _get_pickle_file(filename):
+    "get the worker's IndexedPickleFile, reopened if the file has changed"
+    stat = os.stat(filename)
+    key  = (stat.st_size, stat.st_mtime_ns)
+    cached_key, pickle_file = _open_files.get(filename, (None, None))
+    if cached_key != key:
+        if not pickle_file is None:
+            pickle_file.close()
+        pickle_file = IndexedPickleFile(filename)
+        _open_files[filename] = (key, pickle_file)
+    return pickle_file
+
+def _get_length(filename):
+    "the number of events, updating the sidecar index"
+    pickle_file = IndexedPickleFile(filename)
+    try:
+        return len(pickle_file)
+    finally:
+        pickle_file.close()
+
+def _find_boundaries(filename, start, stop, boundary_event_types):
+    "get the indices in [start, stop) of events with a boundary type"
+    pickle_file = _get_pickle_file(filename)
+    return [index for index, event in zip(range(start, stop), pickle_file[start:stop]) if event[0] in boundary_event_types]
+
+def _parse_segment(filename, start, stop, parser_class, parser_kwargs):
+    pickle_file = _get_pickle_file(filename)
+    parser = parser_class(pickle_file[start:stop], **parser_kwargs)
+    return parser.parse_all()
+
+###############################################################################
+def split_evenly(length, num_segments):
+    "get (start, stop) ranges splitting range(length) into at most 'num_segments' nearly equal pieces"
+    num_segments = max(1, min(num_segments, length))
+    bounds = [length*i//num_segments for i in range(num_segments + 1)]
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+def partition_by_boundaries(filename, boundary_event_types, executor, num_scan_segments = DEFAULT_SCAN_SEGMENTS, length = None):
+    """get (start, stop) ranges of the log, each new segment starting at an
+       event with one of the 'boundary_event_types', the scan runs in parallel
+    """
+    if length is None:
+        length = _get_length(filename)
+    boundary_event_types = frozenset(boundary_event_types)
+    futures = [executor.submit(_find_boundaries, filename, start, stop, boundary_event_types)
+               for start, stop in split_evenly(length, num_scan_segments)]
+    boundaries = [0]
+    for future in futures:
+        boundaries.extend(index for index in future.result() if index > 0)
+    boundaries.append(length)
+    return [(start, stop) for start, stop in zip(boundaries[:-1], boundaries[1:]) if stop > start]
+
+def reprocess(filename,
+              parser_class,
+              boundary_event_types = None,  #event types which start a new independent segment
+              partition_func       = None,  #called with the IndexedPickleFile, returns (start, stop) ranges
+              num_segments         = None,  #without boundaries or a partition function, split evenly
+              workers              = None,
+              parser_kwargs        = None,  #passed to each parser instance
+              merge_func           = None,  #called with the list of segment outputs, defaults to concatenation
+             ):
+    """parse the log in parallel, returning the merged outputs in order,
+       segments must not depend on parser state from earlier segments
+    """
+    if parser_kwargs is None:
+        parser_kwargs = {}
+    if workers is None:
+        workers = os.cpu_count() or 1
+    #build (or update) the sidecar index once, so the workers can just load it
+    #opened afresh on each call, so that events appended since the last are seen
+    pickle_file = IndexedPickleFile(filename)
+    try:
+        length   = len(pickle_file)
+        segments = None if partition_func is None else partition_func(pickle_file)
+    finally:
+        pickle_file.close()
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers, initializer = _init_worker) as executor:
+        if segments is None and not boundary_event_types is None:
+            segments = partition_by_boundaries(filename, boundary_event_types, executor, length = length)
+        elif segments is None:
+            segments = split_evenly(length, num_segments or 4*workers)
+        futures = [executor.submit(_parse_segment, filename, start, stop, parser_class, parser_kwargs)
+                   for start, stop in segments]
+        outputs = [future.result() for future in futures]
+    if merge_func is None:
+        return [obj for output in outputs for obj in output]
+    return merge_func(outputs)
+
+###############################################################################
+def load_parser_class(path):
+    "load a class from a 'package.module:ClassName' or 'package.module.ClassName' path"
+    if ':' in path:
+        module_path, class_name = path.split(':', 1)
+    else:
+        module_path, _, class_name = path.rpartition('.')
+    return getattr(chain_import(module_path), class_name)
+
+def reprocess_main(argv = None):
+    "parse the command line, reprocess the log and report the timings, returns the outputs"
+    arg_parser = argparse.ArgumentParser(description = "reprocess an event log in parallel with an EventParser subclass")
+    arg_parser.add_argument('filename', help = "uncompressed '.pkl' event log")
+    arg_parser.add_argument('parser', help = "parser class as 'package.module:ClassName'")
+    arg_parser.add_argument('-b', '--boundary', action = 'append', dest = 'boundary_event_types',
+                            help = "event type starting an independent segment (repeatable)")
+    arg_parser.add_argument('-s', '--segments', type = int, default = None, help = "number of segments without boundaries")
+    arg_parser.add_argument('-w', '--workers', type = int, default = None, help = "number of worker processes")
+    args = arg_parser.parse_args(argv)
+
+    parser_class = load_parser_class(args.parser)
+    t0 = time.time()
+    num_events = _get_length(args.filename)
+    t1 = time.time()
+    outputs = reprocess(args.filename,
+                        parser_class,
+                        boundary_event_types = args.boundary_event_types,
+                        num_segments         = args.segments,
+                        workers              = args.workers,
+                       )
+    t2 = time.time()
+    print("indexed %d events in %0.2f seconds" % (num_events, t1 - t0))
+    print("parsed %d events into %d objects in %0.2f seconds (%0.0f events/second)" % (num_events, len(outputs), t2 - t1, num_events/max(t2 - t1, 1e-9)))
+    return outputs
+
+def main(argv = None):
+    "the 'automat_reprocess_events' console script, returns the exit status"
+    reprocess_main(argv)
+    return 0
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+""" bounded in-memory store for cached events, with optional spilling of
+    evicted events to an on-disk segment file
+"""
+###############################################################################
+import os, threading, pickle, bisect, tempfile
+
+DEFAULT_CAPACITY     = 2**20   #events held in memory
+DEFAULT_SEGMENT_SIZE = 1024    #events evicted and spilled together
+
+###############################################################################
+class EventRingBuffer(object):
+    """A fixed capacity ring buffer of events addressed by absolute index.
+
+       Every appended event gets the next absolute index, which never changes
+       for the life of the buffer (even across 'clear'). Events with index in
+       [memory_start_index, end_index) are held in memory, older events are
+       either spilled to disk or discarded. Events with index in
+       [start_index, end_index) can be replayed.
+
+       Like the list it replaces, 'len()', iteration, indexing (including
+       negative indices) and slicing cover the replayable events, so index 0
+       is the event at 'start_index'; slices are copied into lists. Use 'get'
+       to address events by absolute index.
+
+       A single thread should append, any number of threads may read.
+    """
+    def __init__(self,
+                 capacity     = DEFAULT_CAPACITY,     #maximum number of events held in memory
+                 max_memory   = None,                 #approximate memory budget in bytes, None is unlimited
+                 spill_path   = None,                 #segment file for evicted events, None discards them, True uses a temporary file
+                 segment_size = DEFAULT_SEGMENT_SIZE, #minimum number of events evicted at once
+                ):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1, got %r" % capacity)
+        self.capacity     = capacity
+        self.max_memory   = max_memory
+        self.segment_size = segment_size
+        self._slots = [None]*capacity
+        self._sizes = [0]*capacity if not max_memory is None else None
+        self.memory_used  = 0
+        #absolute indices, see class docstring
+        self.start_index        = 0
+        self.memory_start_index = 0
+        self.end_index          = 0
+        #spilled segments
+        self._spill_file = None
+        if spill_path is True:
+            self._spill_file = tempfile.TemporaryFile(prefix = "automat_events_")
+        elif not spill_path is None:
+            self._spill_file = open(spill_path,'w+b')
+        self._segment_starts = []  #absolute index of first event in each segment
+        self._segments       = []  #(offset, length, count) of each segment
+        self._last_segment   = (None, None) #((start index, segment number), events) of the most recently loaded segment
+        #serializes writers ('append' and 'clear' may be called from different threads)
+        self._lock = threading.Lock()
+
+    def get(self, index):
+        "get the event at the absolute index"
+        if not self.start_index <= index < self.end_index:
+            raise IndexError("event %d is not available, replayable range is [%d, %d)" % (index, self.start_index, self.end_index))
+        event = self._slots[index % self.capacity]
+        #check after reading the slot, the writer advances 'memory_start_index' before overwriting
+        if index >= self.memory_start_index:
+            return event
+        return self._read_spilled(index)
+
+    def __len__(self):
+        return self.end_index - self.start_index
+
+    def __iter__(self):
+        return self.iter_range(self.start_index, self.end_index)
+
+    def __getitem__(self, key):
+        "list style access to the replayable events, relative to 'start_index'"
+        start = self.start_index
+        count = self.end_index - start
+        if isinstance(key, slice):
+            first, stop, step = key.indices(count)
+            if step == 1:
+                return list(self.iter_range(start + first, start + max(first, stop)))
+            return [self.get(start + index) for index in range(first, stop, step)]
+        if key < 0:
+            key += count
+        if not 0 <= key < count:
+            raise IndexError("EventRingBuffer index out of range")
+        return self.get(start + key)
+
+    def iter_range(self, start, stop):
+        "iterate over the available events with absolute index in [start, stop)"
+        stop  = min(stop, self.end_index)
+        index = max(start, self.start_index)
+        #spilled events are read one segment at a time
+        while index < stop and index < self.memory_start_index:
+            events, seg_start = self._load_segment_for(index)
+            if events is None: #cleared while iterating
+                index = max(index, self.start_index)
+                continue
+            for event in events[index - seg_start : stop - seg_start]:
+                yield event
+            index = seg_start + len(events)
+        slots    = self._slots
+        capacity = self.capacity
+        while index < stop:
+            event = slots[index % capacity]
+            if index < self.memory_start_index: #evicted while iterating
+                for event in self.iter_range(index, stop):
+                    yield event
+                return
+            yield event
+            index += 1
+
+    def append(self, event):
+        with self._lock:
+            index = self.end_index
+            size = 0
+            if not self.max_memory is None:
+                size = len(pickle.dumps(event, pickle.HIGHEST_PROTOCOL))
+                if self.memory_used + size > self.max_memory:
+                    self._evict(size)
+            if index - self.memory_start_index >= self.capacity:
+                self._evict(0)
+            slot = index % self.capacity
+            self._slots[slot] = event
+            if not self._sizes is None:
+                self._sizes[slot] = size
+                self.memory_used += size
+            self.end_index = index + 1
+
+    def extend(self, events):
+        for event in events:
+            self.append(event)
+
+    def clear(self):
+        "discard all events, absolute indices continue from where they left off"
+        with self._lock:
+            end_index = self.end_index
+            self.start_index = self.memory_start_index = end_index
+            self._slots = [None]*self.capacity
+            if not self._sizes is None:
+                self._sizes = [0]*self.capacity
+            self.memory_used = 0
+            self._segment_starts = []
+            self._segments       = []
+            self._last_segment   = (None, None)
+            if not self._spill_file is None:
+                self._spill_file.truncate(0)
+
+    def close(self):
+        if not self._spill_file is None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    #--------------------------------------------------------------------------
+    # Internal methods
+    def _evict(self, needed_bytes):
+        "evict at least one segment of the oldest events, and enough to free 'needed_bytes'"
+        memory_start = self.memory_start_index
+        end          = self.end_index
+        capacity     = self.capacity
+        #never evict more than half of the buffer just to fill out a segment
+        count = min(self.segment_size, max(1, capacity // 2), end - memory_start)
+        if needed_bytes and not self._sizes is None:
+            sizes = self._sizes
+            budget = self.max_memory - needed_bytes
+            freed = sum(sizes[i % capacity] for i in range(memory_start, memory_start + count))
+            while self.memory_used - freed > budget and memory_start + count < end:
+                freed += sizes[(memory_start + count) % capacity]
+                count += 1
+        if count <= 0:
+            return
+        stop = memory_start + count
+        if not self._spill_file is None:
+            events = [self._slots[i % capacity] for i in range(memory_start, stop)]
+            self._spill(memory_start, events)
+        #advance before the slots are reused, readers check this after reading a slot
+        self.memory_start_index = stop
+        if self._spill_file is None:
+            self.start_index = max(self.start_index, stop)
+        for i in range(memory_start, stop):
+            slot = i % capacity
+            self._slots[slot] = None
+            if not self._sizes is None:
+                self.memory_used -= self._sizes[slot]
+                self._sizes[slot] = 0
+
+    def _spill(self, start, events):
+        data = pickle.dumps(events, pickle.HIGHEST_PROTOCOL)
+        spill_file = self._spill_file
+        spill_file.seek(0, os.SEEK_END)
+        offset = spill_file.tell()
+        spill_file.write(data)
+        spill_file.flush()
+        #publish the segment only after it is on disk
+        self._segments.append((offset, len(data), len(events)))
+        self._segment_starts.append(start)
+
+    def _load_segment_for(self, index):
+        "returns (events, start index) of the spilled segment holding 'index'"
+        segment_starts = self._segment_starts
+        segments       = self._segments
+        seg_num = bisect.bisect_right(segment_starts, index) - 1
+        if seg_num < 0 or seg_num >= len(segments):
+            return (None, None)
+        seg_start = segment_starts[seg_num]
+        last_num, events = self._last_segment
+        if last_num != (seg_start, seg_num):
+            offset, length, count = segments[seg_num]
+            data = os.pread(self._spill_file.fileno(), length, offset)
+            events = pickle.loads(data)
+            self._last_segment = ((seg_start, seg_num), events)
+        return (events, seg_start)
+
+    def _read_spilled(self, index):
+        events, seg_start = self._load_segment_for(index)
+        if events is None:
+            raise IndexError("event %d is no longer available" % index)
+        return events[index - seg_start]
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    RB = EventRingBuffer(capacity = 10, segment_size = 4, spill_path = True)
+    RB.extend(('EVENT', i) for i in range(25))
+    print(list(RB.iter_range(0, RB.end_index)))
+    print(len(RB), RB[0], RB[-1], RB[-3:], RB.get(RB.end_index - 1))
@@ -0,0 +1,174 @@
+""" server side filtering of the events sent to EventServer clients
+
+    A client may send a single ('SUBSCRIBE', {...}) frame right after it
+    connects, any client which doesn't within the server's 'subscribe_timeout'
+    receives all events.
+
+    The server then replays the cached history as a series of 
+    ('PAST_EVENTS', [...]) chunks, followed by ('PAST_EVENTS_END', 
+    {'next_seq': n}), and then streams the live events.  A 'sequenced' 
+    subscription gets every event (in the chunks and live) as a 
+    (seq, event) pair, where 'seq' is the monotonic sequence number of the 
+    event in the cache, the 'PAST_EVENTS', 'PAST_EVENTS_END' and 
+    'EVENTS_DROPPED' and 'EVENTS_RESET' messages themselves are never paired.
+    After a disconnect such a client can reconnect with 'resume_from' set to
+    one past the last sequence number it received. If that is past the end of
+    the cache (the server was restarted and its numbering began again) the
+    server sends ('EVENTS_RESET', {'resume_from': n, 'next_seq': m}) and
+    replays the whole cached history, starting from 'm'.
+
+    A client may negotiate the serializer (see 'network.serializers') before
+    subscribing, otherwise the subscription and the events are pickled.
+"""
+###############################################################################
+import re, fnmatch
+from automat.core.network.framing import send_buffers
+from automat.core.network.serializers import DEFAULT_SERIALIZER
+
+SUBSCRIBE_EVENT_TYPE      = 'SUBSCRIBE'
+DEFAULT_SUBSCRIBE_TIMEOUT = 0.2 #seconds the server waits for a subscription
+HISTORY_CHUNK_SIZE        = 1000 #cached events per 'PAST_EVENTS' chunk
+
+###############################################################################
+class EventSubscription(object):
+    """Selects events by type and content.
+
+       event_types   - sequence of event type patterns (shell-style wildcards
+                       as in 'fnmatch', e.g. 'DATA_*'), None matches all types
+       content_keys  - sequence of keys which must all be present in the
+                       event content
+       content_match - dictionary of key/value pairs which must all be equal
+                       to those in the event content
+       resume_from   - sequence number (a non-negative int) of the first
+                       event to replay, None replays the whole cached history
+       sequenced     - send events paired with their sequence numbers
+    """
+    def __init__(self,
+                 event_types   = None,
+                 content_keys  = None,
+                 content_match = None,
+                 resume_from   = None,
+                 sequenced     = False,
+                ):
+        if isinstance(event_types, str):
+            event_types = [event_types]
+        self.event_types   = None if event_types is None else list(event_types)
+        self.content_keys  = list(content_keys or [])
+        self.content_match = dict(content_match or {})
+        if not resume_from is None and (not isinstance(resume_from, int) or isinstance(resume_from, bool) or resume_from < 0):
+            raise ValueError("'resume_from' must be a non-negative int, got %r" % (resume_from,))
+        self.resume_from   = resume_from
+        self.sequenced     = bool(sequenced)
+        self._type_regex = None
+        if not self.event_types is None:
+            pattern = "|".join(fnmatch.translate(pat) for pat in self.event_types)
+            self._type_regex = re.compile(pattern)
+        self._type_matches = {} #caches the result of matching each event type
+
+    def matches_all(self):
+        return self._type_regex is None and not self.content_keys and not self.content_match
+
+    def match(self, event):
+        try:
+            event_type, content = event
+        except (TypeError, ValueError): #not in the standard 2-tuple form
+            return self.matches_all()
+        if not self._type_regex is None:
+            type_match = self._type_matches.get(event_type)
+            if type_match is None:
+                type_match = bool(self._type_regex.match(str(event_type)))
+                self._type_matches[event_type] = type_match
+            if not type_match:
+                return False
+        if self.content_keys or self.content_match:
+            try:
+                for key in self.content_keys:
+                    if not key in content:
+                        return False
+                for key, val in self.content_match.items():
+                    if content[key] != val:
+                        return False
+            except (KeyError, TypeError): #missing key or content isn't a mapping
+                return False
+        return True
+
+    def filter(self, events):
+        "get a list of the matching events"
+        if self.matches_all():
+            return list(events)
+        match = self.match
+        return [event for event in events if match(event)]
+
+    def select(self, events):
+        """get a list of the matching events from a view of the event cache,
+           as (seq, event) pairs if the subscription is 'sequenced'
+        """
+        if not self.sequenced:
+            return self.filter(events)
+        pairs = enumerate(events, events.start)
+        if self.matches_all():
+            return list(pairs)
+        match = self.match
+        return [(seq, event) for seq, event in pairs if match(event)]
+
+    def replay_history(self, event_cache_cursor, chunk_size = HISTORY_CHUNK_SIZE):
+        """generate the messages replaying the cached history, starting from
+           'resume_from', in chunks so that no single message is huge
+        """
+        event_cache = event_cache_cursor.event_cache
+        history_end = event_cache.end_index
+        if not self.resume_from is None:
+            if self.resume_from > history_end: #numbered by an earlier server
+                event_cache_cursor.cursor_index = event_cache.start_index
+                yield ('EVENTS_RESET', {'resume_from': self.resume_from, 'next_seq': event_cache.start_index})
+            else:
+                event_cache_cursor.cursor_index = self.resume_from
+                missed = event_cache.start_index - self.resume_from
+                if missed > 0:
+                    yield ('EVENTS_DROPPED', {'count': missed})
+        chunk = []
+        while event_cache_cursor.cursor_index < history_end:
+            max_events = min(chunk_size, history_end - event_cache_cursor.cursor_index)
+            events = event_cache_cursor.get_events(block = False, max_events = max_events)
+            if not events: #cleared while replaying
+                break
+            chunk.extend(self.select(events))
+            if len(chunk) >= chunk_size:
+                yield ('PAST_EVENTS', chunk)
+                chunk = []
+        if chunk or not self.sequenced: #unsequenced clients always get some 'PAST_EVENTS'
+            yield ('PAST_EVENTS', chunk)
+        yield ('PAST_EVENTS_END', {'next_seq': event_cache_cursor.cursor_index})
+
+    #--------------------------------------------------------------------------
+    # Wire format
+    def to_message(self):
+        content = {'event_types'  : self.event_types,
+                   'content_keys' : self.content_keys,
+                   'content_match': self.content_match,
+                   'resume_from'  : self.resume_from,
+                   'sequenced'    : self.sequenced,
+                  }
+        return (SUBSCRIBE_EVENT_TYPE, content)
+
+    @classmethod
+    def from_message(cls, msg):
+        try:
+            event_type, content = msg
+        except (TypeError, ValueError):
+            raise ValueError("malformed subscription message: %r" % (msg,))
+        if event_type != SUBSCRIBE_EVENT_TYPE or not isinstance(content, dict):
+            raise ValueError("malformed subscription message: %r" % (msg,))
+        return cls(event_types   = content.get('event_types'),
+                   content_keys  = content.get('content_keys'),
+                   content_match = content.get('content_match'),
+                   resume_from   = content.get('resume_from'),
+                   sequenced     = content.get('sequenced', False),
+                  )
+
+    def send(self, sock, serializer = DEFAULT_SERIALIZER):
+        "send the subscription over a newly connected socket, with the negotiated serializer"
+        send_buffers(sock, serializer.encode(self.to_message()))
+
+    def __repr__(self):
+        return "<EventSubscription event_types=%r content_keys=%r content_match=%r resume_from=%r sequenced=%r>" % (self.event_types, self.content_keys, self.content_match, self.resume_from, self.sequenced)
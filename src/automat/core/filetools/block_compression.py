@@ -0,0 +1,217 @@
+""" block-compressed files of pickled python objects with parallel decompression
+
+    The writer compresses the pickled objects in independent blocks, each a
+    complete compressed member (bz2 stream, gzip member, zstd or lz4 frame),
+    so the file remains readable by the standard tools and by 'PickleFile'.
+    The offset and length of each block is saved in a sidecar
+    '<filename>.blocks' file, which lets the reader decompress many blocks
+    at once in a thread or process pool while still yielding the objects in
+    order.
+"""
+###############################################################################
+import os, io, sys, array, bz2, gzip, pickle, collections
+import concurrent.futures
+from automat.core.filetools.pickle_file import PickleFile
+
+#optional faster codecs
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+BLOCKS_EXTENSION   = '.blocks'
+BLOCKS_MAGIC       = b"AUTOMAT_BLOCKS\x01"
+DEFAULT_BLOCK_SIZE = 1024*1024 #uncompressed bytes per block
+
+###############################################################################
+# Codecs - module level functions so they can be sent to worker processes
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor().compress(data)
+
+def _zstd_decompress(data):
+    #frames written by the compressor record their content size
+    return zstandard.ZstdDecompressor().decompress(data)
+
+#extension -> (compress, decompress)
+CODECS = {
+    'bz2': (bz2.compress, bz2.decompress),
+    'gz' : (gzip.compress, gzip.decompress),
+}
+if not zstandard is None:
+    CODECS['zst'] = (_zstd_compress, _zstd_decompress)
+if not lz4 is None:
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+
+def _get_codec(filename):
+    base, ext = os.path.splitext(filename)
+    codec = ext.lstrip('.')
+    if not codec in CODECS:
+        raise IOError("no block compression codec for extension '%s', available: %r" % (codec, list(CODECS.keys())))
+    return codec
+
+def _read_and_decompress(filename, codec, offset, length):
+    "read and decompress one block, runs in the worker processes"
+    with open(filename, 'rb') as stream:
+        stream.seek(offset)
+        data = stream.read(length)
+    return CODECS[codec][1](data)
+
+###############################################################################
+class BlockCompressedPickleWriter(object):
+    """Writes pickled objects to a block-compressed file, the codec is chosen
+       by the file extension (one of the keys of CODECS)
+    """
+    def __init__(self, filename, block_size = DEFAULT_BLOCK_SIZE, protocol = pickle.HIGHEST_PROTOCOL):
+        self.filename   = filename
+        self.codec      = _get_codec(filename)
+        self.block_size = block_size
+        self.protocol   = protocol
+        self._compress  = CODECS[self.codec][0]
+        self._stream    = open(filename, 'wb')
+        self._buffer    = bytearray()
+        self._blocks    = array.array('Q') #flattened (offset, length) pairs
+
+    def dump(self, obj):
+        self._buffer += pickle.dumps(obj, self.protocol)
+        if len(self._buffer) >= self.block_size:
+            self.flush()
+
+    def dump_many(self, objs):
+        for obj in objs:
+            self.dump(obj)
+
+    def flush(self):
+        "compress the buffered objects into a block"
+        if not self._buffer:
+            return
+        data = self._compress(bytes(self._buffer))
+        offset = self._stream.tell()
+        self._stream.write(data)
+        self._stream.flush()
+        self._blocks.extend((offset, len(data)))
+        self._buffer = bytearray()
+
+    def close(self):
+        if self._stream is None:
+            return
+        self.flush()
+        self._stream.close()
+        self._stream = None
+        blocks = array.array('Q', self._blocks)
+        if sys.byteorder == 'little': #saved in network byte order
+            blocks.byteswap()
+        with open(self.filename + BLOCKS_EXTENSION, 'wb') as blocks_file:
+            blocks_file.write(BLOCKS_MAGIC)
+            blocks.tofile(blocks_file)
+
+    #implement Python 'with' statement interface
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+###############################################################################
+class ParallelPickleFile(object):
+    """A file-like iterator over a block-compressed file of pickled objects,
+       which decompresses up to 'prefetch' blocks ahead in a pool of workers.
+
+       Threads are the default, since the codecs release the GIL while
+       decompressing, use 'use_processes' for codecs which don't. Files
+       without a '.blocks' sidecar are read sequentially by 'PickleFile'.
+    """
+    def __init__(self, filename, workers = None, prefetch = None, use_processes = False):
+        self.filename = filename
+        self.codec    = _get_codec(filename)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers       = workers
+        self.prefetch      = prefetch or 2*workers
+        self.use_processes = use_processes
+        self.blocks        = self._load_blocks()
+        self._iter = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iter is None:
+            self._iter = self._generate()
+        return next(self._iter)
+
+    def read(self):
+        "get a list of all the objects at once"
+        return [obj for obj in self]
+
+    def _load_blocks(self):
+        blocks_filename = self.filename + BLOCKS_EXTENSION
+        if not os.path.exists(blocks_filename):
+            return None
+        with open(blocks_filename, 'rb') as blocks_file:
+            if blocks_file.read(len(BLOCKS_MAGIC)) != BLOCKS_MAGIC:
+                return None
+            blocks = array.array('Q', blocks_file.read())
+        if sys.byteorder == 'little':
+            blocks.byteswap()
+        return [(blocks[i], blocks[i + 1]) for i in range(0, len(blocks), 2)]
+
+    def _generate(self):
+        if self.blocks is None: #fall back to sequential decompression
+            for obj in PickleFile(self.filename):
+                yield obj
+            return
+        if self.use_processes:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers = self.workers)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.workers)
+        with executor:
+            pending = collections.deque()
+            blocks  = iter(self.blocks)
+            def submit_next():
+                for offset, length in blocks:
+                    pending.append(executor.submit(_read_and_decompress, self.filename, self.codec, offset, length))
+                    return
+            for i in range(self.prefetch):
+                submit_next()
+            while pending:
+                data = pending.popleft().result()
+                submit_next()
+                #each block holds only whole pickles
+                unpickler = pickle.Unpickler(io.BytesIO(data))
+                while True:
+                    try:
+                        yield unpickler.load()
+                    except EOFError:
+                        break
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    import time, tempfile
+    if len(sys.argv) == 1: #round trip many blocks with each codec
+        objs = [('SAMPLE', {'index': i, 'data': list(range(i % 50))}) for i in range(5000)]
+        tmp_dir = tempfile.mkdtemp()
+        for codec in CODECS:
+            filename = os.path.join(tmp_dir, "events.pkl.%s" % codec)
+            with BlockCompressedPickleWriter(filename, block_size = 4096) as writer:
+                writer.dump_many(objs)
+            num_blocks = len(ParallelPickleFile(filename).blocks)
+            parallel   = ParallelPickleFile(filename).read() == objs
+            sequential = PickleFile(filename).read() == objs
+            os.remove(filename + BLOCKS_EXTENSION)
+            without_sidecar = ParallelPickleFile(filename).read() == objs
+            print("%-4s %4d blocks, parallel: %s, PickleFile: %s, without sidecar: %s" % (codec, num_blocks, parallel, sequential, without_sidecar))
+    elif len(sys.argv) > 2: #convert a file
+        t0 = time.time()
+        with BlockCompressedPickleWriter(sys.argv[2]) as writer:
+            writer.dump_many(PickleFile(sys.argv[1]))
+        print("wrote '%s' in %0.2f seconds" % (sys.argv[2], time.time() - t0))
+    else:
+        t0 = time.time()
+        count = sum(1 for obj in ParallelPickleFile(sys.argv[1]))
+        print("read %d objects in %0.2f seconds" % (count, time.time() - t0))
@@ -0,0 +1,311 @@
+""" append-only, chunked log of (event_type, content) events
+
+    File layout:
+        MAGIC
+        chunk*      - CHUNK_HEADER followed by the (optionally compressed) payload
+        footer      - pickled list of chunk index entries
+        TRAILER     - offset of the footer and TRAILER_MAGIC
+
+    Each chunk payload is a pickled (event_types, timestamps, contents_data)
+    tuple of columns, where 'contents_data' is the separately pickled list of
+    event contents, so that chunks can be filtered by event type and
+    timestamp without unpickling the contents. The footer indexes every chunk
+    by offset, event type counts and timestamp range, a reader uses it to
+    seek straight to the chunks it needs. A log which was not closed (no
+    footer) is indexed by scanning the chunk headers. Timestamps are stored
+    as float seconds, datetimes are converted.
+"""
+###############################################################################
+import os, struct, time, pickle, zlib, bz2, lzma
+from automat.core.filetools.pickle_file import as_timestamp
+
+MAGIC          = b"AUTOMAT_EVENT_LOG\x01\n"
+CHUNK_HEADER   = struct.Struct('!4sBIQ') #tag, codec id, number of events, payload length
+CHUNK_TAG      = b"CHNK"
+TRAILER        = struct.Struct('!Q8s')   #footer offset, magic
+TRAILER_MAGIC  = b"EVLOGEND"
+
+DEFAULT_TIMESTAMP_KEY  = 'timestamp'
+DEFAULT_FLUSH_EVENTS   = 1000  #events per chunk
+DEFAULT_FLUSH_INTERVAL = 1.0   #seconds an event may wait before its chunk is written
+
+#codec name -> (id, compress, decompress)
+CODECS = {
+    None  : (0, None, None),
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'bz2' : (2, bz2.compress,  bz2.decompress),
+    'lzma': (3, lzma.compress, lzma.decompress),
+}
+CODEC_IDS = dict((codec_id, name) for name, (codec_id, _, _) in CODECS.items())
+
+###############################################################################
+class EventLogError(IOError):
+    pass
+
+###############################################################################
+def _read_index(stream):
+    """get the chunk index from the footer, or by scanning the chunks if the
+       log was not closed, returns (index, end of last chunk)
+    """
+    stream.seek(0, os.SEEK_END)
+    file_size = stream.tell()
+    stream.seek(0)
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise EventLogError("not an event log file: %r" % getattr(stream, 'name', stream))
+    #try the footer first
+    if file_size >= len(MAGIC) + TRAILER.size:
+        stream.seek(file_size - TRAILER.size)
+        footer_offset, magic = TRAILER.unpack(stream.read(TRAILER.size))
+        if magic == TRAILER_MAGIC:
+            stream.seek(footer_offset)
+            index = pickle.loads(stream.read(file_size - TRAILER.size - footer_offset))
+            return (index, footer_offset)
+    #fall back to scanning, reading only the payloads for their columns
+    index  = []
+    offset = len(MAGIC)
+    while offset + CHUNK_HEADER.size <= file_size:
+        stream.seek(offset)
+        tag, codec_id, count, length = CHUNK_HEADER.unpack(stream.read(CHUNK_HEADER.size))
+        if tag != CHUNK_TAG or offset + CHUNK_HEADER.size + length > file_size:
+            break #truncated by a crash
+        payload = stream.read(length)
+        event_types, timestamps, _ = _decode_columns(codec_id, payload)
+        index.append(_make_index_entry(offset, codec_id, length, event_types, timestamps))
+        offset += CHUNK_HEADER.size + length
+    return (index, offset)
+
+def _decode_columns(codec_id, payload):
+    decompress = CODECS[CODEC_IDS[codec_id]][2]
+    if not decompress is None:
+        payload = decompress(payload)
+    return pickle.loads(payload)
+
+def _make_index_entry(offset, codec_id, length, event_types, timestamps):
+    type_counts = {}
+    for event_type in event_types:
+        type_counts[event_type] = type_counts.get(event_type, 0) + 1
+    known_timestamps = [t for t in map(as_timestamp, timestamps) if not t is None]
+    entry = {'offset'     : offset,
+             'codec'      : codec_id,
+             'length'     : length,
+             'count'      : len(event_types),
+             'event_types': type_counts,
+             't_min'      : min(known_timestamps) if known_timestamps else None,
+             't_max'      : max(known_timestamps) if known_timestamps else None,
+            }
+    return entry
+
+def _picklable_content(content):
+    "the content, or a description of it if it can't be pickled"
+    try:
+        pickle.dumps(content, pickle.HIGHEST_PROTOCOL)
+        return content
+    except Exception as exc:
+        return {'unpicklable_content': repr(content), 'error_msg': str(exc)}
+
+###############################################################################
+class EventLogWriter(object):
+    """Buffers events and appends them to the log one chunk at a time.
+
+       A chunk is written once 'flush_events' events are buffered, or when an
+       event has waited 'flush_interval' seconds (checked on each append and
+       by 'flush_if_due'). Opening an existing log appends to it.
+    """
+    def __init__(self,
+                 filename,
+                 compression    = None,    #one of the keys of CODECS
+                 flush_events   = DEFAULT_FLUSH_EVENTS,
+                 flush_interval = DEFAULT_FLUSH_INTERVAL,
+                 timestamp_key  = DEFAULT_TIMESTAMP_KEY, #content key holding the event timestamp
+                ):
+        if not compression in CODECS:
+            raise ValueError("unknown compression %r, must be one of %r" % (compression, list(CODECS.keys())))
+        self.filename       = filename
+        self.compression    = compression
+        self.flush_events   = flush_events
+        self.flush_interval = flush_interval
+        self.timestamp_key  = timestamp_key
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            stream = open(filename, 'r+b')
+            self.index, end = _read_index(stream)
+            #the footer is rewritten on close
+            stream.seek(end)
+            stream.truncate()
+        else:
+            stream = open(filename, 'w+b')
+            stream.write(MAGIC)
+            self.index = []
+        self._stream = stream
+        self._event_types = []
+        self._timestamps  = []
+        self._contents    = []
+        self._first_time  = None #time the oldest buffered event was appended
+
+    def append(self, event):
+        event_type, content = event
+        timestamp = None
+        try:
+            timestamp = as_timestamp(content[self.timestamp_key])
+        except (KeyError, TypeError, IndexError):
+            pass
+        if self._first_time is None:
+            self._first_time = time.time()
+        self._event_types.append(event_type)
+        self._timestamps.append(timestamp)
+        self._contents.append(content)
+        if len(self._event_types) >= self.flush_events:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def extend(self, events):
+        for event in events:
+            self.append(event)
+
+    def flush_if_due(self):
+        first_time = self._first_time
+        if not first_time is None and time.time() - first_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """write the buffered events as one chunk, a content which can't be
+           pickled is replaced by its description, if the write fails the
+           chunk is dropped and the error raised
+        """
+        event_types = self._event_types
+        if not event_types:
+            return
+        timestamps  = self._timestamps
+        contents    = self._contents
+        #never retry a chunk which failed, it would fail every later write
+        self._event_types = []
+        self._timestamps  = []
+        self._contents    = []
+        self._first_time  = None
+        stream = self._stream
+        offset = stream.tell()
+        try:
+            try:
+                contents_data = pickle.dumps(contents, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                contents_data = pickle.dumps([_picklable_content(content) for content in contents], pickle.HIGHEST_PROTOCOL)
+            payload = pickle.dumps((event_types, timestamps, contents_data), pickle.HIGHEST_PROTOCOL)
+            codec_id, compress, _ = CODECS[self.compression]
+            if not compress is None:
+                payload = compress(payload)
+            stream.write(CHUNK_HEADER.pack(CHUNK_TAG, codec_id, len(event_types), len(payload)))
+            stream.write(payload)
+            stream.flush()
+        except Exception:
+            #don't leave a partial chunk behind
+            stream.seek(offset)
+            stream.truncate()
+            raise
+        self.index.append(_make_index_entry(offset, codec_id, len(payload), event_types, timestamps))
+
+    def close(self):
+        "flush and write the footer index"
+        if self._stream is None:
+            return
+        self.flush()
+        stream = self._stream
+        footer_offset = stream.tell()
+        stream.write(pickle.dumps(self.index, pickle.HIGHEST_PROTOCOL))
+        stream.write(TRAILER.pack(footer_offset, TRAILER_MAGIC))
+        stream.close()
+        self._stream = None
+
+    #implement Python 'with' statement interface
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+###############################################################################
+class EventLogReader(object):
+    """Reads an event log, using the chunk index to seek directly to the
+       chunks holding the requested event types and time range
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._stream  = open(filename, 'rb')
+        self.index, _ = _read_index(self._stream)
+
+    def __len__(self):
+        return sum(entry['count'] for entry in self.index)
+
+    def __iter__(self):
+        return self.read()
+
+    def get_event_types(self):
+        "get the total count of each event type in the log"
+        counts = {}
+        for entry in self.index:
+            for event_type, count in entry['event_types'].items():
+                counts[event_type] = counts.get(event_type, 0) + count
+        return counts
+
+    def select_chunks(self, event_types = None, t_start = None, t_stop = None):
+        "get the index entries of the chunks which may hold matching events"
+        t_start = as_timestamp(t_start) if not t_start is None else None
+        t_stop  = as_timestamp(t_stop)  if not t_stop is None else None
+        entries = []
+        for entry in self.index:
+            if not event_types is None and not any(event_type in entry['event_types'] for event_type in event_types):
+                continue
+            if not t_start is None and not entry['t_max'] is None and entry['t_max'] < t_start:
+                continue
+            if not t_stop is None and not entry['t_min'] is None and entry['t_min'] >= t_stop:
+                continue
+            entries.append(entry)
+        return entries
+
+    def read(self, event_types = None, t_start = None, t_stop = None):
+        """generate the events, in order, which have one of the 'event_types'
+           and a timestamp in [t_start, t_stop), None means no restriction
+        """
+        if not event_types is None:
+            event_types = frozenset(event_types)
+        t_start = as_timestamp(t_start) if not t_start is None else None
+        t_stop  = as_timestamp(t_stop)  if not t_stop is None else None
+        time_filtered = not (t_start is None and t_stop is None)
+        for entry in self.select_chunks(event_types, t_start, t_stop):
+            types, timestamps, contents_data = self._read_columns(entry)
+            selected = []
+            for i, (event_type, timestamp) in enumerate(zip(types, map(as_timestamp, timestamps))):
+                if not event_types is None and not event_type in event_types:
+                    continue
+                if time_filtered:
+                    if timestamp is None:
+                        continue
+                    if not t_start is None and timestamp < t_start:
+                        continue
+                    if not t_stop is None and timestamp >= t_stop:
+                        continue
+                selected.append(i)
+            if not selected:
+                continue
+            #only unpickle the contents of chunks with matching events
+            contents = pickle.loads(contents_data)
+            for i in selected:
+                yield (types[i], contents[i])
+
+    def close(self):
+        self._stream.close()
+
+    def _read_columns(self, entry):
+        stream = self._stream
+        stream.seek(entry['offset'] + CHUNK_HEADER.size)
+        payload = stream.read(entry['length'])
+        return _decode_columns(entry['codec'], payload)
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    import sys
+    reader = EventLogReader(sys.argv[1])
+    print("%d events in %d chunks" % (len(reader), len(reader.index)))
+    for event_type, count in sorted(reader.get_event_types().items()):
+        print("\t%s: %d" % (event_type, count))
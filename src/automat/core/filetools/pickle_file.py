@@ -1,4 +1,4 @@
-import os 
+import os, sys, mmap, array, bisect, struct, zlib
 import bz2, gzip, zipfile
 #use the faster library if available
 try: 
@@ -13,6 +13,21 @@ FILE_TYPES = {
     'zip': zipfile.ZipFile,
     'pkl': open,
 }
+#optional faster codecs
+try:
+    import zstandard
+    def _open_zstd(filename, mode):
+        if 'r' in mode: #block-compressed files hold many frames
+            return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames = True, closefd = True)
+        return zstandard.open(filename, mode)
+    FILE_TYPES['zst'] = _open_zstd
+except ImportError:
+    pass
+try:
+    import lz4.frame
+    FILE_TYPES['lz4'] = lz4.frame.open
+except ImportError:
+    pass
 
 ###############################################################################
 class PickleFile(object):
@@ -24,6 +39,8 @@ class PickleFile(object):
         #guess the file type from the extension
         base, ext = os.path.splitext(filename)
         file_type = ext.lstrip('.')
+        if file_type != 'zip' and not 'b' in mode:
+            mode += 'b' #pickles are binary data
         try:    
             stream = FILE_TYPES[file_type](filename,mode)
         except KeyError:
@@ -42,11 +59,203 @@ class PickleFile(object):
         "get a list of all the objects at once"
         return [obj for obj in self]
 
+###############################################################################
+INDEX_EXTENSION = '.idx'
+INDEX_MAGIC     = b"AUTOMAT_PKL_INDEX\x02"
+INDEX_HEADER    = struct.Struct('!18sQQQII') #magic, indexed file size, file mtime (ns), number of objects, CRC32 of the first and last objects
+
+def as_timestamp(timestamp):
+    "get the timestamp (seconds or a datetime) as float seconds, or None"
+    if hasattr(timestamp, 'timestamp'): #datetime.datetime objects
+        timestamp = timestamp.timestamp()
+    try:
+        return float(timestamp)
+    except (TypeError, ValueError):
+        return None
+
+def get_event_timestamp(obj, timestamp_key = 'timestamp'):
+    "default timestamp extractor for (event_type, content) events, returns float or None"
+    try:
+        timestamp = obj[1][timestamp_key]
+    except (KeyError, TypeError, IndexError):
+        return None
+    return as_timestamp(timestamp)
+
+class IndexedPickleFile(object):
+    """Random access to an uncompressed file of pickled python objects.
+
+       The offset of every object is found by a one-time scan, which is saved
+       in a sidecar index file ('<filename>.idx') and only extended when the
+       file grows; the index is checked against the first and last objects it
+       covers, so a file overwritten by another run is rescanned. The file is
+       then memory-mapped, giving O(1) 'len()' and indexing, lazy slicing and
+       binary search by timestamp. Timestamps are carried forward over objects
+       without one, so the search assumes they are non-decreasing.
+    """
+    def __init__(self, filename, timestamp_func = get_event_timestamp, use_sidecar = True):
+        base, ext = os.path.splitext(filename)
+        if ext != '.pkl':
+            raise IOError("indexed access requires an uncompressed '.pkl' file, got '%s'" % filename)
+        self.filename       = filename
+        self.timestamp_func = timestamp_func
+        self.use_sidecar    = use_sidecar
+        self.index_filename = filename + INDEX_EXTENSION
+        self._file  = None
+        self._mmap  = None
+        self._view  = None
+        self.refresh()
+
+    def refresh(self):
+        "update the index and mapping to include any objects appended to the file"
+        self._unmap()
+        offsets, timestamps = self._load_index()
+        self._offsets    = offsets     #start of each object, plus the end of the last
+        self._timestamps = timestamps
+        self._file = open(self.filename, 'rb')
+        if offsets[-1] > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            return IndexedPickleFileView(self, range(start, stop, step))
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("IndexedPickleFile index out of range")
+        offsets = self._offsets
+        return pickle.loads(self._view[offsets[key]:offsets[key + 1]])
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def get_timestamp(self, index):
+        return self._timestamps[index]
+
+    def bisect_timestamp(self, timestamp):
+        "get the index of the first object with a timestamp at or after 'timestamp'"
+        return bisect.bisect_left(self._timestamps, timestamp)
+
+    def time_slice(self, t_start = None, t_stop = None):
+        "get a view of the objects with timestamps in [t_start, t_stop)"
+        start = 0 if t_start is None else self.bisect_timestamp(t_start)
+        stop  = len(self) if t_stop is None else self.bisect_timestamp(t_stop)
+        return self[start:stop]
+
+    def close(self):
+        self._unmap()
+
+    #--------------------------------------------------------------------------
+    # Internal methods
+    def _unmap(self):
+        if not self._view is None:
+            self._view.release()
+            self._view = None
+        if not self._mmap is None:
+            self._mmap.close()
+            self._mmap = None
+        if not self._file is None:
+            self._file.close()
+            self._file = None
+
+    def _load_index(self):
+        stat = os.stat(self.filename)
+        offsets    = array.array('Q', [0])
+        timestamps = array.array('d')
+        #reuse a saved index, it remains valid for a prefix of a growing file
+        if self.use_sidecar and os.path.exists(self.index_filename):
+            with open(self.index_filename, 'rb') as index_file:
+                header = index_file.read(INDEX_HEADER.size)
+                if len(header) == INDEX_HEADER.size:
+                    magic, size, mtime_ns, count, head_crc, tail_crc = INDEX_HEADER.unpack(header)
+                    if magic == INDEX_MAGIC and (size < stat.st_size or (size == stat.st_size and mtime_ns == stat.st_mtime_ns)):
+                        try:
+                            offsets = array.array('Q')
+                            offsets.fromfile(index_file, count + 1)
+                            timestamps.fromfile(index_file, count)
+                            if sys.byteorder == 'little': #saved in network byte order
+                                offsets.byteswap()
+                                timestamps.byteswap()
+                        except EOFError: #corrupt index
+                            offsets = None
+                        #the file may have been overwritten by a larger one
+                        if offsets is None or self._get_prefix_crcs(offsets) != (head_crc, tail_crc):
+                            offsets    = array.array('Q', [0])
+                            timestamps = array.array('d')
+        if offsets[-1] < stat.st_size:
+            self._scan(offsets, timestamps)
+            if self.use_sidecar:
+                self._save_index(offsets, timestamps, os.stat(self.filename))
+        return (offsets, timestamps)
+
+    def _get_prefix_crcs(self, offsets):
+        "get the CRC32s of the first and last indexed objects"
+        with open(self.filename, 'rb') as stream:
+            stream.seek(offsets[0])
+            head = stream.read(offsets[1] - offsets[0]) if len(offsets) > 1 else b""
+            stream.seek(offsets[-2] if len(offsets) > 1 else 0)
+            tail = stream.read(offsets[-1] - offsets[-2]) if len(offsets) > 1 else b""
+        return (zlib.crc32(head), zlib.crc32(tail))
+
+    def _scan(self, offsets, timestamps):
+        "extend the index by unpickling each object after the last indexed one"
+        timestamp_func = self.timestamp_func
+        last_timestamp = timestamps[-1] if timestamps else float('-inf')
+        with open(self.filename, 'rb') as stream:
+            stream.seek(offsets[-1])
+            unpickler = pickle.Unpickler(stream)
+            while True:
+                try:
+                    obj = unpickler.load()
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError): #partially written object at the end
+                    break
+                timestamp = timestamp_func(obj)
+                if not timestamp is None:
+                    last_timestamp = timestamp
+                timestamps.append(last_timestamp)
+                offsets.append(stream.tell())
+
+    def _save_index(self, offsets, timestamps, stat):
+        head_crc, tail_crc = self._get_prefix_crcs(offsets)
+        offsets    = array.array('Q', offsets)
+        timestamps = array.array('d', timestamps)
+        if sys.byteorder == 'little':
+            offsets.byteswap()
+            timestamps.byteswap()
+        try:
+            with open(self.index_filename, 'wb') as index_file:
+                index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(timestamps), head_crc, tail_crc))
+                offsets.tofile(index_file)
+                timestamps.tofile(index_file)
+        except IOError: #read-only location, the index is just not persisted
+            pass
+
+class IndexedPickleFileView(object):
+    "a lazy sequence over a range of the objects in an IndexedPickleFile"
+    def __init__(self, pickle_file, indices):
+        self.pickle_file = pickle_file
+        self.indices     = indices
+    def __len__(self):
+        return len(self.indices)
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return IndexedPickleFileView(self.pickle_file, self.indices[key])
+        return self.pickle_file[self.indices[key]]
+    def __iter__(self):
+        pickle_file = self.pickle_file
+        for index in self.indices:
+            yield pickle_file[index]
+
 ###############################################################################
 # TEST CODE
 ###############################################################################       
 if __name__ == "__main__":
-    import sys
     PF = PickleFile(sys.argv[1])
     for event in PF:
         print(event)
@@ -11,9 +11,16 @@ from   configobj import ConfigObj
 from   automat.core.filetools.directories        import fullpath, recur_mkdir
 import automat.core.hwcontrol.devices.loader     as device_loader
 import automat.core.hwcontrol.controllers.loader as controller_loader
-from   automat.core.threads.mutex import Mutex
+from   automat.core.threads.mutex import make_mutex
 ###############################################################################
 DEFAULT_MUTEX_TIMEOUT = 10 #seconds
+DEFAULT_MUTEX_MODE    = 'exclusive' #or 'rw' for shared (read-only) and exclusive locking
+
+def _as_bool(value):
+    "configuration values may be strings"
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'yes', 'on', '1')
+    return bool(value)
 
 ###############################################################################
 class Configuration(ConfigObj):
@@ -85,8 +92,10 @@ class Configuration(ConfigObj):
         mutex_settings = settings.pop('mutex', None)
         if not mutex_settings is None:
             name    = mutex_settings.get('name',handle) #default to handle if not specified
-            timeout = mutex_settings.get('timeout', DEFAULT_MUTEX_TIMEOUT)
-            mutex   = Mutex(name=name, default_timeout=timeout)
+            timeout = float(mutex_settings.get('timeout', DEFAULT_MUTEX_TIMEOUT))
+            mode    = mutex_settings.get('mode', DEFAULT_MUTEX_MODE)
+            fair    = _as_bool(mutex_settings.get('fair', False)) #FIFO among the threads of the process
+            mutex   = make_mutex(name, mode=mode, fair=fair, default_timeout=timeout)
             self._device_mutexes[handle] = mutex
         #check for alias
         alias = settings.pop('alias', None)
@@ -1,14 +1,24 @@
 ###############################################################################
-import queue, threading
+import os, queue, time
 from automat.core.threads.interruptible_thread import InterruptibleThread, AbortInterrupt
+from automat.core.threads.interruptible_process import InterruptibleProcess
+from automat.core.threads.selectable import SelectableEvent
+from automat.core.events.event_batch import EventBatch
+from automat.core.hwcontrol.controllers.initialization import initialize_concurrently, DEFAULT_INIT_WORKERS
+from automat.core.hwcontrol.controllers.shutdown import shutdown_concurrently, DEFAULT_SHUTDOWN_TIMEOUT, DEFAULT_SHUTDOWN_WORKERS
 #Standard or substitute
 OrderedDict = None
 try:
     from collections import OrderedDict
 except ImportError:
     from automat.substitutes.ordered_dict import OrderedDict
+###############################################################################
+DEFAULT_EVENT_BATCH_SIZE     = 256  #events buffered by '_buffer_event' before they are sent
+DEFAULT_EVENT_BATCH_INTERVAL = 0.05 #seconds, the longest an event stays buffered while events keep coming
+
 ###############################################################################
 class BaseController(object):
+    shared_controllers = () #handles of subcontrollers owned elsewhere, left out of the shutdown
     def __init__(self, 
                  devices             = None, #should be a dictionary containing only dependent device interfaces 
                  controllers         = None, #should be a ductionary containing only dependent controller interfaces
@@ -40,9 +50,17 @@ class BaseController(object):
         self._controller_mode_set = set(['object_initialized'])
         #holds information relevant to the controllers context
         self.context = {}
+        #handles of the devices initialized, and not shut down since
+        self._initialized_devices = set()
+        #the timings of the last 'initialize_devices' and 'shutdown'
+        self.init_report     = None
+        self.shutdown_report = None
+        #a forked child process must not shut down the parent's controllers
+        self._pid = os.getpid()
         
     def initialize(self, **kwargs):
-        self.initialize_devices()
+        if not 'devices_initialized' in self._controller_mode_set: #already, e.g. by an initialization graph
+            self.initialize_devices()
 
     def set_devices(self,**kwargs):
         for key, val in list(kwargs.items()):
@@ -87,28 +105,49 @@ class BaseController(object):
         #holds information relevant to the controllers context
         self.context = context  
         
-    def initialize_devices(self):
-        "initialize all the devices, often can be overloaded in child class"
-        for handle, device in list(self.devices.items()):
-            device.initialize()
+    def initialize_devices(self, max_workers = DEFAULT_INIT_WORKERS):
+        """initialize all the devices, often can be overloaded in child class
+           the devices (and those of the controller dependencies) are initialized
+           concurrently, each once, skipped if they have been initialized already"""
+        if 'devices_initialized' in self._controller_mode_set:
+            return
         #cascade device initializations into the controller dependencies
-        for handle, subcontroller in list(self.controllers.items()):
-            subcontroller.initialize_devices()
+        self.init_report = initialize_concurrently([self], max_workers = max_workers, expand_roots = True)
+
+    def _mark_devices_initialized(self):
         self._controller_mode_set.discard('devices_shutdown')                  
         self._controller_mode_set.add('devices_initialized')
     
     def shutdown_devices(self):
         "shutdown all the devices, often can be overloaded in child class"
+        modes = self._controller_mode_set
         for handle, device in list(self.devices.items()):
+            if 'devices_shutdown' in modes and not handle in self._initialized_devices: #shut down already
+                continue
             device.shutdown()
+            self._initialized_devices.discard(handle) #initialize again in the next 'initialize_devices'
         #cascade device initializations into the controller dependencies
         for handle, subcontroller in list(self.controllers.items()):
             subcontroller.shutdown_devices()    
+        self._mark_devices_shutdown()
+
+    def _mark_devices_shutdown(self):
         self._controller_mode_set.discard('devices_initialized')        
         self._controller_mode_set.add('devices_shutdown')
     
-    def shutdown(self):
-        self.shutdown_devices()
+    def shutdown(self, timeout = DEFAULT_SHUTDOWN_TIMEOUT):
+        """shut down the controller, its subcontrollers and the devices, each
+           once and independent branches concurrently, within the 'timeout' (seconds)"""
+        if 'shutdown_coordinated' in self._controller_mode_set: #the coordinator handles the devices
+            return
+        max_workers = DEFAULT_SHUTDOWN_WORKERS
+        if 'shutdown_inline' in self._controller_mode_set: #from '__del__', start no threads
+            max_workers = 0
+        self.shutdown_report = shutdown_concurrently([self], timeout = timeout, max_workers = max_workers, expand_roots = True)
+
+    def _shutdown_controller(self):
+        "release the controller's own resources, not those of its devices or subcontrollers"
+        pass
 
     def reset(self):
         self.shutdown()       
@@ -123,13 +162,24 @@ class BaseController(object):
         
     def __del__(self):
         try:
+            if self._pid != os.getpid(): #inherited by a forked child
+                return
+            self._controller_mode_set.add('shutdown_inline')
             self.shutdown()
         except AttributeError:  #ignore already collected garbage
             pass
 
 ###############################################################################
 class Controller(BaseController):
-    """A threaded hardware interface that is to send events through to their 'event_queue' using the 'send_event' method"""
+    """A threaded hardware interface that is to send events through to their 'event_queue' using the 'send_event' method
+
+       With 'isolate_process' the 'main' method runs in a (forked) child
+       process instead, so that CPU-heavy processing doesn't hold the GIL of
+       the other controllers: events are forwarded to the 'event_queue', and
+       'stop' and 'abort' reach the child, but other changes to the
+       controller's state made in the child are not seen by the parent.
+    """
+    isolate_process = False #overload in CPU-heavy child classes, or pass to 'thread_init'
     #--------------------------------------------------------------------------
     # Initialization/Shutdown methods - called externally in various program phases 
     def __init__(self, 
@@ -149,6 +199,11 @@ class Controller(BaseController):
         self.event_queue = None
         self.stop_event  = None
         self.abort_event = None
+        #events buffered by '_buffer_event', sent as one EventBatch
+        self._event_buffer          = EventBatch()
+        self._event_buffer_deadline = None
+        self.event_batch_size       = DEFAULT_EVENT_BATCH_SIZE
+        self.event_batch_interval   = DEFAULT_EVENT_BATCH_INTERVAL
         #maintain state of the controller  
         self._controller_mode_set = set(['object_initialized'])
         #holds information relevant to the controllers context
@@ -156,27 +211,39 @@ class Controller(BaseController):
         
     def initialize(self, **kwargs):
         self.thread_init(**kwargs)
-        self.initialize_devices()
+        if not 'devices_initialized' in self._controller_mode_set: #already, e.g. by an initialization graph
+            self.initialize_devices()
 
     def thread_init(self,  
                     event_queue = None,  #to pass back controller events
                     stop_event  = None,  #to synchronize controlled exit
                     abort_event = None,  #to synchronize forced exit
+                    isolate_process = None, #run 'main' in a child process
                    ):
         self._require_controller_modes('object_initialized')
+        if not isolate_process is None:
+            self.isolate_process = isolate_process
         if event_queue is None:
             event_queue = queue.Queue()
         self.event_queue = event_queue
         if stop_event is None:
-            stop_event = threading.Event()
+            stop_event = SelectableEvent()
         self.stop_event  = stop_event        
         if abort_event is None:
-            abort_event = threading.Event()
+            abort_event = SelectableEvent()
         self.abort_event = abort_event        
-        self.thread = InterruptibleThread(target = self.main,        #this ties the thread into the overloadable execution path 
-                                          stop_event  = stop_event, 
-                                          abort_event = abort_event
-                                         )
+        if self.isolate_process:
+            self.thread = InterruptibleProcess(target = self._thread_main, #the process has the interface of the thread
+                                               stop_event  = stop_event,
+                                               abort_event = abort_event,
+                                               event_queue = event_queue,
+                                               child_init  = self._thread_rebind,
+                                              )
+        else:
+            self.thread = InterruptibleThread(target = self._thread_main, #this ties the thread into the overloadable execution path 
+                                              stop_event  = stop_event, 
+                                              abort_event = abort_event
+                                             )
         #set daemonic property so thread does not block application exit
         self.thread.daemon = True
         #cascade thread initializations into the controller dependencies
@@ -186,18 +253,34 @@ class Controller(BaseController):
         self._controller_mode_set.add('thread_initialized')
 
     def thread_shutdown(self):
-        try:    
-            self.thread.shutdown()  #from InterruptibleThread
-        except RuntimeError:  #when thread has not been run yet
-            pass       
+        self._thread_shutdown_own()
         #cascade device initializations into the controller dependencies
         for handle, subcontroller in list(self.controllers.items()):
             subcontroller.thread_shutdown()  
+
+    def _thread_shutdown_own(self):
+        "shut down the thread of this controller, not of its subcontrollers"
+        if not self.thread is None:
+            try:    
+                self.thread.shutdown()  #from InterruptibleThread
+            except RuntimeError:  #when thread has not been run yet
+                pass       
         self._controller_mode_set.discard('running_as_thread')
         self._controller_mode_set.discard('running_as_blocking_call')
         self._controller_mode_set.discard('thread_initialized')
         self._controller_mode_set.add('thread_shutdown')   
 
+    def _thread_rebind(self, event_queue, stop_event, abort_event):
+        "in an isolated child process, use its event queue and events, for the subcontrollers too"
+        self.event_queue = event_queue
+        self.stop_event  = stop_event
+        self.abort_event = abort_event
+        if not self.thread is None:
+            self.thread.stop_event  = stop_event
+            self.thread.abort_event = abort_event
+        for handle, subcontroller in list(self.controllers.items()):
+            subcontroller._thread_rebind(event_queue, stop_event, abort_event)
+
     def thread_reset(self):
         self.thread_shutdown()
         #clear any events
@@ -217,10 +300,20 @@ class Controller(BaseController):
     def abort(self):
         self.abort_event.set()
     
-    def shutdown(self):
-        self.abort()
-        self.thread_shutdown()
-        self.shutdown_devices()
+    def shutdown(self, timeout = DEFAULT_SHUTDOWN_TIMEOUT):
+        """abort and shut down the threads and devices of the controller and
+           its subcontrollers, each once and independent branches concurrently,
+           within the 'timeout' (seconds)"""
+        if 'shutdown_coordinated' in self._controller_mode_set: #the coordinator handles the rest
+            self._shutdown_controller()
+            return
+        BaseController.shutdown(self, timeout = timeout)
+
+    def _shutdown_controller(self):
+        "abort and shut down the thread of this controller, not of its subcontrollers"
+        if not self.abort_event is None:
+            self.abort()
+        self._thread_shutdown_own()
 
     def reset(self):
         self.shutdown()
@@ -228,6 +321,7 @@ class Controller(BaseController):
         self.initialize_devices()
 
     def sleep(self, time):
+        self._flush_events() #don't hold events back while idle
         self.abort_event.wait(time)        
         
     #--------------------------------------------------------------------------
@@ -235,6 +329,13 @@ class Controller(BaseController):
     def main(self):
         "the main functionality, must be overloaded in child class"
         raise NotImplementedError("this abstract method must be overloaded in any child classes")
+
+    def _thread_main(self):
+        "the thread target, sends the events still buffered when 'main' returns"
+        try:
+            self.main()
+        finally:
+            self._flush_events()
         
     def start(self):
         "run the 'main' method in a separate thread, this call should not block"
@@ -246,7 +347,7 @@ class Controller(BaseController):
             self.thread_init()
         self._require_controller_modes('thread_initialized','devices_initialized')
         self._controller_mode_set.add('running_as_thread')
-        self.thread.start() #will run self.main as the target in a seperate thread
+        self.thread.start() #will run self.main as the target in a seperate thread (or process)
           
     def run(self):
         "run the 'main' method in non-threaded mode (will block)"
@@ -266,24 +367,74 @@ class Controller(BaseController):
         #debug
         #print event_type, content
         self._require_controller_modes('thread_initialized')
+        if self._event_buffer: #keep the events in order
+            self._flush_events()
         event = (event_type, content)  #events have standard 2-tuple form
         self.event_queue.put(event)
+
+    def _buffer_event(self, event_type, content):
+        """use within child class instead of '_send_event' in fast loops, the
+           event is buffered and sent in one EventBatch with the others, once
+           'event_batch_size' events are buffered or the first has been
+           buffered for 'event_batch_interval' seconds, or on '_flush_events'.
+           The interval is checked here and at the stop/abort checks, so an
+           event waits at most until the later of the interval and the loop's
+           next call into the controller (sleeping and waiting flush first)"""
+        buffer = self._event_buffer
+        buffer.append((event_type, content))
+        if len(buffer) == 1:
+            self._event_buffer_deadline = time.monotonic() + self.event_batch_interval
+        if len(buffer) >= self.event_batch_size or time.monotonic() >= self._event_buffer_deadline:
+            self._flush_events()
+
+    def _flush_events_if_due(self):
+        "send the buffered events if the first has waited 'event_batch_interval' seconds"
+        if self._event_buffer and time.monotonic() >= self._event_buffer_deadline:
+            self._flush_events()
+
+    def _flush_events(self):
+        """send the buffered events now, as one EventBatch, it is called when
+           'main' returns and before the thread sleeps or waits"""
+        buffer = self._event_buffer
+        if not buffer:
+            return
+        self._require_controller_modes('thread_initialized')
+        self._event_buffer = EventBatch()
+        self.event_queue.put(buffer)
+
+    def _send_events(self, events):
+        "use within child class to send many (event_type, content) events as one EventBatch"
+        self._require_controller_modes('thread_initialized')
+        if self._event_buffer:
+            self._flush_events()
+        self.event_queue.put(EventBatch(events))
         
     def _thread_check_abort_event(self):
         """use to synchronize forced thread shutdown
            raises AbortInterupt if the abort_event has been set"""
         self._require_controller_modes('thread_initialized')
+        self._flush_events_if_due()
         return self.thread.check_abort_event()
         
     def _thread_abort_breakout_point(self):
         """use to synchronize forced thread shutdown
            raises AbortInterupt if the abort_event has been set"""
         self._require_controller_modes('thread_initialized')
+        self._flush_events_if_due()
         self.thread.abort_breakout_point()
         
+    def _thread_wait_any(self, *sources, **kwargs):
+        """use to block until any of the sources (queues, sockets, ...), the 
+           stop event or the abort event is ready, instead of polling
+           returns the ready sources, raises AbortInterrupt if the abort_event has been set"""
+        self._require_controller_modes('thread_initialized')
+        self._flush_events() #don't hold events back while waiting
+        return self.thread.wait_any(*sources, **kwargs)
+        
     def _thread_check_stop_event(self):
         """use to synchronize controlled thread shutdown"""
         self._require_controller_modes(['running_as_thread','running_as_blocking_call'])
+        self._flush_events_if_due()
         return self.thread.check_stop_event()
         
     def _require_controller_modes(self, *args):
@@ -312,7 +463,10 @@ class Controller(BaseController):
         
     def __del__(self):
         try:
+            if self._pid != os.getpid(): #inherited by a forked child
+                return
             self.stop()
+            self._controller_mode_set.add('shutdown_inline')
             self.shutdown()
         except AttributeError:  #ignore already collected garbage
             pass
@@ -0,0 +1,125 @@
+""" concurrent initialization of devices and controllers, scheduled as a
+    dependency graph over the controllers' 'devices' and 'controllers' dicts
+
+    Each device and each controller is a node, a controller depends on its
+    devices and subcontrollers, so independent devices (e.g. instruments with
+    a slow self-calibration) are initialized at once, in up to 'max_workers'
+    threads. A device or subcontroller shared by many controllers is one node,
+    so it is initialized exactly once, and its handle is added to the
+    '_initialized_devices' of the controllers using it (until it is shut down)
+    so that later graphs skip it. A controller which overloads
+    'initialize_devices' runs its own method once its devices and
+    subcontrollers are done, unless it is one of the roots being expanded,
+    and is then marked 'devices_initialized' so that its 'initialize' doesn't
+    run it again.
+"""
+###############################################################################
+from automat.core.hwcontrol.controllers.task_graph import TaskNode, run_graph, DEFAULT_WORKERS
+try:
+    from collections import OrderedDict
+except ImportError:
+    from automat.substitutes.ordered_dict import OrderedDict
+
+DEFAULT_INIT_WORKERS = DEFAULT_WORKERS
+
+###############################################################################
+def _initialize_device(device, users):
+    device.initialize()
+    for controller, handle in users:
+        controller._initialized_devices.add(handle)
+
+def _run_initialize_devices(controller):
+    "run the controller's overloaded 'initialize_devices', which finds the devices done"
+    controller.initialize_devices()
+    controller._mark_devices_initialized()
+
+def _overloads_initialize_devices(controller):
+    from automat.core.hwcontrol.controllers.controller import BaseController
+    return type(controller).initialize_devices is not BaseController.initialize_devices
+
+def build_init_graph(controllers, expand_roots = False):
+    """get the list of nodes, dependencies first, to initialize the
+       'controllers' (a dict of name -> controller, or a sequence) and all
+       their devices and subcontrollers, the controllers whose devices are
+       initialized already are left out
+    """
+    if hasattr(controllers, 'items'):
+        controllers = list(controllers.items())
+    else: #name them by class
+        controllers = [(controller.__class__.__name__, controller) for controller in controllers]
+    nodes = OrderedDict() #id(obj) -> node, in dependency order
+    users = {}            #id(device) -> [(controller, handle)]
+
+    def add_device(handle, device, controller):
+        node = nodes.get(id(device))
+        if node is None:
+            if handle in controller._initialized_devices:
+                return None
+            device_users = users[id(device)] = []
+            node = nodes[id(device)] = TaskNode("device:%s" % handle, device, 'device', lambda: _initialize_device(device, device_users))
+        users[id(device)].append((controller, handle))
+        return node
+
+    def add_controller(handle, controller, expand):
+        node = nodes.get(id(controller))
+        if not node is None:
+            return node
+        if 'devices_initialized' in controller._controller_mode_set:
+            return None
+        if not expand and _overloads_initialize_devices(controller):
+            run = lambda: _run_initialize_devices(controller)
+        else:
+            run = controller._mark_devices_initialized
+        node = TaskNode("controller:%s" % handle, controller, 'controller', run)
+        for device_handle, device in list(controller.devices.items()):
+            if not device is None:
+                node.deps.append(add_device(device_handle, device, controller))
+        for subcontroller_handle, subcontroller in list(controller.controllers.items()):
+            node.deps.append(add_controller(subcontroller_handle, subcontroller, False))
+        node.deps = [dep for dep in node.deps if not dep is None] #done already
+        nodes[id(controller)] = node #after its dependencies
+        return node
+
+    for handle, controller in controllers:
+        add_controller(handle, controller, expand_roots)
+    return list(nodes.values())
+
+def run_init_graph(nodes, max_workers = DEFAULT_INIT_WORKERS):
+    """initialize the nodes, each as soon as its dependencies are done,
+       returns a GraphReport; if a node fails the others still running are
+       waited for and its exception is raised, with the report attached as
+       'init_report'
+    """
+    report = run_graph(nodes, max_workers = max_workers)
+    failed = report.failed
+    if failed:
+        exc = failed[0].error
+        exc.init_report = report
+        raise exc
+    return report
+
+def initialize_concurrently(controllers, max_workers = DEFAULT_INIT_WORKERS, expand_roots = False):
+    "initialize the devices of the controllers as a dependency graph, returns a GraphReport"
+    return run_init_graph(build_init_graph(controllers, expand_roots = expand_roots), max_workers = max_workers)
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    import time
+    from automat.core.hwcontrol.controllers.controller import NullController
+    from automat.core.hwcontrol.devices.device import StubDevice
+    class SlowDevice(StubDevice):
+        def __init__(self):
+            self.init_count = 0
+        def initialize(self):
+            time.sleep(0.5) #self-calibration
+            self.init_count += 1
+    shared = SlowDevice()
+    sub = NullController(devices = OrderedDict([('dmm', SlowDevice()), ('shared', shared)]))
+    controllers = OrderedDict()
+    controllers['scan']  = NullController(devices = OrderedDict([('stage', SlowDevice()), ('shared', shared)]),
+                                          controllers = OrderedDict([('sub', sub)]))
+    controllers['other'] = NullController(devices = OrderedDict([('laser', SlowDevice()), ('shared', shared)]))
+    print(initialize_concurrently(controllers))
+    print("the shared device was initialized %d time(s)" % shared.init_count)
@@ -1,49 +1,140 @@
 ###############################################################################
 import time, datetime, traceback, socket
-from threading import Thread
+from threading import Thread, Lock
 from queue import Queue
+from concurrent.futures import Future, ThreadPoolExecutor
 try:
     from collections import OrderedDict
 except ImportError:
     from yes_o2ab.support.odict import OrderedDict
     
 from automat.core.hwcontrol.controllers.controller import BaseController,Controller
+from automat.core.hwcontrol.controllers.shutdown import DEFAULT_SHUTDOWN_TIMEOUT
 from automat.core.network.pickle_socket import PickleSocket
+from automat.core.network.session import SessionPool, DEFAULT_POOL_SIZE, is_request, make_response, make_error, set_nodelay
+from automat.core.network.rpc import RemoteProxy, DEFAULT_RPC_WORKERS, make_call, is_call, dispatch_call
 ###############################################################################
-SOCKET_TIMEOUT  = 1.0   #timeout for accepting connections
-MAX_CONNECTIONS = 5
+SOCKET_TIMEOUT         = 1.0   #timeout for accepting connections
+MAX_CONNECTIONS        = 16    #sessions served at once, more are refused, overridden by the 'max_connections' configuration
+MAX_QUEUED_CONNECTIONS = 16    #accepted sessions being handed to a worker, overridden by 'max_queued_connections'
 
 ###############################################################################
-class ConnectionHandlerThread(Thread):
-    def __init__(self, connection, address, message_queue):
-        Thread.__init__(self)
-        self.daemon = True  #set the thread daemonic property so it doesn't hang app
+class ConnectionHandler(object):
+    """Serves a persistent client session in a worker thread, one-way
+       messages are put on the 'message_queue' and requests are answered with
+       the result of the 'request_handler' (see 'automat.core.network.session'),
+       which may return a Future to respond later without holding up the session
+    """
+    def __init__(self, connection, address, message_queue, request_handler = None):
         self.connection = connection
         self.address    = address
-        self.message_queue = message_queue
+        self.message_queue   = message_queue
+        self.request_handler = request_handler
+        self._send_lock = Lock()
         
     def run(self):
         try:
             print("CONNECTION AT %s STARTED" % (self.address,))
-            msg = self.connection.load()
-            print("FROM %s RECEIVED: %r" % (self.address,msg))
-            self.message_queue.put(msg)
-        except socket.error:
-            #connection dropped, end this thread
+            for msg in self.connection: #until the client disconnects
+                if is_request(msg) and not self.request_handler is None:
+                    self.handle_request(msg)
+                else:
+                    print("FROM %s RECEIVED: %r" % (self.address,msg))
+                    self.message_queue.put(msg)
+        except (socket.error, ValueError):
+            #connection dropped, free the worker
             print("CONNECTION AT %s DROPPED" % (self.address,))
+        finally:
+            self.close()
+            
+    def handle_request(self, msg):
+        msg_type, request_id, payload = msg
+        try:
+            result = self.request_handler(payload)
+        except Exception as exc:
+            self.send(make_error(request_id, exc))
             return
-        self.close()    
+        if isinstance(result, Future):
+            result.add_done_callback(lambda future: self._send_result(request_id, future))
+        else:
+            self.send(make_response(request_id, result))
+            
+    def _send_result(self, request_id, future):
+        "called when a deferred request completes"
+        exc = future.exception()
+        if exc is None:
+            response = make_response(request_id, future.result())
+        else:
+            response = make_error(request_id, exc)
+        try:
+            self.send(response)
+        except (socket.error, ValueError): #client already gone
+            pass
+            
+    def send(self, msg):
+        with self._send_lock:
+            self.connection.dump(msg)
             
     def close(self):
+        try:
+            self.connection.sock.shutdown(socket.SHUT_RDWR) #wakes a blocked read
+        except OSError: #already closed
+            pass
         self.connection.close()
         
 ###############################################################################
 class ClientController(BaseController):
+    shared_controllers = ('server',) #the server outlives its clients
     def __init__(self, **kwargs):
         BaseController.__init__(self, **kwargs)
         server = self.controllers['server']
         port = server.configuration['port']
         self.set_configuration(port=port)
+        self._session_pool = None
+        self._proxy = None
+        
+    def get_session_pool(self):
+        "sessions to the server are opened on first use and kept open"
+        if self._session_pool is None:
+            host = self.configuration.get('host', 'localhost')
+            port = int(self.configuration['port'])
+            pool_size = int(self.configuration.get('pool_size', DEFAULT_POOL_SIZE))
+            self._session_pool = SessionPool((host, port), size = pool_size)
+        return self._session_pool
+        
+    def send(self, msg):
+        "send a one-way message to the server's 'message_queue'"
+        self.get_session_pool().send(msg)
+        
+    def request(self, payload, timeout = None):
+        "send a request and wait for the server's response"
+        return self.get_session_pool().request(payload, timeout = timeout)
+        
+    def request_async(self, payload):
+        "send a request, returns a Future for the server's response"
+        return self.get_session_pool().request_async(payload)
+        
+    def call(self, method_name, args = (), kwargs = None, timeout = None):
+        "call one of the server's 'RPC_METHODS' and wait for the result"
+        return self.request(make_call(method_name, args, kwargs), timeout = timeout)
+        
+    def call_async(self, method_name, *args, **kwargs):
+        "call one of the server's 'RPC_METHODS', returns a Future for the result"
+        return self.request_async(make_call(method_name, args, kwargs))
+        
+    def get_proxy(self, timeout = None):
+        "get an object whose methods call the server's 'RPC_METHODS'"
+        if timeout is None:
+            if self._proxy is None:
+                self._proxy = RemoteProxy(self)
+            return self._proxy
+        return RemoteProxy(self, timeout = timeout)
+        
+    def shutdown(self, timeout = DEFAULT_SHUTDOWN_TIMEOUT):
+        BaseController.shutdown(self, timeout = timeout)
+        if not self._session_pool is None:
+            self._session_pool.close()
+            self._session_pool = None
     #--------------------------------------------------------------------------
     # Python Builtin Methods
     def __repr__(self):
@@ -60,14 +151,39 @@ class ClientController(BaseController):
     
 ###############################################################################
 class NetworkedController(Controller):
-    """A threaded hardware interface that is to send events through to their 'event_queue' using the 'send_event' method"""
+    """A threaded hardware interface that is to send events through to their 'event_queue' using the 'send_event' method,
+       clients may call the methods named in 'RPC_METHODS', which are run in a pool of 'rpc_workers' threads
+    """
+    RPC_METHODS = ('get_rpc_methods',
+                   'set_configuration',
+                   'get_configuration',
+                   'set_metadata',
+                   'get_metadata',
+                   'start',
+                   'stop',
+                   'abort',
+                   'get_connection_metrics',
+                  )
     #--------------------------------------------------------------------------
     # Initialization/Shutdown methods - called externally in various program phases 
     def __init__(self, **kwargs):
         Controller.__init__(self, **kwargs)
         self._pickle_socket = None
-        self.handler_threads = []
+        self.connection_handlers = set() #handlers of the active and queued sessions
         self.message_queue = Queue()
+        self._rpc_executor = None
+        self._connection_queue   = Queue() #handlers waiting for a free worker
+        self._connection_workers = []
+        self._connection_lock     = Lock()
+        self._max_connections        = MAX_CONNECTIONS
+        self._max_queued_connections = MAX_QUEUED_CONNECTIONS
+        self._connection_counts = OrderedDict([('active'     , 0),
+                                               ('queued'     , 0),
+                                               ('accepted'   , 0),
+                                               ('completed'  , 0),
+                                               ('refused'    , 0),
+                                               ('peak_active', 0),
+                                              ])
         
     def initialize(self, **kwargs):
         Controller.initialize(self,**kwargs)
@@ -78,26 +194,113 @@ class NetworkedController(Controller):
         port = int(self.configuration.get('port', 0)) # default of 0 gets any available port at bind time
         self._pickle_socket = PickleSocket(timeout=SOCKET_TIMEOUT)
         self._pickle_socket.bind(("", port))     
-        self._pickle_socket.listen(MAX_CONNECTIONS) #accept a limited number of simultaneous connections
+        self._max_connections        = int(self.configuration.get('max_connections', MAX_CONNECTIONS))
+        self._max_queued_connections = int(self.configuration.get('max_queued_connections', MAX_QUEUED_CONNECTIONS))
+        self._pickle_socket.listen(self._max_connections) #accept a limited number of simultaneous connections
+        #runs the remote procedure calls
+        workers = int(self.configuration.get('rpc_workers', DEFAULT_RPC_WORKERS))
+        self._rpc_executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "rpc")
         
-    def shutdown(self):
-        Controller.shutdown(self)
-        for handler_thread in self.handler_threads:
-            handler_thread.close()
-            handler_thread.join()
-        self._pickle_socket.close()
+    def shutdown(self, timeout = DEFAULT_SHUTDOWN_TIMEOUT):
+        Controller.shutdown(self, timeout = timeout)
+        with self._connection_lock:
+            handlers = list(self.connection_handlers)
+        for handler in handlers:
+            handler.close()
+        #from '__del__' the (daemonic) threads are left to exit by themselves
+        wait = not 'shutdown_inline' in self._controller_mode_set
+        #queued handlers exit at once, their connections being closed
+        for worker in self._connection_workers:
+            self._connection_queue.put(None)
+        if wait:
+            for worker in self._connection_workers:
+                worker.join()
+        self._connection_workers = []
+        if not self._pickle_socket is None: #None if it was never initialized
+            self._pickle_socket.close()
+        if not self._rpc_executor is None:
+            self._rpc_executor.shutdown(wait = wait)
+            self._rpc_executor = None
         
     def accept_connection(self):
         #accept a connection
         try:         
             connection, address = self._pickle_socket.accept()
-            #launch a new thread for each connection
-            handler_thread = HandlerThread(connection,address,message_queue = self.message_queue)
-            handler_thread.start()
-            self.handler_threads.append(handler_thread)  #keep track of running threads
-            return True
         except socket.timeout: #continue with next iteration
             return False
+        set_nodelay(connection.sock)
+        handler = ConnectionHandler(connection,
+                                    address,
+                                    message_queue   = self.message_queue,
+                                    request_handler = self.handle_request,
+                                   )
+        counts = self._connection_counts
+        with self._connection_lock:
+            #a session holds its worker until the client disconnects, so a
+            #session queued behind busy workers would never be served
+            if counts['active'] + counts['queued'] >= self._max_connections or counts['queued'] >= self._max_queued_connections:
+                counts['refused'] += 1
+                handler = None
+            else:
+                counts['queued']   += 1
+                counts['accepted'] += 1
+                self.connection_handlers.add(handler)
+                #start workers as they are needed, up to the limit
+                workers = self._connection_workers
+                if counts['active'] + counts['queued'] > len(workers) and len(workers) < self._max_connections:
+                    #daemonic, so that open sessions don't hang app exit
+                    worker = Thread(target = self._connection_worker, name = "connection-%d" % len(workers))
+                    worker.daemon = True
+                    worker.start()
+                    workers.append(worker)
+        if handler is None:
+            print("CONNECTION AT %s REFUSED, %d SESSIONS ALREADY SERVED" % (address, self._max_connections))
+            connection.close()
+            return True
+        #the session is served by a pooled worker, one is free or just started
+        self._connection_queue.put(handler)
+        return True
+
+    def _connection_worker(self):
+        counts = self._connection_counts
+        while True:
+            handler = self._connection_queue.get()
+            if handler is None: #shutdown
+                return
+            with self._connection_lock:
+                counts['queued'] -= 1
+                counts['active'] += 1
+                counts['peak_active'] = max(counts['peak_active'], counts['active'])
+            try:
+                handler.run()
+            finally:
+                #reap the finished handler
+                with self._connection_lock:
+                    counts['active']    -= 1
+                    counts['completed'] += 1
+                    self.connection_handlers.discard(handler)
+
+    def get_connection_metrics(self):
+        "get the counts of active, queued, accepted, completed and refused sessions"
+        with self._connection_lock:
+            metrics = OrderedDict(self._connection_counts)
+        metrics['max_connections']        = self._max_connections
+        metrics['max_queued_connections'] = self._max_queued_connections
+        return metrics
+
+    def handle_request(self, payload):
+        """the response to a client request, runs in the connection handler
+           thread, calls to the 'RPC_METHODS' are run in the worker pool,
+           by default any other payload is queued like a one-way message and
+           acknowledged, often overloaded in child class
+        """
+        if is_call(payload):
+            return self._rpc_executor.submit(dispatch_call, self, payload, self.RPC_METHODS)
+        self.message_queue.put(payload)
+        return True
+
+    def get_rpc_methods(self):
+        return list(self.RPC_METHODS)
 
     def reset(self):
         Controller.reset(self)
@@ -112,10 +315,7 @@ class NetworkedController(Controller):
         return s
         
     def __del__(self):
-        try:
-            self.stop()
-            self.shutdown()
-        except AttributeError:  #ignore already collected garbage
-            pass
+        #forked copies are skipped and the shutdown runs inline
+        Controller.__del__(self)
         
         
@@ -0,0 +1,162 @@
+""" concurrent, deduplicated shutdown of controller trees, in the reverse of
+    the initialization order and within a deadline
+
+    The graph is walked once: each controller and each device is one node, a
+    controller is shut down (aborted and its thread joined) before its
+    subcontrollers, and a device only once all the controllers which use it
+    are. All the controllers are aborted first, so that their threads wind
+    down together, and independent branches run concurrently. When the
+    deadline expires the nodes still running are left behind (in daemon
+    threads) and the rest are skipped, so that teardown is bounded.
+
+    A controller which overloads 'shutdown' (to release its own resources,
+    e.g. sockets) has it called in the 'shutdown_coordinated' mode, in which
+    the base class 'shutdown' leaves the devices and subcontrollers to the
+    coordinator. The subcontrollers named in a controller's
+    'shared_controllers' are owned elsewhere and left out. A device which was
+    shut down is removed from the '_initialized_devices' of the controllers
+    using it, and skipped by their later shutdowns, e.g. from '__del__'.
+"""
+###############################################################################
+import warnings
+from automat.core.hwcontrol.controllers.task_graph import TaskNode, run_graph, DEFAULT_WORKERS
+try:
+    from collections import OrderedDict
+except ImportError:
+    from automat.substitutes.ordered_dict import OrderedDict
+
+DEFAULT_SHUTDOWN_TIMEOUT = 10.0 #seconds, for the whole tree
+DEFAULT_SHUTDOWN_WORKERS = DEFAULT_WORKERS
+
+###############################################################################
+def _shutdown_device(device, users):
+    device.shutdown()
+    for controller, handle in users:
+        controller._initialized_devices.discard(handle)
+
+def _overloads_shutdown(controller):
+    from automat.core.hwcontrol.controllers.controller import BaseController, Controller
+    return not type(controller).shutdown in (BaseController.shutdown, Controller.shutdown)
+
+def _is_device_shut_down(controller, handle):
+    return 'devices_shutdown' in controller._controller_mode_set and not handle in controller._initialized_devices
+
+def _is_shut_down(controller):
+    modes = controller._controller_mode_set
+    return 'devices_shutdown' in modes and not 'thread_initialized' in modes
+
+def _run_coordinated_shutdown(controller):
+    "call the controller's overloaded 'shutdown' for its own resources only"
+    modes = controller._controller_mode_set
+    modes.add('shutdown_coordinated')
+    try:
+        controller.shutdown()
+    finally:
+        modes.discard('shutdown_coordinated')
+
+def build_shutdown_graph(controllers, devices = None, expand_roots = False):
+    """get the list of nodes, in order, to shut down the 'controllers' (a dict
+       of name -> controller, or a sequence) with all their subcontrollers and
+       devices, and any other 'devices' (a dict of handle -> device), the
+       controllers and devices shut down already are left out
+    """
+    if hasattr(controllers, 'items'):
+        controllers = list(controllers.items())
+    else: #name them by class
+        controllers = [(controller.__class__.__name__, controller) for controller in controllers]
+    nodes = OrderedDict() #id(obj) -> node
+    users = {}            #id(device) -> [(controller, handle)]
+
+    def add_device(handle, device, parent_node):
+        if device is None:
+            return
+        controller = None if parent_node is None else parent_node.obj
+        node = nodes.get(id(device))
+        if node is None:
+            if not controller is None and _is_device_shut_down(controller, handle):
+                return
+            device_users = users[id(device)] = []
+            node = nodes[id(device)] = TaskNode("device:%s" % handle, device, 'device', lambda: _shutdown_device(device, device_users))
+        if not parent_node is None:
+            users[id(device)].append((controller, handle))
+            node.deps.append(parent_node) #after every controller using it
+
+    def add_controller(handle, controller, parent_node, expand):
+        node = nodes.get(id(controller))
+        if node is None:
+            if _is_shut_down(controller):
+                return
+            if not expand and _overloads_shutdown(controller):
+                run = lambda: _run_coordinated_shutdown(controller)
+            else:
+                run = controller._shutdown_controller
+            node = nodes[id(controller)] = TaskNode("controller:%s" % handle, controller, 'controller', run)
+            for device_handle, device in list(controller.devices.items()):
+                add_device(device_handle, device, node)
+            for subcontroller_handle, subcontroller in list(controller.controllers.items()):
+                if subcontroller_handle in controller.shared_controllers:
+                    continue #shut down by its owner
+                add_controller(subcontroller_handle, subcontroller, node, False)
+        if not parent_node is None:
+            node.deps.append(parent_node) #after every controller using it
+
+    for handle, controller in controllers:
+        add_controller(handle, controller, None, expand_roots)
+    if not devices is None:
+        for handle, device in devices.items():
+            add_device(handle, device, None)
+    return list(nodes.values())
+
+def run_shutdown_graph(nodes, timeout = DEFAULT_SHUTDOWN_TIMEOUT, max_workers = DEFAULT_SHUTDOWN_WORKERS):
+    """shut down the nodes, a failure doesn't hold up the others, returns a
+       GraphReport; warns of the nodes left behind at the deadline, then
+       raises the first failure, with the report attached as 'shutdown_report'
+    """
+    controllers = [node.obj for node in nodes if node.kind == 'controller']
+    #abort them all at once, so that their threads wind down together
+    for controller in controllers:
+        if not getattr(controller, 'abort_event', None) is None:
+            controller.abort()
+    report = run_graph(nodes, max_workers = max_workers, timeout = timeout, stop_on_error = False)
+    for controller in controllers:
+        controller._mark_devices_shutdown()
+    if report.timed_out:
+        warnings.warn("shutdown did not complete within %s seconds, left behind: %s" % (timeout, ", ".join(node.name for node in report.timed_out)), RuntimeWarning)
+    failed = report.failed
+    if failed:
+        exc = failed[0].error
+        exc.shutdown_report = report
+        raise exc
+    return report
+
+def shutdown_concurrently(controllers, devices = None, timeout = DEFAULT_SHUTDOWN_TIMEOUT, max_workers = DEFAULT_SHUTDOWN_WORKERS, expand_roots = False):
+    "shut down the controllers and the devices as a dependency graph, returns a GraphReport"
+    nodes = build_shutdown_graph(controllers, devices = devices, expand_roots = expand_roots)
+    return run_shutdown_graph(nodes, timeout = timeout, max_workers = max_workers)
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    import time
+    from automat.core.hwcontrol.controllers.controller import NullController
+    from automat.core.hwcontrol.devices.device import StubDevice
+    class SlowDevice(StubDevice):
+        def __init__(self, delay = 0.5):
+            self.delay = delay
+            self.shutdown_count = 0
+        def shutdown(self):
+            time.sleep(self.delay) #parking a stage
+            self.shutdown_count += 1
+    shared = SlowDevice()
+    sub = NullController(devices = OrderedDict([('dmm', SlowDevice()), ('shared', shared)]))
+    controllers = OrderedDict()
+    controllers['scan']  = NullController(devices = OrderedDict([('stage', SlowDevice()), ('shared', shared)]),
+                                          controllers = OrderedDict([('sub', sub)]))
+    controllers['other'] = NullController(devices = OrderedDict([('hung', SlowDevice(delay = 60.0)), ('shared', shared)]))
+    for controller in controllers.values():
+        controller.initialize()
+    print(shutdown_concurrently(controllers, timeout = 2.0))
+    for controller in controllers.values():
+        controller.shutdown() #again, e.g. from __del__, nothing is left to do
+    print("the shared device was shut down %d time(s)" % shared.shutdown_count)
@@ -0,0 +1,169 @@
+""" run a dependency graph of tasks concurrently, with per task timings
+
+    Used to initialize and shut down the device and controller trees. Each
+    task runs in its own daemon thread as soon as its dependencies are done,
+    so a task which hangs (e.g. an instrument which doesn't answer) can be
+    left behind when the graph's timeout expires, without holding up the exit
+    of the interpreter.
+"""
+###############################################################################
+import time, threading, queue
+try:
+    from collections import OrderedDict
+except ImportError:
+    from automat.substitutes.ordered_dict import OrderedDict
+
+DEFAULT_WORKERS = 8 #tasks running at once
+
+#task states
+PENDING   = 'pending'
+RUNNING   = 'running'
+DONE      = 'done'
+FAILED    = 'failed'
+SKIPPED   = 'skipped'   #not started, because a task failed or the time ran out
+TIMED_OUT = 'timed_out' #still running when the time ran out
+
+###############################################################################
+class TaskNode(object):
+    "a device or controller task, with its timing"
+    def __init__(self, name, obj, kind, run):
+        self.name   = name
+        self.obj    = obj
+        self.kind   = kind #'device' or 'controller'
+        self.run    = run  #callable doing the work
+        self.deps   = []   #the nodes which must be done first
+        self.state  = PENDING
+        self.start_time = None
+        self.end_time   = None
+        self.error  = None
+
+    @property
+    def duration(self):
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def __repr__(self):
+        return "<TaskNode %s %s>" % (self.name, self.state)
+
+###############################################################################
+class GraphReport(object):
+    "the per task timings of a graph run"
+    def __init__(self, nodes, start_time, end_time):
+        self.nodes      = nodes
+        self.start_time = start_time
+        self.end_time   = end_time
+
+    @property
+    def wall_time(self):
+        return self.end_time - self.start_time
+
+    @property
+    def serial_time(self):
+        "the time it would have taken one task at a time"
+        return sum(node.duration for node in self.nodes if not node.duration is None)
+
+    @property
+    def failed(self):
+        return [node for node in self.nodes if node.state == FAILED]
+
+    @property
+    def timed_out(self):
+        return [node for node in self.nodes if node.state == TIMED_OUT]
+
+    def get_timings(self):
+        "get an OrderedDict of task name -> seconds"
+        return OrderedDict((node.name, node.duration) for node in self.nodes)
+
+    def format(self):
+        lines = ["%-40s %-10s %10s %10s" % ('node', 'state', 'start (s)', 'time (s)')]
+        for node in sorted(self.nodes, key = lambda node: (node.start_time is None, node.start_time)):
+            start    = "" if node.start_time is None else "%10.3f" % (node.start_time - self.start_time)
+            duration = "" if node.duration is None else "%10.3f" % node.duration
+            lines.append("%-40s %-10s %10s %10s" % (node.name, node.state, start, duration))
+        lines.append("%d nodes in %0.3f seconds (%0.3f seconds one at a time)" % (len(self.nodes), self.wall_time, self.serial_time))
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.format()
+
+###############################################################################
+def run_graph(nodes, max_workers = DEFAULT_WORKERS, timeout = None, stop_on_error = True):
+    """run the tasks, each as soon as its dependencies are done, returns a
+       GraphReport. After a failure no more tasks are started if
+       'stop_on_error', otherwise a failed dependency counts as done. When
+       the 'timeout' (seconds) expires the tasks still running are left
+       behind and those not started are skipped. With 'max_workers' 0 the
+       tasks run one at a time in the calling thread, e.g. from '__del__'
+       where starting threads isn't safe.
+    """
+    start_time = time.time()
+    deadline   = None if timeout is None else start_time + timeout
+    if max_workers is None:
+        max_workers = DEFAULT_WORKERS
+    finished_states = (DONE,) if stop_on_error else (DONE, FAILED)
+    finished = queue.Queue()
+
+    def run_node(node):
+        node.start_time = time.time()
+        try:
+            node.run()
+            node.state = DONE
+        except BaseException as exc:
+            node.error = exc
+            node.state = FAILED
+        finally:
+            node.end_time = time.time()
+            finished.put(node)
+
+    pending = list(nodes)
+    running = set()
+    failed  = False
+    while pending:
+        if failed and stop_on_error:
+            break
+        ready = [node for node in pending if all(dep.state in finished_states for dep in node.deps)]
+        if max_workers < 1: #inline
+            if not ready or (not deadline is None and time.time() >= deadline):
+                break
+            node = ready[0]
+            pending.remove(node)
+            node.state = RUNNING
+            run_node(node)
+            finished.get()
+            failed = failed or node.state == FAILED
+            continue
+        for node in ready[:max_workers - len(running)]:
+            pending.remove(node)
+            running.add(node)
+            node.state = RUNNING
+            thread = threading.Thread(target = run_node, args = (node,), name = "task-%s" % node.name)
+            thread.daemon = True
+            thread.start()
+        if not running:
+            break
+        #wait for a task to finish, then start the tasks it was holding up
+        remaining = None if deadline is None else deadline - time.time()
+        if not remaining is None and remaining <= 0:
+            break
+        try:
+            node = finished.get(timeout = remaining)
+        except queue.Empty: #out of time
+            break
+        running.discard(node)
+        failed = failed or node.state == FAILED
+    #wait for the tasks still running
+    while running:
+        remaining = None if deadline is None else deadline - time.time()
+        if not remaining is None and remaining <= 0:
+            break
+        try:
+            node = finished.get(timeout = remaining)
+        except queue.Empty:
+            break
+        running.discard(node)
+    for node in pending:
+        node.state = SKIPPED
+    for node in running:
+        node.state = TIMED_OUT
+    return GraphReport(nodes, start_time, time.time())
@@ -0,0 +1,245 @@
+""" length-prefixed framing of byte payloads over stream sockets
+
+    Each frame on the wire is a 4 byte big-endian unsigned payload length
+    followed by the payload bytes.  The writer coalesces many small frames into
+    a single 'sendmsg' call, flushing when a size or time threshold is reached.
+
+    Objects are pickled with protocol 5, large contiguous buffers (e.g. NumPy 
+    arrays) are sent out-of-band without being copied into the pickle: the
+    high bit of the pickle frame's length is set (OOB_FLAG) and each buffer
+    follows as its own frame, in the order the unpickler asks for them.
+"""
+###############################################################################
+import socket, struct, time, pickle
+
+FRAME_HEADER           = struct.Struct('!I')
+OOB_FLAG               = 0x80000000 #pickle frame is followed by out-of-band buffer frames
+MAX_FRAME_SIZE         = OOB_FLAG - 1
+PICKLE_PROTOCOL        = 5
+OOB_THRESHOLD          = 64*1024  #smaller buffers are left in the pickle
+DEFAULT_FLUSH_SIZE     = 64*1024  #bytes buffered before a write is forced
+DEFAULT_FLUSH_INTERVAL = 0.002    #seconds a frame may wait in the buffer
+DEFAULT_BUFFER_SIZE    = 64*1024  #initial size of the receive buffer
+MAX_SENDMSG_BUFFERS    = 512      #stay well below the system IOV_MAX
+
+###############################################################################
+def send_buffers(sock, buffers):
+    "send all the buffers using as few system calls as possible, handling partial sends"
+    if not hasattr(sock, 'sendmsg'): #not available on all platforms
+        sock.sendall(b"".join(buffers))
+        return
+    buffers = [memoryview(buf).cast('B') for buf in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers[:MAX_SENDMSG_BUFFERS])
+        #drop the buffers which were completely sent
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+def encode_object(obj, protocol = PICKLE_PROTOCOL):
+    """pickle the object into a list of buffers holding its frames, large 
+       buffers of the object are referenced, not copied
+    """
+    oob_buffers = []
+    def buffer_callback(pickle_buffer):
+        try:
+            raw = pickle_buffer.raw()
+        except BufferError: #not contiguous, leave it in the pickle
+            return True
+        if raw.nbytes < OOB_THRESHOLD:
+            return True
+        oob_buffers.append(raw)
+        return False
+    if protocol >= 5:
+        data = pickle.dumps(obj, protocol, buffer_callback = buffer_callback)
+    else:
+        data = pickle.dumps(obj, protocol)
+    _check_frame_size(len(data))
+    if not oob_buffers:
+        return [FRAME_HEADER.pack(len(data)), data]
+    frames = [FRAME_HEADER.pack(len(data) | OOB_FLAG), data]
+    for raw in oob_buffers:
+        _check_frame_size(raw.nbytes)
+        frames.append(FRAME_HEADER.pack(raw.nbytes))
+        frames.append(raw)
+    return frames
+
+def _check_frame_size(size):
+    if size > MAX_FRAME_SIZE:
+        raise ValueError("frame payload of %d bytes exceeds the maximum of %d" % (size, MAX_FRAME_SIZE))
+
+###############################################################################
+class FrameWriter(object):
+    """Buffers outgoing frames and writes them to the socket in batches"""
+    def __init__(self,
+                 sock,
+                 flush_size     = DEFAULT_FLUSH_SIZE,
+                 flush_interval = DEFAULT_FLUSH_INTERVAL,
+                 protocol       = PICKLE_PROTOCOL, #used by 'write_object'
+                ):
+        self.sock           = sock
+        self.flush_size     = flush_size
+        self.flush_interval = flush_interval
+        self.protocol       = protocol
+        self._buffers       = []
+        self._buffered_size = 0
+        self._first_time    = None #time the oldest buffered frame was written
+
+    def write(self, payload):
+        "buffer a single frame, flushing if the size threshold is reached"
+        size = len(payload)
+        _check_frame_size(size)
+        self.write_frames([FRAME_HEADER.pack(size), payload])
+
+    def write_object(self, obj):
+        """pickle the object into frames, out-of-band buffers reference the 
+           object's memory so it must not be modified until flushed
+        """
+        self.write_frames(encode_object(obj, self.protocol))
+
+    def write_frames(self, buffers):
+        "buffer data which is already framed, e.g. by a serializer"
+        if self._first_time is None:
+            self._first_time = time.time()
+        self._buffers.extend(buffers)
+        self._buffered_size += sum(memoryview(buf).nbytes for buf in buffers)
+        if self._buffered_size >= self.flush_size:
+            self.flush()
+
+    def time_until_flush(self):
+        "seconds left before the buffered frames are due, None if nothing is buffered"
+        if self._first_time is None:
+            return None
+        return max(0.0, self._first_time + self.flush_interval - time.time())
+
+    def flush_if_due(self):
+        "flush if the oldest buffered frame has waited at least 'flush_interval'"
+        if self.time_until_flush() == 0.0:
+            self.flush()
+
+    def flush(self):
+        buffers = self._buffers
+        self._buffers       = []
+        self._buffered_size = 0
+        self._first_time    = None
+        if buffers:
+            send_buffers(self.sock, buffers)
+
+###############################################################################
+class FrameReader(object):
+    """Reads frames from a socket into a reusable receive buffer"""
+    def __init__(self, sock, buffer_size = DEFAULT_BUFFER_SIZE):
+        self.sock    = sock
+        self._buffer = bytearray(buffer_size)
+        self._view   = memoryview(self._buffer)
+        self._start  = 0  #start of unread data in the buffer
+        self._end    = 0  #end of received data in the buffer
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return self.load()
+        except EOFError:
+            raise StopIteration
+
+    def read_frame_view(self):
+        """get the next frame payload as a memoryview into the receive buffer,
+           which is only valid until the next read
+        """
+        size, has_oob = self._read_header()
+        return self._read_payload_view(size)
+
+    def read_frame(self):
+        "get the next frame payload as bytes"
+        return bytes(self.read_frame_view())
+
+    def read_frame_into_new(self):
+        "get the next frame payload in its own bytearray, received directly into it where possible"
+        size, has_oob = self._read_header()
+        payload = bytearray(size)
+        view    = memoryview(payload)
+        #take whatever is already buffered, then receive the rest in place
+        buffered = min(size, self._end - self._start)
+        view[:buffered] = self._view[self._start:self._start + buffered]
+        self._start += buffered
+        received = buffered
+        while received < size:
+            nbytes = self.sock.recv_into(view[received:])
+            if nbytes == 0:
+                raise ConnectionError("connection closed in the middle of a frame")
+            received += nbytes
+        return payload
+
+    def load(self):
+        "unpickle the next object"
+        size, has_oob = self._read_header()
+        if not has_oob:
+            return pickle.loads(self._read_payload_view(size))
+        #copy out the pickle, the receive buffer is reused for the buffer frames
+        data = bytes(self._read_payload_view(size))
+        return pickle.loads(data, buffers = self._iter_oob_buffers())
+
+    def _iter_oob_buffers(self):
+        while True:
+            yield self.read_frame_into_new()
+
+    def _read_header(self):
+        "returns (payload size, out-of-band flag) of the next frame"
+        header_size = FRAME_HEADER.size
+        self._fill(header_size, at_boundary = True)
+        size, = FRAME_HEADER.unpack_from(self._buffer, self._start)
+        self._start += header_size
+        return (size & MAX_FRAME_SIZE, bool(size & OOB_FLAG))
+
+    def _read_payload_view(self, size):
+        self._fill(size)
+        start = self._start
+        self._start += size
+        return self._view[start:start + size]
+
+    def close(self):
+        self.sock.close()
+
+    def _fill(self, needed, at_boundary = False):
+        "receive until at least 'needed' bytes are available after the read position"
+        if self._end - self._start >= needed:
+            return
+        #make room at the end of the buffer
+        if self._start + needed > len(self._buffer):
+            pending = self._end - self._start
+            if needed > len(self._buffer):
+                new_buffer = bytearray(max(needed, 2*len(self._buffer)))
+                new_buffer[:pending] = self._buffer[self._start:self._end]
+                self._buffer = new_buffer
+                self._view   = memoryview(new_buffer)
+            else:
+                self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start = 0
+            self._end   = pending
+        while self._end - self._start < needed:
+            nbytes = self.sock.recv_into(self._view[self._end:])
+            if nbytes == 0:
+                if at_boundary and self._end == self._start:
+                    raise EOFError("connection closed")
+                raise ConnectionError("connection closed in the middle of a frame")
+            self._end += nbytes
+
+###############################################################################
+async def read_frame_async(stream_reader):
+    "read the next frame payload from an 'asyncio.StreamReader'"
+    header = await stream_reader.readexactly(FRAME_HEADER.size)
+    size, = FRAME_HEADER.unpack(header)
+    return await stream_reader.readexactly(size)
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    import sys
+    sock = socket.create_connection(('localhost', int(sys.argv[1])))
+    for obj in FrameReader(sock):
+        print(obj)
@@ -1,49 +1,103 @@
-import pickle
+""" send and receive pickled python objects over stream sockets
+
+    Objects are sent as length-prefixed binary frames (see 'framing'), so a
+    PickleSocket can also read the stream of an EventServer. Large contiguous
+    buffers, such as the NumPy arrays of an ArrayDataSet, are sent as pickle
+    protocol 5 out-of-band frames straight from the array memory and received
+    directly into their own buffers.
+
+    With 'serializers' (a list of serializer names in order of preference,
+    see 'serializers') the client negotiates the serializer on 'connect' and
+    an accepted connection on its first 'load' or 'dump', both ends must 
+    then be configured this way.
+"""
+###############################################################################
 import socket
+from automat.core.network.framing import FrameWriter, FrameReader, PICKLE_PROTOCOL, DEFAULT_BUFFER_SIZE
+from automat.core.network.serializers import PickleSerializer, SerializerError, parse_hello, request_serializer, reply_serializer
 
+###############################################################################
 class UnknownObject(object):
     pass
 
+###############################################################################
 class PickleSocket:
     '''receive and unpickle python objects over the network'''
-    def __init__(self, sock=None, timeout=None, **kwargs):
+    def __init__(self, sock=None, timeout=None, buffer_size=DEFAULT_BUFFER_SIZE, protocol=PICKLE_PROTOCOL, serializers=None, **kwargs):
         if sock is None:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, **kwargs)
         if timeout is not None:
             sock.settimeout(timeout)
         self.sock = sock
-        #make objects for dumping/loading python objects 
-        self.wfile     = self.sock.makefile('w')
-        self.rfile     = self.sock.makefile('r')
-        self.pickler   = pickle.Pickler(self.wfile)
-        self.unpickler = pickle.Unpickler(self.rfile)
+        self.buffer_size = buffer_size
+        self.protocol    = protocol
+        self.serializers = serializers
+        #without negotiation, everything is pickled
+        self.serializer  = PickleSerializer(protocol) if serializers is None else None
+        self._is_server  = False
+        #frames are only sent on 'dump' or 'dump_many', never on a timer
+        self._writer = FrameWriter(sock, flush_size = float('inf'), protocol = protocol)
+        self._reader = FrameReader(sock, buffer_size = buffer_size)
     def bind(self,*args,**kwargs):
         self.sock.bind(*args,**kwargs)
     def get_port(self):
         hostaddr, port = self.sock.getsockname()
         return port
+    def fileno(self):
+        return self.sock.fileno()
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
     def listen(self,*args,**kwargs):
         self.sock.listen(*args,**kwargs)
     def accept(self, *args,**kwargs):
         #get a new socket object to handle the connection
         conn, addr = self.sock.accept(*args,**kwargs)
         #wrap the connection with a new PickleSocket object
-        conn = PickleSocket(sock=conn)
+        conn = PickleSocket(sock=conn, buffer_size=self.buffer_size, protocol=self.protocol, serializers=self.serializers)
+        conn._is_server = True
         return (conn, addr)
     def connect(self,*args,**kwargs):
         self.sock.connect(*args,**kwargs)
+        if self.serializer is None:
+            self.serializer = request_serializer(self.sock, self.serializers, reader=self._reader)
+    def _accept_serializer(self):
+        "server side of the negotiation, the client's hello must be the first frame"
+        if not self._is_server:
+            raise SerializerError("the serializer must be negotiated by 'connect' first")
+        offered = parse_hello(self._reader.read_frame_view())
+        if offered is None:
+            raise SerializerError("client did not start with a serializer negotiation")
+        self.serializer = reply_serializer(self.sock, offered, self.serializers)
     def close(self):
         self.sock.close()
     def dump(self,obj):
-        self.pickler.dump(obj)
-        self.wfile.flush()
+        self.dump_many((obj,))
+    def dump_many(self, objs):
+        "send a batch of objects with as few system calls as possible"
+        if self.serializer is None:
+            self._accept_serializer()
+        encode = self.serializer.encode
+        writer = self._writer
+        for obj in objs:
+            writer.write_frames(encode(obj))
+        writer.flush()
     def load(self):
+        "get the next object, raises EOFError when the peer closes the connection"
+        if self.serializer is None:
+            self._accept_serializer()
         try:
-            return self.unpickler.load()
-        except TypeError:
+            return self.serializer.decode(self._reader)
+        except (TypeError, AttributeError, ImportError):
+            #the frame was consumed, so the stream is still in sync
             return UnknownObject()
+    def __iter__(self):
+        while True:
+            try:
+                yield self.load()
+            except EOFError:
+                return
+
 
-                
 ###############################################################################
 # TEST CODE
 ###############################################################################
@@ -52,4 +106,3 @@ if __name__ == "__main__":
     PS.connect(('localhost',50007))
     while True:
         print(PS.load())
-
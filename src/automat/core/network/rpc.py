@@ -0,0 +1,80 @@
+""" remote procedure calls on the methods a server exposes, over the request
+    sessions of 'automat.core.network.session'
+
+    A call is the request payload ('CALL', method_name, args, kwargs), the
+    response is the method's return value. The server runs calls in a pool of
+    worker threads, so pipelined calls may complete out of order.
+"""
+###############################################################################
+import functools
+from concurrent.futures import wait
+
+CALL                = 'CALL'
+DEFAULT_RPC_WORKERS = 4
+
+###############################################################################
+class RPCError(Exception):
+    pass
+
+###############################################################################
+def make_call(method_name, args = (), kwargs = None):
+    return (CALL, method_name, tuple(args), dict(kwargs or {}))
+
+def is_call(payload):
+    return isinstance(payload, tuple) and len(payload) == 4 and payload[0] == CALL
+
+def dispatch_call(obj, payload, exposed_methods):
+    "run the call on the object, only the 'exposed_methods' may be called"
+    call_type, method_name, args, kwargs = payload
+    if not method_name in exposed_methods:
+        raise RPCError("method %r is not exposed, must be one of %r" % (method_name, list(exposed_methods)))
+    return getattr(obj, method_name)(*args, **kwargs)
+
+def gather(futures, timeout = None):
+    """wait for the Futures of calls, e.g. made on many servers at once,
+       returns their results in order, raises the first exception
+    """
+    futures = list(futures)
+    done, not_done = wait(futures, timeout = timeout)
+    if not_done:
+        raise TimeoutError("%d of %d calls did not complete within %s seconds" % (len(not_done), len(futures), timeout))
+    return [future.result() for future in futures]
+
+###############################################################################
+class RemoteProxy(object):
+    """Calls the exposed methods of a server as if they were local, e.g.
+       'proxy.set_configuration(port = 5000)', the 'requester' is anything
+       with 'request' and 'request_async' methods, such as a ClientController,
+       SessionPool or ClientSession
+    """
+    def __init__(self, requester, timeout = None):
+        self._requester = requester
+        self._timeout   = timeout
+
+    def call(self, method_name, *args, **kwargs):
+        "call and wait for the result, raises RemoteError if the method failed"
+        return self._requester.request(make_call(method_name, args, kwargs), timeout = self._timeout)
+
+    def call_async(self, method_name, *args, **kwargs):
+        "call without waiting, returns a Future for the result"
+        return self._requester.request_async(make_call(method_name, args, kwargs))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    def __repr__(self):
+        return "<RemoteProxy for %r>" % (self._requester,)
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    import sys
+    from automat.core.network.session import ClientSession
+    session = ClientSession((sys.argv[1], int(sys.argv[2])))
+    proxy = RemoteProxy(session, timeout = 5.0)
+    print(proxy.get_rpc_methods())
+    print(proxy.get_configuration())
+    session.close()
@@ -0,0 +1,296 @@
+""" pluggable serialization of the objects sent over framed sockets
+
+    Serializers are registered by name, in order of preference:
+        'msgpack' - compact and safe to load from untrusted peers, for the
+                    common (event_type, content) events of numbers, strings,
+                    lists and dicts; tuples and NumPy arrays are kept as
+                    extension types (requires the 'msgpack' package)
+        'numpy'   - raw NumPy arrays with a dtype/shape header, received
+                    directly into the array memory (requires 'numpy'), it
+                    can't send events so the event servers never choose it
+        'pickle'  - any python object, large buffers are sent out-of-band,
+                    only safe between trusted hosts
+
+    A client chooses the serializer at connect time by sending a hello frame
+    listing the names it accepts, the server replies with the first of those
+    which it also accepts (an empty name means none).
+"""
+###############################################################################
+import struct, pickle
+from collections import OrderedDict
+from automat.core.network.framing import FRAME_HEADER, PICKLE_PROTOCOL, FrameReader, encode_object, send_buffers
+
+#optional codecs
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HELLO_MAGIC = b"AUTOMAT_SERIALIZERS\x01"
+
+###############################################################################
+class SerializerError(ValueError):
+    pass
+
+###############################################################################
+class Serializer(object):
+    """Base class, 'encode' returns the list of buffers holding the framed
+       object and 'decode' reads it back from a FrameReader
+    """
+    name = None
+    sends_events = True #can encode (event_type, content) events
+
+    def encode(self, obj):
+        data = self.dumps(obj)
+        return [FRAME_HEADER.pack(len(data)), data]
+
+    def decode(self, reader):
+        return self.loads(reader.read_frame_view())
+
+    def dumps(self, obj):
+        "get the payload of a single frame"
+        raise NotImplementedError
+
+    def loads(self, data):
+        "load a single frame payload"
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.name)
+
+
+class PickleSerializer(Serializer):
+    name = 'pickle'
+
+    def __init__(self, protocol = PICKLE_PROTOCOL):
+        self.protocol = protocol
+
+    def encode(self, obj):
+        return encode_object(obj, self.protocol)
+
+    def decode(self, reader):
+        #handles the out-of-band buffer frames
+        return reader.load()
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+###############################################################################
+# Raw NumPy arrays
+ARRAY_HEADER = struct.Struct('!BB') #number of dimensions, length of the dtype string
+
+def _array_header(arr):
+    dtype = arr.dtype.str.encode('ascii')
+    return ARRAY_HEADER.pack(arr.ndim, len(dtype)) + dtype + struct.pack('!%dQ' % arr.ndim, *arr.shape)
+
+def _array_from_buffer(data):
+    "get an array viewing the buffer, which holds a header followed by the raw data"
+    ndim, dtype_size = ARRAY_HEADER.unpack_from(data)
+    offset = ARRAY_HEADER.size
+    dtype  = np.dtype(bytes(data[offset:offset + dtype_size]).decode('ascii'))
+    offset += dtype_size
+    shape = struct.unpack_from('!%dQ' % ndim, data, offset)
+    offset += 8*ndim
+    return np.frombuffer(data, dtype = dtype, offset = offset).reshape(shape)
+
+def _array_buffers(arr):
+    "get the header and the raw data of the array, which is only copied if not contiguous"
+    if arr.dtype.hasobject:
+        raise TypeError("arrays of python objects can not be sent raw")
+    arr = np.ascontiguousarray(arr)
+    return (_array_header(arr), arr.reshape(-1).view(np.uint8).data)
+
+
+class NumpyRawSerializer(Serializer):
+    """Sends NumPy arrays (only) as a dtype/shape header and the raw array
+       data, which is received directly into the memory of the new array
+    """
+    name = 'numpy'
+    sends_events = False
+
+    def encode(self, obj):
+        if not isinstance(obj, np.ndarray):
+            raise TypeError("the 'numpy' serializer only sends arrays, not %r" % type(obj))
+        header, data = _array_buffers(obj)
+        return [FRAME_HEADER.pack(len(header) + data.nbytes), header, data]
+
+    def decode(self, reader):
+        return _array_from_buffer(reader.read_frame_into_new())
+
+    def dumps(self, obj):
+        return b"".join(self.encode(obj)[1:])
+
+    def loads(self, data):
+        return _array_from_buffer(bytearray(data))
+
+###############################################################################
+# msgpack
+EXT_TUPLE   = 1
+EXT_NDARRAY = 2
+
+def _msgpack_default(obj):
+    "convert the types msgpack doesn't handle natively"
+    if isinstance(obj, tuple):
+        return msgpack.ExtType(EXT_TUPLE, _msgpack_dumps(list(obj)))
+    if not np is None:
+        if isinstance(obj, np.ndarray):
+            header, data = _array_buffers(obj)
+            return msgpack.ExtType(EXT_NDARRAY, header + bytes(data))
+        if isinstance(obj, np.generic):
+            return obj.item()
+    #subclasses of the native types, e.g. OrderedDict
+    for base in (dict, list, str, bytes, float, int):
+        if isinstance(obj, base):
+            return base(obj)
+    raise TypeError("can not serialize %r with msgpack" % type(obj))
+
+def _msgpack_ext_hook(code, data):
+    if code == EXT_TUPLE:
+        return tuple(_msgpack_loads(data))
+    if code == EXT_NDARRAY and not np is None:
+        return _array_from_buffer(bytearray(data))
+    return msgpack.ExtType(code, data)
+
+_msgpack_packers = [] #idle Packers, creating one costs more than packing a small event
+
+def _msgpack_dumps(obj):
+    #a Packer can't be reentered, as it is when packing a nested tuple, so each call takes its own
+    try:
+        packer = _msgpack_packers.pop()
+    except IndexError:
+        #strict types, so that tuples aren't packed as lists
+        packer = msgpack.Packer(default = _msgpack_default, use_bin_type = True, strict_types = True)
+    try:
+        return packer.pack(obj)
+    finally:
+        _msgpack_packers.append(packer)
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, ext_hook = _msgpack_ext_hook, raw = False, strict_map_key = False)
+
+
+class MsgpackSerializer(Serializer):
+    name = 'msgpack'
+
+    def dumps(self, obj):
+        return _msgpack_dumps(obj)
+
+    def loads(self, data):
+        return _msgpack_loads(data)
+
+###############################################################################
+# Registry
+SERIALIZERS = OrderedDict() #name -> Serializer, in order of preference
+
+def register_serializer(serializer):
+    SERIALIZERS[serializer.name] = serializer
+
+def get_serializer(name):
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise SerializerError("unknown serializer %r, available: %r" % (name, list(SERIALIZERS.keys())))
+
+def get_serializer_names():
+    return list(SERIALIZERS.keys())
+
+def get_event_serializer_names(accepted = None):
+    "get the names of the serializers which can send events, of those 'accepted' (None is all)"
+    return [name for name, serializer in SERIALIZERS.items()
+            if serializer.sends_events and (accepted is None or name in accepted)]
+
+if not msgpack is None:
+    register_serializer(MsgpackSerializer())
+if not np is None:
+    register_serializer(NumpyRawSerializer())
+register_serializer(PickleSerializer())
+
+DEFAULT_SERIALIZER = SERIALIZERS['pickle']
+
+###############################################################################
+# Negotiation
+def make_hello(names):
+    "get the frame payload offering (or, from the server, choosing) serializers"
+    return HELLO_MAGIC + ",".join(names).encode('ascii')
+
+def parse_hello(data):
+    "get the list of serializer names in a hello payload, None if it isn't one"
+    data = bytes(data)
+    if not data.startswith(HELLO_MAGIC):
+        return None
+    names = data[len(HELLO_MAGIC):].decode('ascii')
+    return [name for name in names.split(",") if name]
+
+def choose_serializer(offered, accepted = None):
+    "get the name of the first offered serializer which is accepted and available, None if there is none"
+    if accepted is None:
+        accepted = get_serializer_names()
+    for name in offered:
+        if name in accepted and name in SERIALIZERS:
+            return name
+    return None
+
+def request_serializer(sock, names, reader = None):
+    """client side negotiation over a newly connected socket, returns the
+       Serializer the server chose, use the same 'reader' for later reads
+    """
+    hello = make_hello(names)
+    send_buffers(sock, [FRAME_HEADER.pack(len(hello)), hello])
+    if reader is None:
+        reader = FrameReader(sock, buffer_size = 4096)
+    chosen = parse_hello(reader.read_frame_view())
+    if chosen is None:
+        raise SerializerError("server did not reply to the serializer negotiation")
+    if not chosen:
+        raise SerializerError("server accepts none of the serializers %r" % (list(names),))
+    return get_serializer(chosen[0])
+
+def reply_serializer(sock, offered, accepted = None):
+    """server side negotiation, given the names from the client's hello,
+       returns the chosen Serializer
+    """
+    name  = choose_serializer(offered, accepted)
+    reply = make_hello([name] if name else [])
+    send_buffers(sock, [FRAME_HEADER.pack(len(reply)), reply])
+    if name is None:
+        raise SerializerError("accepts none of the offered serializers %r" % (offered,))
+    return get_serializer(name)
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    import time
+    #benchmark the serializers on typical events
+    NUM_EVENTS = 20000
+    EVENTS = {
+        'reading': ('TEMPERATURE_READING', {'timestamp': 1700000000.123, 'value': 23.456, 'channel': 3}),
+        'status' : ('DEVICE_STATUS', {'timestamp': 1700000000.123, 'name': 'motor1', 'state': 'moving', 'position': [1.5, 2.5, 3.5]}),
+        'nested' : ('SAMPLE', {'timestamp': 1700000000.123, 'values': dict(('ch%d' % i, 0.1*i) for i in range(16))}),
+    }
+    if not np is None:
+        EVENTS['array'] = ('SPECTRUM', {'timestamp': 1700000000.123, 'data': np.linspace(0.0, 1.0, 4096)})
+        EVENTS['raw array'] = np.linspace(0.0, 1.0, 2**20)
+    print("%-10s %-10s %10s %12s %12s" % ('event', 'serializer', 'bytes', 'encode (us)', 'decode (us)'))
+    for event_name, event in EVENTS.items():
+        count = NUM_EVENTS if event_name != 'raw array' else 100
+        for name, serializer in SERIALIZERS.items():
+            try:
+                data = serializer.dumps(event)
+            except TypeError:
+                continue
+            t0 = time.perf_counter()
+            for i in range(count):
+                serializer.encode(event)
+            t1 = time.perf_counter()
+            for i in range(count):
+                serializer.loads(data)
+            t2 = time.perf_counter()
+            print("%-10s %-10s %10d %12.2f %12.2f" % (event_name, name, len(data), 1e6*(t1 - t0)/count, 1e6*(t2 - t1)/count))
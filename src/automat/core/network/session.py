@@ -0,0 +1,335 @@
+""" persistent, multiplexed request/response sessions over a PickleSocket
+
+    Any number of threads may have requests outstanding on one session, each
+    request is tagged with an id which the server echoes in its response:
+        client -> server:  ('REQUEST', request_id, payload)
+        server -> client:  ('RESPONSE', request_id, result)
+                           ('ERROR', request_id, (exc_type_name, message, traceback_text))
+    Any other message is one-way, as sent by the original 'ClientController'.
+"""
+###############################################################################
+import socket, threading, itertools, traceback, time
+from queue import Queue
+from concurrent.futures import Future, TimeoutError
+from automat.core.network.pickle_socket import PickleSocket
+
+REQUEST  = 'REQUEST'
+RESPONSE = 'RESPONSE'
+ERROR    = 'ERROR'
+
+DEFAULT_POOL_SIZE       = 4
+DEFAULT_CONNECT_TIMEOUT = 5.0
+REFUSED_BACKOFF         = 1.0 #seconds a pool makes do with its open sessions after one was refused
+
+###############################################################################
+class RemoteError(Exception):
+    "an exception raised by the server while handling a request"
+    def __init__(self, exc_type_name, msg, traceback_text = ""):
+        Exception.__init__(self, exc_type_name, msg, traceback_text)
+        self.exc_type_name  = exc_type_name
+        self.msg            = msg
+        self.traceback_text = traceback_text
+
+    def __str__(self):
+        return "%s: %s\nremote traceback:\n%s" % (self.exc_type_name, self.msg, self.traceback_text)
+
+class SessionClosed(ConnectionError):
+    pass
+
+###############################################################################
+def is_request(msg):
+    return isinstance(msg, tuple) and len(msg) == 3 and msg[0] == REQUEST
+
+def make_response(request_id, result):
+    return (RESPONSE, request_id, result)
+
+def make_error(request_id, exc):
+    "describe the exception, which may not be picklable, for the client to raise as a RemoteError"
+    traceback_text = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+    return (ERROR, request_id, (exc.__class__.__name__, str(exc), traceback_text))
+
+def set_nodelay(sock):
+    "send small requests and responses at once, a round trip must not wait on Nagle's algorithm"
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError): #not a TCP socket
+        pass
+
+###############################################################################
+class ClientSession(object):
+    """A persistent connection to a NetworkedController, responses are read
+       by a daemon thread and delivered to the Future of their request
+    """
+    def __init__(self, address, timeout = DEFAULT_CONNECT_TIMEOUT, serializers = None):
+        self.address = address
+        pickle_socket = PickleSocket(timeout = timeout, serializers = serializers)
+        pickle_socket.connect(address)
+        pickle_socket.settimeout(None) #the reader thread blocks until the connection closes
+        set_nodelay(pickle_socket.sock)
+        self._pickle_socket = pickle_socket
+        self._send_lock   = threading.Lock()
+        self._pending     = {} #request id -> Future
+        self._request_ids = itertools.count()
+        self._closed      = False
+        self._replied     = False #set on the first response, the server is serving the session
+        self.message_queue = Queue() #messages which are not responses
+        self._reader_thread = threading.Thread(target = self._read_responses)
+        self._reader_thread.daemon = True
+        self._reader_thread.start()
+
+    def is_alive(self):
+        return not self._closed
+
+    def get_pending_count(self):
+        return len(self._pending)
+
+    def has_replied(self):
+        return self._replied
+
+    def abandon(self, request_id):
+        "give up on a request, a late response is dropped"
+        self._pending.pop(request_id, None)
+
+    def send(self, msg):
+        "send a one-way message"
+        self._send_many((msg,))
+
+    def request_async(self, payload):
+        "send a request, returns a Future for the response"
+        future     = Future()
+        request_id = future.request_id = next(self._request_ids)
+        future.session = self
+        self._pending[request_id] = future
+        try:
+            self._send_many(((REQUEST, request_id, payload),))
+        except Exception:
+            self._pending.pop(request_id, None)
+            raise
+        return future
+
+    def request(self, payload, timeout = None):
+        """send a request and wait for the response, raises RemoteError if the
+           server failed, or TimeoutError
+        """
+        future = self.request_async(payload)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            self.abandon(future.request_id)
+            raise
+
+    def request_many_async(self, payloads):
+        "pipeline a batch of requests in one write, returns their Futures in order"
+        futures  = []
+        requests = []
+        for payload in payloads:
+            future     = Future()
+            request_id = future.request_id = next(self._request_ids)
+            future.session = self
+            self._pending[request_id] = future
+            futures.append(future)
+            requests.append((REQUEST, request_id, payload))
+        try:
+            self._send_many(requests)
+        except Exception:
+            for request in requests:
+                self._pending.pop(request[1], None)
+            raise
+        return futures
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._pickle_socket.sock.shutdown(socket.SHUT_RDWR) #wakes the reader thread
+        except OSError:
+            pass
+        self._pickle_socket.close()
+        self._fail_pending(SessionClosed("session to %s closed" % (self.address,)))
+
+    def _send_many(self, msgs):
+        if self._closed:
+            raise SessionClosed("session to %s closed" % (self.address,))
+        try:
+            with self._send_lock:
+                self._pickle_socket.dump_many(msgs)
+        except OSError:
+            self.close()
+            raise
+
+    def _read_responses(self):
+        pending = self._pending
+        try:
+            for msg in self._pickle_socket:
+                if isinstance(msg, tuple) and len(msg) == 3 and msg[0] in (RESPONSE, ERROR):
+                    msg_type, request_id, content = msg
+                    self._replied = True
+                    future = pending.pop(request_id, None)
+                    if future is None or future.cancelled(): #the request was given up on
+                        continue
+                    if msg_type == RESPONSE:
+                        future.set_result(content)
+                    else:
+                        future.set_exception(RemoteError(*content))
+                else:
+                    self.message_queue.put(msg)
+        except (OSError, ValueError): #connection dropped or closed
+            pass
+        self.close()
+
+    def _fail_pending(self, exc):
+        pending = self._pending
+        while pending:
+            try:
+                request_id, future = pending.popitem()
+            except KeyError: #emptied by the reader thread
+                break
+            if not future.done():
+                future.set_exception(exc)
+
+    def __repr__(self):
+        return "<ClientSession to %s, %d pending%s>" % (self.address, len(self._pending), "" if self.is_alive() else ", closed")
+
+###############################################################################
+class SessionPool(object):
+    """Up to 'size' sessions to one server, a new session is only opened when
+       all the others have requests outstanding, closed sessions are replaced.
+
+       The server may refuse a new session when it is at its connection
+       limit, then the requests are sent over the open sessions instead: if
+       the new session can't be opened, or closes before its first response,
+       its requests are retried on another open session, and no new session
+       is tried for 'REFUSED_BACKOFF' seconds. One-way messages
+       are sent over an open session if there is one, and never retried.
+    """
+    def __init__(self, address, size = DEFAULT_POOL_SIZE, timeout = DEFAULT_CONNECT_TIMEOUT, serializers = None):
+        self.address     = address
+        self.size        = size
+        self.timeout     = timeout
+        self.serializers = serializers
+        self._sessions   = []
+        self._lock       = threading.Lock()
+        self._refused_time = None
+
+    def get_session(self):
+        "get the least busy open session"
+        return self._get_session()[0]
+
+    def _get_session(self):
+        "returns (session, is_new), a new session is opened if all are busy"
+        with self._lock:
+            self._sessions = sessions = [session for session in self._sessions if session.is_alive()]
+            session = None
+            if sessions:
+                session = min(sessions, key = ClientSession.get_pending_count)
+            backing_off = not self._refused_time is None and time.time() - self._refused_time < REFUSED_BACKOFF
+            if session is None or (session.get_pending_count() > 0 and len(sessions) < self.size and not backing_off):
+                try:
+                    new_session = ClientSession(self.address, timeout = self.timeout, serializers = self.serializers)
+                except OSError:
+                    if session is None:
+                        raise
+                    self._refused_time = time.time()
+                    return (session, False) #make do with the open sessions
+                sessions.append(new_session)
+                return (new_session, True)
+            return (session, False)
+
+    def _get_open_session(self, exclude = None):
+        "get the least busy open session other than 'exclude', None if there is none"
+        with self._lock:
+            sessions = [session for session in self._sessions if session.is_alive() and not session is exclude]
+        if not sessions:
+            return None
+        return min(sessions, key = ClientSession.get_pending_count)
+
+    def send(self, msg):
+        session = self._get_open_session()
+        if session is None:
+            session = self.get_session()
+        session.send(msg)
+
+    def request_async(self, payload):
+        return self.request_many_async((payload,))[0]
+
+    def request(self, payload, timeout = None):
+        future = self.request_async(payload)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.session.abandon(future.request_id)
+            raise
+
+    def request_many_async(self, payloads):
+        payloads = list(payloads)
+        session, is_new = self._get_session()
+        if not is_new:
+            return session.request_many_async(payloads)
+        try:
+            futures = session.request_many_async(payloads)
+        except OSError: #includes SessionClosed, refused straight away
+            self._refused_time = time.time()
+            fallback = self._get_open_session(exclude = session)
+            if fallback is None:
+                raise
+            return fallback.request_many_async(payloads)
+        return [self._retry_if_refused(future, payload) for future, payload in zip(futures, payloads)]
+
+    def _retry_if_refused(self, future, payload):
+        """get a Future for the result of the request, which is retried on
+           another session if its new session closes before replying
+        """
+        session = future.session
+        result  = Future()
+        result.session    = session
+        result.request_id = future.request_id
+
+        def copy_outcome(future):
+            if future.cancelled():
+                result.cancel()
+            elif future.exception() is None:
+                result.set_result(future.result())
+            else:
+                result.set_exception(future.exception())
+
+        def on_done(future):
+            if not future.cancelled() and isinstance(future.exception(), SessionClosed) and not session.has_replied():
+                self._refused_time = time.time()
+                fallback = self._get_open_session(exclude = session)
+                if not fallback is None:
+                    try:
+                        retry = fallback.request_async(payload)
+                    except OSError:
+                        pass
+                    else:
+                        result.session    = fallback
+                        result.request_id = retry.request_id
+                        retry.add_done_callback(copy_outcome)
+                        return
+            copy_outcome(future)
+        future.add_done_callback(on_done)
+        return result
+
+    def close(self):
+        with self._lock:
+            sessions = self._sessions
+            self._sessions = []
+        for session in sessions:
+            session.close()
+
+    def __len__(self):
+        return len(self._sessions)
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    import sys
+    host, port = sys.argv[1], int(sys.argv[2])
+    session = ClientSession((host, port))
+    t0 = time.time()
+    for i in range(1000):
+        session.request(('PING', i))
+    print("round trip: %0.1f us" % (1e3*(time.time() - t0)))
+    session.close()
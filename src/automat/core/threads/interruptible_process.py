@@ -0,0 +1,241 @@
+""" run a target in a child process, with the interface of InterruptibleThread
+
+    The child is forked, so the target (e.g. a controller's bound 'main'
+    method, with its devices) need not be picklable. It gets its own stop and
+    abort events, which are set when the parent's are, through a control pipe,
+    and an event queue whose items are sent back through an event pipe and put
+    on the parent's queue by a supervisor thread. The child is aborted if the
+    parent goes away.
+"""
+###############################################################################
+import os, threading, multiprocessing, traceback
+from automat.core.threads.interruptible_thread import AbortInterrupt
+from automat.core.threads.selectable import SelectableEvent, wait_any
+
+DEFAULT_START_METHOD = 'fork'
+
+#control messages, parent -> child
+STOP  = 'STOP'
+ABORT = 'ABORT'
+#the last item sent by the child, with the error text if the target failed
+PROCESS_EXIT = '__PROCESS_EXIT__'
+
+###############################################################################
+class _EventPipeWriter(object):
+    "the child's event queue, 'put' sends the item to the parent"
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock() #many threads may send events
+
+    def put(self, item, block = True, timeout = None):
+        with self._lock:
+            self._conn.send(item)
+
+    put_nowait = put
+
+###############################################################################
+class InterruptibleProcess(object):
+    """Runs 'target' in a child process, the events put on the child's queue
+       are forwarded to 'event_queue', setting the stop or abort event in the
+       parent sets it in the child. 'child_init(event_queue, stop_event,
+       abort_event)' is called in the child before the target, to hand the
+       child's queue and events to the objects which use them.
+    """
+    def __init__(self,
+                 target,
+                 stop_event   = None,   #to synchronize controlled exit
+                 abort_event  = None,   #to synchronize forced exit
+                 event_queue  = None,   #to pass back the child's events
+                 child_init   = None,
+                 name         = None,
+                 start_method = DEFAULT_START_METHOD,
+                ):
+        self._target     = target
+        self._child_init = child_init
+        self.name        = name
+        if stop_event is None:
+            stop_event  = SelectableEvent()
+        self.stop_event  = stop_event
+        if abort_event is None:
+            abort_event  = SelectableEvent()
+        self.abort_event = abort_event
+        self.event_queue = event_queue
+        self.daemon      = False
+        self.error       = None #the traceback text if the target failed in the child
+        self._context    = multiprocessing.get_context(start_method)
+        self._process    = None
+        self._supervisor = None
+        self._parent_pid = None
+
+    #--------------------------------------------------------------------------
+    # parent side
+    def start(self):
+        if not self._process is None:
+            raise RuntimeError("processes can only be started once")
+        context = self._context
+        self._control_recv, self._control_send = context.Pipe(duplex = False)
+        self._event_recv,   self._event_send   = context.Pipe(duplex = False)
+        self._parent_pid = os.getpid()
+        self._process = context.Process(target = self._child_main, name = self.name)
+        self._process.daemon = self.daemon
+        self._process.start()
+        #the child's ends
+        self._control_recv.close()
+        self._event_send.close()
+        self._supervisor = threading.Thread(target = self._supervise, name = "process-supervisor")
+        self._supervisor.daemon = True
+        self._supervisor.start()
+
+    def run(self):
+        "run the target in the child process and block until it completes"
+        self.start()
+        self.join()
+
+    def join(self, timeout = None):
+        "join the child process, and wait until all its events are forwarded"
+        if self._process is None:
+            raise RuntimeError("cannot join process before it is started")
+        if not self._is_parent(): #an inherited copy, in another forked child
+            return
+        self._process.join(timeout)
+        if not self._process.is_alive():
+            self._supervisor.join(timeout)
+
+    def is_alive(self):
+        return not self._process is None and self._is_parent() and self._process.is_alive()
+
+    isAlive = is_alive #called by 'Controller.thread_isAlive'
+
+    def _is_parent(self):
+        return self._parent_pid == os.getpid()
+
+    @property
+    def pid(self):
+        return None if self._process is None else self._process.pid
+
+    @property
+    def exitcode(self):
+        return None if self._process is None else self._process.exitcode
+
+    def terminate(self):
+        "kill the child, when it doesn't respond to the abort event"
+        if not self._process is None and self._is_parent():
+            self._process.terminate()
+
+    def _supervise(self):
+        "forward the child's events, and the stop and abort events to the child"
+        event_recv = self._event_recv
+        signals = [(self.abort_event, ABORT), (self.stop_event, STOP)]
+        try:
+            while True:
+                sources = [event for event, msg in signals] + [event_recv]
+                ready = wait_any(*sources)
+                for event, msg in list(signals):
+                    if event in ready:
+                        signals.remove((event, msg))
+                        try:
+                            self._control_send.send(msg)
+                        except OSError: #the child has exited
+                            pass
+                if event_recv in ready:
+                    while event_recv.poll():
+                        item = event_recv.recv()
+                        if isinstance(item, tuple) and len(item) == 2 and item[0] == PROCESS_EXIT:
+                            self.error = item[1]
+                        elif not self.event_queue is None:
+                            self.event_queue.put(item)
+        except EOFError: #the child has exited and all its events have been read
+            pass
+        finally:
+            event_recv.close()
+            self._control_send.close()
+
+    #--------------------------------------------------------------------------
+    # child side
+    def _child_main(self):
+        self._control_send.close()
+        self._event_recv.close()
+        #fresh events for the child, set through the control pipe
+        self.stop_event  = SelectableEvent()
+        self.abort_event = SelectableEvent()
+        self.event_queue = _EventPipeWriter(self._event_send)
+        listener = threading.Thread(target = self._listen_control, name = "process-control")
+        listener.daemon = True
+        listener.start()
+        error = None
+        try:
+            if not self._child_init is None:
+                self._child_init(self.event_queue, self.stop_event, self.abort_event)
+            self._target()
+        except BaseException:
+            error = traceback.format_exc()
+            traceback.print_exc()
+        finally:
+            self.event_queue.put((PROCESS_EXIT, error))
+            self._event_send.close()
+
+    def _listen_control(self):
+        try:
+            while True:
+                msg = self._control_recv.recv()
+                if msg == STOP:
+                    self.stop_event.set()
+                elif msg == ABORT:
+                    self.abort_event.set()
+        except (EOFError, OSError): #the parent has gone away
+            self.abort_event.set()
+
+    #--------------------------------------------------------------------------
+    # same as InterruptibleThread, the events are the child's within the target
+    def sleep(self, time):
+        self.abort_event.wait(time)
+
+    def wait_any(self, *sources, timeout = None):
+        """block until any of the sources (see 'selectable.wait_any'), the
+           stop event or the abort event is ready, returns the ready sources,
+           raises AbortInterrupt if the abort event was set
+        """
+        ready = wait_any(self.abort_event, self.stop_event, *sources, timeout = timeout)
+        if ready and ready[0] is self.abort_event:
+            raise AbortInterrupt("user requested abort")
+        return ready
+
+    def abort(self):
+        """ signals the process to abort
+        """
+        self.abort_event.set()
+
+    def shutdown(self):
+        self.stop_event.set()
+        self.join()
+
+    def abort_breakout_point(self):
+        if self.check_abort_event():
+            raise AbortInterrupt("user requested abort")
+
+    def check_abort_event(self):
+        "use in the target to mark forced exit points"
+        return self.abort_event.isSet()
+
+    def check_stop_event(self):
+        "use in the target to mark controlled exit points"
+        return self.stop_event.isSet()
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    import queue, time
+    events = queue.Queue()
+    process = None
+    def count():
+        i = 0
+        while not process.check_stop_event():
+            process.event_queue.put(('COUNT', {'pid': os.getpid(), 'i': i}))
+            i += 1
+            process.sleep(0.1)
+    process = InterruptibleProcess(target = count, event_queue = events)
+    process.start()
+    time.sleep(0.5)
+    process.shutdown()
+    print("forwarded %d events, first: %r" % (events.qsize(), events.get()))
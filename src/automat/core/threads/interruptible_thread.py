@@ -1,6 +1,7 @@
 ###############################################################################
-from threading import Thread, Event
+from threading import Thread
 import signal
+from automat.core.threads.selectable import SelectableEvent, wait_any
 ###############################################################################
 
 class AbortInterrupt(Exception):
@@ -30,13 +31,13 @@ class InterruptibleThread(Thread):
                 ):
         #configure the thread
         Thread.__init__(self, **kwargs)
-        #enable controlled exit
+        #enable controlled exit, selectable so that 'wait_any' can wake on it
         if stop_event is None:
-            stop_event  = Event()
+            stop_event  = SelectableEvent()
         self.stop_event = stop_event        
         #enable forced exit
         if abort_event is None:
-            abort_event  = Event()
+            abort_event  = SelectableEvent()
         self.abort_event = abort_event
     
     def join(self,timeout=None):
@@ -46,6 +47,16 @@ class InterruptibleThread(Thread):
 
     def sleep(self, time):
         self.abort_event.wait(time)
+
+    def wait_any(self, *sources, timeout = None):
+        """block until any of the sources (see 'selectable.wait_any'), the
+           stop event or the abort event is ready, returns the ready sources,
+           raises AbortInterrupt if the abort event was set
+        """
+        ready = wait_any(self.abort_event, self.stop_event, *sources, timeout = timeout)
+        if ready and ready[0] is self.abort_event:
+            raise AbortInterrupt("user requested abort")
+        return ready
         
     def abort(self):
         """ signals the thread to abort
@@ -1,18 +1,244 @@
-""" interface for lockfile implementation of system wide mutex (inter-process 
+""" interface for lockfile implementation of system wide mutex (inter-process
     and inter-thread)
+
+    Within a process, the Mutex objects for one lockfile share a thread lock,
+    which a thread must hold before it takes the (per-process) file lock.
+    Both are waited on by blocking, not by polling: an untimed acquire blocks
+    in 'fcntl.lockf', a timed one hands the blocking call to a helper thread
+    and waits on it for the remaining time. The owning thread may acquire
+    the mutex again (reentrancy), it is freed by the matching last release.
+
+    An RWMutex may also be held shared, by any number of threads and
+    processes at once, e.g. for read-only status polling, while 'acquire'
+    stays exclusive. Waiting exclusive acquisitions hold off new shared ones,
+    so that the controller which owns a device isn't starved by the polling.
+    A 'fair' mutex is granted to the threads of the process in order of
+    arrival, the file lock between processes is granted by the OS in any order.
 """
 ###############################################################################
-import os, fcntl, threading, tempfile, time, pwd, grp, getpass
+import os, fcntl, threading, tempfile, time, pwd, grp, getpass, contextlib
+from collections import deque
 
 DEFAULT_PATH = tempfile.gettempdir()
-SLEEP_TIME = 0.01
 LOCKFILE_SUBDIR = "Automat"
 LOCKFILE_PREFIX = "AUTOMAT_MUTEX"
 
+###############################################################################
+class _RWLock(object):
+    """An in-process lock which is held either exclusively by one thread or
+       shared by many, the exclusive 'acquire' and 'release' have the
+       interface of 'threading.Lock'. When 'fair' the lock is granted in order
+       of arrival, consecutive shared requests are granted together.
+    """
+    def __init__(self, fair = False):
+        self.fair = fair
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer  = False
+        self._waiting_writers = 0
+        self._queue = deque() #tickets of the waiting threads in order, when fair
+
+    def _can_write(self, ticket):
+        if self._writer or self._readers:
+            return False
+        return not self.fair or self._queue[0] is ticket
+
+    def _can_read(self, ticket):
+        if self._writer:
+            return False
+        if self.fair:
+            return self._queue[0] is ticket
+        return not self._waiting_writers #writers go first
+
+    def _acquire(self, shared, blocking, timeout):
+        can_acquire = self._can_read if shared else self._can_write
+        with self._cond:
+            ticket = None
+            if self.fair:
+                ticket = object()
+                self._queue.append(ticket)
+            if not shared:
+                self._waiting_writers += 1
+            acquired = False
+            try:
+                if blocking:
+                    deadline = None if timeout < 0 else time.monotonic() + timeout
+                    while not can_acquire(ticket):
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if not remaining is None and remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                acquired = can_acquire(ticket)
+                if acquired:
+                    if shared:
+                        self._readers += 1
+                    else:
+                        self._writer = True
+                return acquired
+            finally:
+                if self.fair:
+                    self._queue.remove(ticket) #the head, unless it timed out
+                if not shared:
+                    self._waiting_writers -= 1
+                if self.fair or not acquired: #the next in line may go ahead
+                    self._cond.notify_all()
+
+    def acquire(self, blocking = True, timeout = -1):
+        return self._acquire(False, blocking, timeout)
+
+    def release(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    def acquire_shared(self, blocking = True, timeout = -1):
+        return self._acquire(True, blocking, timeout)
+
+    def release_shared(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+###############################################################################
+class _FileLockWaiter(object):
+    "blocks on the file lock in a helper thread, so that the caller can time out"
+    def __init__(self, state, operation):
+        self.state     = state
+        self.operation = operation #LOCK_EX or LOCK_SH
+        self.acquired  = threading.Event()
+        self.done      = threading.Event()
+        self.abandoned = False
+        thread = threading.Thread(target = self._run, name = "mutex-waiter")
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        state = self.state
+        try:
+            fcntl.lockf(state.lockfile, self.operation) #blocks
+            with state.guard:
+                state.file_waiter = None
+                if self.abandoned: #the caller timed out, and nobody has taken over the wait
+                    fcntl.lockf(state.lockfile, fcntl.LOCK_UN)
+                    return
+                self.acquired.set()
+        finally:
+            self.done.set()
+
+###############################################################################
+class _MutexState(object):
+    "shared by the Mutex objects for one lockfile within the process"
+    def __init__(self, lockfile_name, rw = False, fair = False):
+        self.lockfile_name = lockfile_name
+        self.lockfile      = None
+        if rw or fair:
+            self.threadlock = _RWLock(fair = fair)
+        else:
+            self.threadlock = threading.Lock()
+        self.guard         = threading.Lock() #protects 'file_waiter' and the shared statistics
+        self.file_waiter   = None
+        self.file_contended = False #the last 'lock_file' had to wait
+        self.owner         = None #ident of the owning thread
+        self.count         = 0    #reentrant acquisitions by the owner
+        self.acquired_time = None
+        self.shared_gate    = threading.Lock() #serializes taking the shared file lock
+        self.shared_holders = 0  #threads holding the mutex shared
+        self.shared_counts  = {} #thread ident -> reentrant shared acquisitions
+        #contention statistics
+        self.stats = {'acquisitions': 0,   #outermost acquisitions
+                      'contended'   : 0,   #acquisitions which had to wait
+                      'timeouts'    : 0,
+                      'wait_time'   : 0.0, #total seconds spent waiting
+                      'max_wait'    : 0.0,
+                      'hold_time'   : 0.0, #total seconds held
+                      'max_hold'    : 0.0,
+                      'shared_acquisitions': 0,
+                      'shared_wait_time'   : 0.0,
+                      'shared_max_wait'    : 0.0,
+                     }
+
+    def open_lockfile(self):
+        if self.lockfile is None:
+            #readable for shared locks, not truncated while someone holds the lock
+            self.lockfile = open(self.lockfile_name,'a+')
+#            #FIXME change the permissions and change the group
+#            uid = os.getuid()
+#            gid = grp.getgrnam("automat").gr_gid
+#            os.chown(self._lockfile_name, uid, gid)
+#            os.chmod(self._lockfile_name, 0o777) #FIXME this may be insecure
+
+    def lock_file(self, timeout, shared = False):
+        """take the file lock, the thread lock (or the shared gate) must be
+           held, returns False on timeout
+        """
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        self.file_contended = True
+        with self.guard:
+            #take over the wait of a previous caller which timed out, the
+            #process can't lock the file again while it is still blocked
+            waiter = self.file_waiter
+            if not waiter is None and waiter.operation == operation:
+                waiter.abandoned = False
+        if not waiter is None and waiter.operation != operation:
+            #a wait for the other kind of lock, it must give up the lock first
+            t0 = time.time()
+            if not waiter.done.wait(timeout):
+                return False
+            if not timeout is None:
+                timeout = max(0.0, timeout - (time.time() - t0))
+            waiter = None
+        if waiter is None:
+            try:
+                fcntl.lockf(self.lockfile, operation | fcntl.LOCK_NB)
+                self.file_contended = False
+                return True
+            except IOError: #someone else has the lock
+                pass
+            if timeout is None:
+                fcntl.lockf(self.lockfile, operation)
+                return True
+            with self.guard:
+                waiter = self.file_waiter = _FileLockWaiter(self, operation)
+        if waiter.acquired.wait(timeout):
+            return True
+        with self.guard:
+            if waiter.acquired.is_set(): #acquired just in time
+                return True
+            waiter.abandoned = True
+        return False
+
+    def lock_shared_file(self, timeout):
+        "the first thread to hold the mutex shared takes the shared file lock for the process"
+        if not self.shared_gate.acquire(timeout = -1 if timeout is None else timeout):
+            return False
+        try:
+            if self.shared_holders == 0:
+                self.open_lockfile()
+                if not self.lock_file(timeout, shared = True):
+                    return False
+            self.shared_holders += 1
+            return True
+        finally:
+            self.shared_gate.release()
+
+    def unlock_shared_file(self):
+        with self.shared_gate:
+            self.shared_holders -= 1
+            if self.shared_holders == 0:
+                fcntl.lockf(self.lockfile, fcntl.LOCK_UN)
+
 ###############################################################################
 class Mutex(object):
-    _threadlocks = {} #cache thread locks by name
-    def __init__(self, name, path = DEFAULT_PATH, default_timeout = None):
+    """An exclusive, reentrant mutex between the threads and processes
+       which use the same 'name', with 'fair' the waiting threads of the
+       process acquire it in order (the first Mutex created for a name in
+       the process decides)
+    """
+    _states = {} #shared state by lockfile name
+    _states_lock = threading.Lock()
+    rw = False
+    def __init__(self, name, path = DEFAULT_PATH, default_timeout = None, fair = False):
         self.name = name
         self.path = path
         self.default_timeout = default_timeout
@@ -20,80 +246,248 @@ class Mutex(object):
         subdirname = "%s_%s" % (LOCKFILE_SUBDIR, username)
         self._lockfile_subdir = os.sep.join((path,subdirname))
         if not os.path.exists(self._lockfile_subdir):
-            os.mkdir(self._lockfile_subdir)
+            os.makedirs(self._lockfile_subdir, exist_ok = True)
             #FIXME change the permissions and change the group
 #            uid = os.getuid()
 #            gid = grp.getgrnam("automat").gr_gid
 #            os.chown(self._lockfile_subdir, uid, gid)
 #            os.chmod(self._lockfile_subdir, 0o777) #FIXME this may be insecure
-            
+
         fname = "%s_%s" % (LOCKFILE_PREFIX, name)
-        self._lockfile_name = os.sep.join((self._lockfile_subdir,fname)) 
-        self._lockfile = None
-        threadlock = Mutex._threadlocks.get(name)
-        if threadlock is None: #unique name
-            Mutex._threadlocks[name] = threadlock = threading.Lock()
-        self._threadlock = threadlock
+        self._lockfile_name = os.sep.join((self._lockfile_subdir,fname))
+        with Mutex._states_lock:
+            state = Mutex._states.get(self._lockfile_name)
+            if state is None: #unique lockfile
+                state = _MutexState(self._lockfile_name, rw = self.rw, fair = fair)
+                Mutex._states[self._lockfile_name] = state
+        if self.rw and not isinstance(state.threadlock, _RWLock):
+            raise ValueError("the mutex '%s' is already used as an exclusive Mutex in this process" % name)
+        self._state = state
 
     def acquire(self, timeout = None):
         if timeout is None:
             timeout = self.default_timeout
-        if self._lockfile is None:
-            self._lockfile = open(self._lockfile_name,'w')
-#            #FIXME change the permissions and change the group
-#            uid = os.getuid()
-#            gid = grp.getgrnam("automat").gr_gid
-#            os.chown(self._lockfile_name, uid, gid)
-#            os.chmod(self._lockfile_name, 0o777) #FIXME this may be insecure
-        has_threadlock = False
+        state = self._state
+        me = threading.get_ident()
+        if state.owner == me: #reentrant
+            state.count += 1
+            return
         t0 = time.time()
-        while True:
-            try:
-                #first try acquiring the thread lock (within one process)
-                has_threadlock = self._threadlock.acquire(False) #False means don't block
-                if not has_threadlock:
-                    curr_thread = threading.current_thread()
-                    raise RuntimeError("could not obtain the thread lock in thread: %s" % curr_thread.name)
-                #next try to obtain the process lock (lockfile implementation)
-                fcntl.lockf(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB) #might throw IOError
-                #we have both locks now
-                info = "acquired by PID %s at %s" % (os.getpid(), time.time())
-                self._lockfile.truncate(0) #clean up after last thread
-                self._lockfile.write(info) #tell them who you are
-                self._lockfile.flush()
-                return
-            except IOError: #some else has lock
-                dt = time.time() - t0
-                if not timeout is None and dt >= timeout:
-                    raise RuntimeError("acquiring the mutex lock '%s' has timed-out in %f seconds" % (self.name, timeout))
-                time.sleep(SLEEP_TIME)
+        #first acquire the thread lock (within one process)
+        has_threadlock = state.threadlock.acquire(False)
+        contended = not has_threadlock
+        if not has_threadlock:
+            if timeout is None:
+                has_threadlock = state.threadlock.acquire()
+            else:
+                has_threadlock = state.threadlock.acquire(timeout = max(0.0, timeout))
+        try:
+            if not has_threadlock:
+                self._raise_timeout(timeout)
+            state.open_lockfile()
+            #next obtain the process lock (lockfile implementation) for the remaining time
+            remaining = None if timeout is None else max(0.0, timeout - (time.time() - t0))
+            if not state.lock_file(remaining):
+                self._raise_timeout(timeout)
+        except BaseException:
+            if has_threadlock:
+                state.threadlock.release()
+            raise
+        #we have both locks now
+        t1 = time.time()
+        state.owner = me
+        state.count = 1
+        state.acquired_time = t1
+        stats = state.stats
+        wait = t1 - t0
+        stats['acquisitions'] += 1
+        stats['wait_time']    += wait
+        stats['max_wait']      = max(stats['max_wait'], wait)
+        if contended or state.file_contended:
+            stats['contended'] += 1
+        info = "acquired by PID %s at %s" % (os.getpid(), t1)
+        state.lockfile.truncate(0) #clean up after last thread
+        state.lockfile.write(info) #tell them who you are
+        state.lockfile.flush()
 
     def release(self):
-        info = ", released at %s\n" % (time.time(),)
+        state = self._state
+        if state.owner != threading.get_ident():
+            curr_thread = threading.current_thread()
+            raise RuntimeError("the mutex lock '%s' is not held by thread: %s" % (self.name, curr_thread.name))
+        state.count -= 1
+        if state.count > 0: #still held by an outer acquisition
+            return
+        t = time.time()
+        hold = t - state.acquired_time
+        stats = state.stats
+        stats['hold_time'] += hold
+        stats['max_hold']   = max(stats['max_hold'], hold)
+        state.owner = None
+        info = ", released at %s\n" % (t,)
         #release process lock first
-        self._lockfile.write(info)
-        self._lockfile.flush()
-        fcntl.lockf(self._lockfile, fcntl.LOCK_UN)
+        state.lockfile.write(info)
+        state.lockfile.flush()
+        fcntl.lockf(state.lockfile, fcntl.LOCK_UN)
         #now release the thread lock
-        self._threadlock.release()
-        
+        state.threadlock.release()
+
+    def is_owned(self):
+        "is the mutex held by the calling thread"
+        return self._state.owner == threading.get_ident()
+
+    def get_stats(self):
+        "get the contention statistics, shared by all the Mutex objects for the lockfile in this process"
+        stats = dict(self._state.stats)
+        acquisitions = stats['acquisitions']
+        stats['mean_wait'] = stats['wait_time']/acquisitions if acquisitions else 0.0
+        stats['mean_hold'] = stats['hold_time']/acquisitions if acquisitions else 0.0
+        return stats
+
+    def _raise_timeout(self, timeout):
+        self._state.stats['timeouts'] += 1
+        raise RuntimeError("acquiring the mutex lock '%s' has timed-out in %f seconds" % (self.name, timeout))
+
     #implement Python 'with' statement interface
     def __enter__(self):
         #set things up
         self.acquire() #grab the lock on 'with' entrance
-        
+        return self
+
     def __exit__(self, type, value, traceback):
         #tear things down
         self.release() #release on 'with' exit
 
+###############################################################################
+class RWMutex(Mutex):
+    """A Mutex which may also be held shared, by many threads and processes
+       at once: 'acquire' (and 'with mutex:') is exclusive as before, use
+       'acquire_shared' or 'with mutex.shared():' to only read
+    """
+    rw = True
+
+    def acquire(self, timeout = None):
+        if self._state.shared_counts.get(threading.get_ident()):
+            raise RuntimeError("the mutex lock '%s' is held shared by the thread, it can't be upgraded" % self.name)
+        Mutex.acquire(self, timeout = timeout)
+
+    def acquire_shared(self, timeout = None):
+        if timeout is None:
+            timeout = self.default_timeout
+        state = self._state
+        me = threading.get_ident()
+        if state.owner == me: #the exclusive owner may read too
+            state.count += 1
+            return
+        count = state.shared_counts.get(me, 0)
+        if count: #reentrant
+            state.shared_counts[me] = count + 1
+            return
+        t0 = time.time()
+        threadlock = state.threadlock
+        has_threadlock = threadlock.acquire_shared(False)
+        if not has_threadlock:
+            has_threadlock = threadlock.acquire_shared(timeout = -1 if timeout is None else max(0.0, timeout))
+        try:
+            if not has_threadlock:
+                self._raise_timeout(timeout)
+            remaining = None if timeout is None else max(0.0, timeout - (time.time() - t0))
+            if not state.lock_shared_file(remaining):
+                self._raise_timeout(timeout)
+        except BaseException:
+            if has_threadlock:
+                threadlock.release_shared()
+            raise
+        state.shared_counts[me] = 1
+        wait = time.time() - t0
+        with state.guard:
+            stats = state.stats
+            stats['shared_acquisitions'] += 1
+            stats['shared_wait_time']    += wait
+            stats['shared_max_wait']      = max(stats['shared_max_wait'], wait)
+
+    def release_shared(self):
+        state = self._state
+        me = threading.get_ident()
+        if state.owner == me: #taken by 'acquire_shared' while held exclusive
+            self.release()
+            return
+        count = state.shared_counts.get(me, 0)
+        if not count:
+            curr_thread = threading.current_thread()
+            raise RuntimeError("the mutex lock '%s' is not held shared by thread: %s" % (self.name, curr_thread.name))
+        if count > 1:
+            state.shared_counts[me] = count - 1
+            return
+        del state.shared_counts[me]
+        #release process lock first
+        state.unlock_shared_file()
+        state.threadlock.release_shared()
+
+    def is_owned_shared(self):
+        "is the mutex held shared by the calling thread"
+        return threading.get_ident() in self._state.shared_counts
+
+    @contextlib.contextmanager
+    def shared(self, timeout = None):
+        "'with mutex.shared():' holds the mutex shared"
+        self.acquire_shared(timeout = timeout)
+        try:
+            yield self
+        finally:
+            self.release_shared()
+
+    @contextlib.contextmanager
+    def exclusive(self, timeout = None):
+        "'with mutex.exclusive(timeout):' holds the mutex exclusively"
+        self.acquire(timeout = timeout)
+        try:
+            yield self
+        finally:
+            self.release()
+
+###############################################################################
+MUTEX_MODES = {'exclusive': Mutex,
+               'rw'       : RWMutex,
+              }
+
+def make_mutex(name, mode = 'exclusive', fair = False, **kwargs):
+    "get a Mutex of the mode, 'exclusive' or 'rw' (shared/exclusive)"
+    try:
+        mutex_class = MUTEX_MODES[mode]
+    except KeyError:
+        raise ValueError("unknown mutex mode '%s', must be one of %r" % (mode, sorted(MUTEX_MODES.keys())))
+    return mutex_class(name, fair = fair, **kwargs)
+
 ################################################################################
 # TEST CODE
 ################################################################################
 if __name__ == "__main__":
     m1 = Mutex("test1")
     n1 = Mutex("test1")
-    #m1.acquire()
-    #n1.acquire(timeout = 5) #should fail with RuntimeError
-
-
-
+    m1.acquire()
+    m1.acquire() #reentrant
+    def contend():
+        try:
+            n1.acquire(timeout = 0.5) #should fail with RuntimeError
+        except RuntimeError as exc:
+            print(exc)
+    thread = threading.Thread(target = contend)
+    thread.start()
+    thread.join()
+    m1.release()
+    m1.release()
+    print(m1.get_stats())
+    #readers share the mutex, the writer waits for them
+    rw = RWMutex("test_rw", fair = True)
+    def read():
+        with rw.shared():
+            time.sleep(0.2)
+    readers = [threading.Thread(target = read) for i in range(3)]
+    t0 = time.time()
+    for reader in readers:
+        reader.start()
+    time.sleep(0.05)
+    with rw:
+        print("writer waited %0.2f seconds for 3 concurrent readers" % (time.time() - t0))
+    print(rw.get_stats())
@@ -0,0 +1,154 @@
+""" events and queues which can be waited on together with sockets and file
+    descriptors, so that a thread can block on many sources at once
+
+    Each SelectableEvent and SelectableQueue owns a self-pipe, which holds a
+    byte while the event is set or the queue is not empty, and 'wait_any'
+    selects on the pipes and any other file descriptors.
+"""
+###############################################################################
+import os, queue, threading, selectors, time
+
+###############################################################################
+class _SelfPipe(object):
+    "a non-blocking pipe holding at most one byte, to mark a source as ready"
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+
+    def fileno(self):
+        return self._read_fd
+
+    def mark(self):
+        os.write(self._write_fd, b"\x00")
+
+    def unmark(self):
+        try:
+            os.read(self._read_fd, 1)
+        except BlockingIOError: #wasn't marked
+            pass
+
+    def close(self):
+        for fd in (self._read_fd, self._write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._read_fd = self._write_fd = -1
+
+    def __del__(self):
+        self.close()
+
+###############################################################################
+class SelectableEvent(object):
+    """A drop-in replacement for 'threading.Event' which may also be passed
+       to 'wait_any'
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock  = threading.Lock()
+        self._pipe  = _SelfPipe()
+
+    def fileno(self):
+        return self._pipe.fileno()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    isSet = is_set
+
+    def set(self):
+        with self._lock:
+            if not self._event.is_set():
+                self._event.set()
+                self._pipe.mark()
+
+    def clear(self):
+        with self._lock:
+            if self._event.is_set():
+                self._event.clear()
+                self._pipe.unmark()
+
+    def wait(self, timeout = None):
+        return self._event.wait(timeout)
+
+    def is_ready(self):
+        return self._event.is_set()
+
+###############################################################################
+class SelectableQueue(queue.Queue):
+    """A FIFO 'queue.Queue' which may also be passed to 'wait_any', it is
+       ready while it holds any items
+    """
+    def __init__(self, maxsize = 0):
+        queue.Queue.__init__(self, maxsize)
+        self._pipe = _SelfPipe()
+
+    def fileno(self):
+        return self._pipe.fileno()
+
+    def is_ready(self):
+        return self.qsize() > 0
+
+    #called with the queue's mutex held
+    def _put(self, item):
+        queue.Queue._put(self, item)
+        if len(self.queue) == 1:
+            self._pipe.mark()
+
+    def _get(self):
+        item = queue.Queue._get(self)
+        if not self.queue:
+            self._pipe.unmark()
+        return item
+
+###############################################################################
+def wait_any(*sources, timeout = None):
+    """block until any of the sources is ready or the timeout (seconds)
+       expires, returns the list of ready sources, empty on a timeout
+
+       A source is a SelectableEvent, a SelectableQueue, or any object with a
+       'fileno' method (socket, file) or an int file descriptor, which is
+       ready when readable.
+    """
+    #don't make system calls if something is ready already
+    ready = [source for source in sources if getattr(source, 'is_ready', None) and source.is_ready()]
+    if ready:
+        return ready
+    for source in sources:
+        if isinstance(source, threading.Event):
+            raise TypeError("'threading.Event' can not be waited on, use 'SelectableEvent' instead")
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with selectors.DefaultSelector() as selector:
+        for index, source in enumerate(sources):
+            selector.register(source, selectors.EVENT_READ, index)
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            keys = selector.select(remaining)
+            #keep the order of the sources
+            indices = sorted(key.data for key, mask in keys)
+            #an event may be cleared or a queue emptied by another thread in the meantime
+            ready = [sources[index] for index in indices
+                     if not getattr(sources[index], 'is_ready', None) or sources[index].is_ready()]
+            if ready or remaining == 0.0:
+                return ready
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    stop_event = SelectableEvent()
+    data_queue = SelectableQueue()
+    def producer():
+        for i in range(5):
+            time.sleep(0.1)
+            data_queue.put(i)
+        stop_event.set()
+    threading.Thread(target = producer).start()
+    while True:
+        ready = wait_any(stop_event, data_queue, timeout = 1.0)
+        if data_queue in ready:
+            print("got", data_queue.get())
+        elif stop_event in ready:
+            print("stopped")
+            break
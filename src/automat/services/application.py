@@ -8,6 +8,8 @@ except ImportError:
     from automat.substitutes.ordered_dict import OrderedDict
 #Automat framework provided
 from automat.core.hwcontrol.config.configuration import Configuration
+from automat.core.hwcontrol.controllers.initialization import initialize_concurrently, DEFAULT_INIT_WORKERS
+from automat.core.hwcontrol.controllers.shutdown import shutdown_concurrently, DEFAULT_SHUTDOWN_TIMEOUT
 #from automat.services.configurator import ConfiguratorService
 from automat.services.errors import ConfigurationError, DeviceError
 ###############################################################################
@@ -46,6 +48,7 @@ class ApplicationBase(object):
         self._controllers = OrderedDict()
         self._metadata    = OrderedDict()
         self._used_controllers = used_controllers
+        self._init_report = None #timings of the last 'initialize'
         #create an event for synchronize forced shutdown
         self._abort_event = threading.Event()
 
@@ -60,14 +63,33 @@ class ApplicationBase(object):
         except KeyError: #ignore log file absence
             pass
 
-    def initialize(self, used_controllers = None):
+    def initialize(self, used_controllers = None, max_workers = DEFAULT_INIT_WORKERS):
         if used_controllers is None:
             used_controllers = []
+        controllers = OrderedDict()
         for name in used_controllers:
             #self.print_comment("\tLoading and initializing controller '%s'..." % name)
             controller = self._load_controller(name)
-            controller.initialize()
+            if not controller is None: #None if the error was ignored
+                controllers[name] = controller
+        #initialize the devices of all the controllers together, independent ones concurrently
+        self._init_report = initialize_concurrently(controllers, max_workers = max_workers)
+        for name, controller in controllers.items():
+            controller.initialize() #the devices are skipped, initialized by the graph
             #self.print_comment("\tcompleted")
+
+    def get_init_report(self):
+        "the per device and controller timings of the last 'initialize'"
+        return self._init_report
+
+    def shutdown(self, timeout = DEFAULT_SHUTDOWN_TIMEOUT):
+        """shut down all the loaded controllers and devices, each once and
+           independent ones concurrently, within the 'timeout' (seconds),
+           returns the report of the timings"""
+        report = shutdown_concurrently(self._controllers, devices = self._devices, timeout = timeout)
+        for node in report.timed_out:
+            self.print_comment("shutdown of '%s' did not complete within %s seconds" % (node.name, timeout))
+        return report
  
     def setup_textbox_printer(self, textbox_printer):
         self._textbox_printer = textbox_printer
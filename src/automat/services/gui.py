@@ -12,6 +12,7 @@ except ImportError:
 import Pmw
 #Automat framework provided
 from automat.system_tools.daemonize import ignore_KeyboardInterrupt, notice_KeyboardInterrupt
+from automat.core.events.event_batch import unpack_events
 ###############################################################################
 # Module Constants
 DEFAULT_WINDOW_TITLE = "Automat GUI Control"
@@ -76,8 +77,9 @@ class GUIBase:
             controller = self._app._load_controller(handle)
             #read out all pending events
             while not controller.event_queue.empty():
-                event, info = controller.event_queue.get()
-                self.print_event(event,info)
+                item = controller.event_queue.get()
+                for event, info in unpack_events((item,)): #may be an EventBatch
+                    self.print_event(event,info)
     
     def busy(self):
         self._win.config(cursor="watch")